@@ -0,0 +1,239 @@
+from typing import Optional, Sequence, Mapping, Any, Union
+from enum import unique, Enum
+from pathlib import Path
+from contextlib import contextmanager
+import os
+import time
+import json
+import hashlib
+import tempfile
+import shutil
+
+import attrs
+
+if os.name == 'nt':
+    import msvcrt
+else:
+    import fcntl
+
+
+@attrs.define
+class ArtifactCacheConfig:
+    # The cache is disabled if `cache_folder` is not provided.
+    cache_folder: Optional[str] = None
+    # Size bounds (in bytes) for LRU eviction.
+    cpp_level_max_size: int = 4 * 1024**3
+    lib_level_max_size: int = 2 * 1024**3
+
+
+@unique
+class ArtifactCacheLevel(Enum):
+    # The transformed C++ file, ready to be compiled.
+    CPP = 'cpp'
+    # The compiled shared library.
+    LIB = 'lib'
+
+
+def compute_artifact_cache_key(*parts: Union[str, bytes]):
+    sha256 = hashlib.sha256()
+    for part in parts:
+        if isinstance(part, str):
+            part = part.encode()
+        # Length prefix to avoid ambiguity in concatenation.
+        sha256.update(len(part).to_bytes(8, 'little'))
+        sha256.update(part)
+    return sha256.hexdigest()
+
+
+@contextmanager
+def lock_file(path: Path):
+    with path.open('a+b') as fout:
+        if os.name == 'nt':
+            fout.seek(0)
+            msvcrt.locking(fout.fileno(), msvcrt.LK_LOCK, 1)  # type: ignore
+            try:
+                yield
+            finally:
+                fout.seek(0)
+                msvcrt.locking(fout.fileno(), msvcrt.LK_UNLCK, 1)  # type: ignore
+        else:
+            fcntl.flock(fout.fileno(), fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(fout.fileno(), fcntl.LOCK_UN)
+
+
+class ArtifactCache:
+    '''
+    Content-addressed on-disk cache shared by multiple processes on the same host.
+
+    Layout: `<cache_folder>/<level>/<key[:2]>/<key>/{files..., meta.json}`. The mtime of
+    `meta.json` is refreshed on every hit and used for LRU eviction. The total size of a level
+    is tracked in `<cache_folder>/<level>/size.json`, the level is scanned only if the size
+    exceeds the bound.
+    '''
+
+    META_JSON = 'meta.json'
+    SIZE_JSON = 'size.json'
+    TEMP_FD_PREFIX = '.tmp_'
+    # The temporary folders left by the crashed processes are removed after this age (seconds).
+    TEMP_FD_MAX_AGE = 3600
+
+    def __init__(self, config: ArtifactCacheConfig):
+        assert config.cache_folder
+        self.config = config
+        self.cache_fd = Path(config.cache_folder).expanduser().absolute()
+
+    def get_level_fd(self, level: ArtifactCacheLevel):
+        level_fd = self.cache_fd / level.value
+        level_fd.mkdir(exist_ok=True, parents=True)
+        return level_fd
+
+    def get_level_max_size(self, level: ArtifactCacheLevel):
+        if level == ArtifactCacheLevel.CPP:
+            return self.config.cpp_level_max_size
+        elif level == ArtifactCacheLevel.LIB:
+            return self.config.lib_level_max_size
+        else:
+            raise NotImplementedError()
+
+    @contextmanager
+    def lock(self, level: ArtifactCacheLevel):
+        with lock_file(self.get_level_fd(level) / '.lock'):
+            yield
+
+    def get(
+        self,
+        level: ArtifactCacheLevel,
+        key: str,
+        output_fd: Path,
+    ) -> Optional[Mapping[str, Any]]:
+        '''
+        Copy the cached files to `output_fd` and return the metadata, or `None` if missed.
+        '''
+        entry_fd = self.get_level_fd(level) / key[:2] / key
+        meta_json = entry_fd / self.META_JSON
+
+        with self.lock(level):
+            if not meta_json.is_file():
+                return None
+            try:
+                meta = json.loads(meta_json.read_text())
+            except Exception:
+                # Broken entry, to be removed by the eviction.
+                return None
+            # Refresh for LRU.
+            os.utime(meta_json)
+
+        # Copy outside of the lock, the entry could be evicted in the meantime.
+        output_fd.mkdir(exist_ok=True, parents=True)
+        try:
+            for name in meta['files']:
+                shutil.copyfile(entry_fd / name, output_fd / name)
+        except OSError:
+            return None
+
+        with self.lock(level):
+            if not meta_json.is_file():
+                # Evicted during copying, the copied files might be incomplete.
+                return None
+
+        return meta['metadata']
+
+    def put(
+        self,
+        level: ArtifactCacheLevel,
+        key: str,
+        files: Sequence[Path],
+        metadata: Mapping[str, Any],
+    ):
+        level_fd = self.get_level_fd(level)
+        entry_fd = level_fd / key[:2] / key
+
+        # Prepare the entry outside of the lock.
+        temp_fd = Path(tempfile.mkdtemp(prefix=self.TEMP_FD_PREFIX, dir=level_fd))
+        size = 0
+        for file in files:
+            shutil.copyfile(file, temp_fd / file.name)
+            size += file.stat().st_size
+        (temp_fd / self.META_JSON).write_text(
+            json.dumps({
+                'files': [file.name for file in files],
+                'size': size,
+                'metadata': metadata,
+            })
+        )
+
+        with self.lock(level):
+            if entry_fd.exists():
+                # Added by another process.
+                shutil.rmtree(temp_fd)
+                return
+
+            entry_fd.parent.mkdir(exist_ok=True)
+            os.replace(temp_fd, entry_fd)
+
+            total_size = self.load_total_size(level)
+            if total_size is None:
+                self.evict(level)
+            else:
+                total_size += size
+                if total_size > self.get_level_max_size(level):
+                    self.evict(level)
+                else:
+                    self.save_total_size(level, total_size)
+
+    def load_total_size(self, level: ArtifactCacheLevel) -> Optional[int]:
+        # NOTE: Should be called with the lock held.
+        size_json = self.get_level_fd(level) / self.SIZE_JSON
+        if not size_json.is_file():
+            return None
+        try:
+            return int(json.loads(size_json.read_text())['size'])
+        except Exception:
+            return None
+
+    def save_total_size(self, level: ArtifactCacheLevel, total_size: int):
+        # NOTE: Should be called with the lock held.
+        size_json = self.get_level_fd(level) / self.SIZE_JSON
+        size_json.write_text(json.dumps({'size': total_size}))
+
+    def evict(self, level: ArtifactCacheLevel):
+        # NOTE: Should be called with the lock held.
+        level_fd = self.get_level_fd(level)
+        max_size = self.get_level_max_size(level)
+
+        # Orphaned temporary folders.
+        deadline = time.time() - self.TEMP_FD_MAX_AGE
+        for temp_fd in level_fd.glob(f'{self.TEMP_FD_PREFIX}*'):
+            try:
+                if temp_fd.stat().st_mtime < deadline:
+                    shutil.rmtree(temp_fd, ignore_errors=True)
+            except OSError:
+                pass
+
+        entries = []
+        total_size = 0
+        for entry_fd in level_fd.glob('*/*'):
+            if not entry_fd.is_dir() or entry_fd.parent.name.startswith(self.TEMP_FD_PREFIX):
+                continue
+            meta_json = entry_fd / self.META_JSON
+            try:
+                size = json.loads(meta_json.read_text())['size']
+                mtime = meta_json.stat().st_mtime
+            except Exception:
+                # Broken entry.
+                shutil.rmtree(entry_fd, ignore_errors=True)
+                continue
+            entries.append((mtime, size, entry_fd))
+            total_size += size
+
+        entries.sort(key=lambda entry: entry[0])
+        for _, size, entry_fd in entries:
+            if total_size <= max_size:
+                break
+            shutil.rmtree(entry_fd, ignore_errors=True)
+            total_size -= size
+
+        self.save_total_size(level, total_size)
@@ -0,0 +1,151 @@
+from typing import Dict, Any, Iterable, Optional
+from pathlib import Path
+import os
+import re
+import json
+import tempfile
+
+from Cython.Build.Dependencies import DependencyTree
+from Cython.Compiler.Main import Context
+from Cython.Compiler.Options import CompilationOptions, default_options, get_directive_defaults
+from Cython.Utils import clear_function_caches
+
+from .artifact_cache import compute_artifact_cache_key
+
+# `from pkg cimport mod` is resolved to `pkg` only by `DependencyTree`.
+CIMPORT_FROM_PATTERN = re.compile(
+    r'^[ \t]*from[ \t]+([\w.]+)[ \t]+cimport[ \t]+\(?([\w., \t]+)\)?',
+    re.MULTILINE,
+)
+
+
+class CodeFileDependencyResolver:
+    '''
+    Resolve the `.pxd` and the `.pxi` files a code file depends on (the `.pxd` of the same name,
+    `cimport` and `include`, transitively), using the dependency tree of Cython.
+    '''
+
+    def __init__(self, py_root_fd: Path):
+        self.py_root_fd = py_root_fd
+        # The parsed files are cached by path in the module level of Cython.
+        clear_function_caches()
+        context = Context(
+            [str(py_root_fd.parent)],
+            get_directive_defaults(),
+            options=CompilationOptions(default_options),
+        )
+        self.dependency_tree = DependencyTree(context, quiet=True)
+
+    def find_cimport_from_pxd_files(self, code_file: str):
+        pxd_files = []
+        with open(code_file, encoding='utf-8', errors='ignore') as fin:
+            code = fin.read()
+        for match in CIMPORT_FROM_PATTERN.finditer(code):
+            module, names = match.groups()
+            for name in names.split(','):
+                # `mod as alias`.
+                name = name.strip().split(' ')[0]
+                if not name:
+                    continue
+                pxd_file = self.dependency_tree.find_pxd(f'{module}.{name}', code_file)
+                if pxd_file:
+                    pxd_files.append(os.path.normpath(pxd_file))
+        return pxd_files
+
+    def get_dependency_files(self, py_file: Path):
+        # The closure of `DependencyTree` misses the dependencies of `from pkg cimport mod`.
+        pending = [os.path.normpath(py_file)]
+        visited = set(pending)
+        while pending:
+            code_file = pending.pop()
+            for dependency_file in (
+                *self.dependency_tree.all_dependencies(code_file),
+                *self.find_cimport_from_pxd_files(code_file),
+            ):
+                dependency_file = os.path.normpath(dependency_file)
+                if dependency_file not in visited and os.path.isfile(dependency_file):
+                    visited.add(dependency_file)
+                    pending.append(dependency_file)
+
+        visited.remove(os.path.normpath(py_file))
+        return sorted(Path(dependency_file) for dependency_file in visited)
+
+    def compute_dependency_hash(self, py_file: Path):
+        '''
+        Returns `None` if `py_file` depends on no other file.
+        '''
+        dependency_files = self.get_dependency_files(py_file)
+        if not dependency_files:
+            return None
+
+        parts = []
+        for dependency_file in dependency_files:
+            # Don't depend on the location of the package.
+            try:
+                parts.append(str(dependency_file.relative_to(self.py_root_fd.parent)))
+            except ValueError:
+                parts.append(str(dependency_file))
+            parts.append(dependency_file.read_bytes())
+        return compute_artifact_cache_key(*parts)
+
+
+class BuildManifest:
+    '''
+    The compiled libraries of the code files processed in the previous runs, kept in the
+    working folder. An entry is reused if the key (the LIB level cache key, which covers the code
+    file, its dependencies, the config and the toolchain) is unchanged.
+    '''
+
+    MANIFEST_JSON = 'manifest.json'
+
+    def __init__(self, working_fd: Path):
+        self.working_fd = working_fd
+        self.manifest_json = working_fd / self.MANIFEST_JSON
+        self.entries = self.load()
+
+    def load(self) -> Dict[str, Dict[str, Any]]:
+        if not self.manifest_json.is_file():
+            return {}
+        try:
+            return json.loads(self.manifest_json.read_text())
+        except Exception:
+            # Broken manifest, rebuild all.
+            return {}
+
+    def get(self, rel_path: str, key: str) -> Optional[Dict[str, Any]]:
+        entry = self.entries.get(rel_path)
+        if entry is None or entry['key'] != key:
+            return None
+        if not (self.working_fd / entry['compiled_lib_file']).is_file():
+            return None
+        return entry
+
+    def get_compiled_lib_file(self, entry: Dict[str, Any]):
+        return self.working_fd / entry['compiled_lib_file']
+
+    def record(
+        self,
+        rel_path: str,
+        key: str,
+        compiled_lib_file: Path,
+        metadata: Dict[str, Any],
+    ):
+        self.entries[rel_path] = {
+            'key': key,
+            'compiled_lib_file': compiled_lib_file.relative_to(self.working_fd).as_posix(),
+            'metadata': metadata,
+        }
+
+    def save(self, rel_paths: Iterable[str]):
+        '''
+        Keep the entries of `rel_paths` only.
+        '''
+        rel_paths = set(rel_paths)
+        self.entries = {
+            rel_path: entry for rel_path, entry in self.entries.items() if rel_path in rel_paths
+        }
+
+        fd, temp_path = tempfile.mkstemp(dir=self.working_fd)
+        with os.fdopen(fd, 'w') as fout:
+            json.dump(self.entries, fout, indent=2, sort_keys=True)
+        os.replace(temp_path, self.manifest_json)
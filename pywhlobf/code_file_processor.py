@@ -1,18 +1,26 @@
 # pyright: reportUnboundVariable=false
 from typing import List, Optional
 from pathlib import Path
+import functools
+import json
 
 import attrs
+import cattrs
+from setuptools import Extension
+from Cython.Compiler.Version import version as cython_version
 
 from .component.cpp_generator import (
     CppGeneratorConfig,
     CppGenerator,
+    dump_ext_module,
+    load_ext_module,
 )
 from .component.flag_setter import (
     FlagSetterConfig,
     FlagSetter,
 )
 from .component.string_literal_obfuscator import (
+    StringLiteralObfuscatorMode,
     StringLiteralObfuscatorConfig,
     StringLiteralObfuscator,
 )
@@ -22,11 +30,34 @@ from .component.source_code_injector import (
 )
 from .component.cpp_compiler import (
     CppCompilerConfig,
+    CppCompilerPgoStage,
+    CompiledLibSizeReport,
     CppCompiler,
 )
+from .unity_build import get_unity_build_init_symbol
+from .artifact_cache import (
+    ArtifactCacheConfig,
+    ArtifactCacheLevel,
+    ArtifactCache,
+    compute_artifact_cache_key,
+)
+from .component.cpp_transform_pipeline import CppTransformPipeline
 from .execution_context import ExecutionContextCollection
 
 
+@functools.lru_cache()
+def compute_component_code_hash():
+    # The C++ file also depends on the code and the assets of the components.
+    component_fd = Path(__file__).parent / 'component'
+    parts = []
+    for file in sorted(component_fd.glob('**/*')):
+        if not file.is_file() or file.suffix == '.pyc':
+            continue
+        parts.append(file.relative_to(component_fd).as_posix())
+        parts.append(file.read_bytes())
+    return compute_artifact_cache_key(*parts)
+
+
 @attrs.define
 class CodeFileProcessorConfig:
     cpp_generator_config: CppGeneratorConfig = attrs.field(factory=CppGeneratorConfig)
@@ -38,7 +69,10 @@ class CodeFileProcessorConfig:
         factory=SourceCodeInjectorConfig
     )
     cpp_compiler_config: CppCompilerConfig = attrs.field(factory=CppCompilerConfig)
+    artifact_cache_config: ArtifactCacheConfig = attrs.field(factory=ArtifactCacheConfig)
     verbose: bool = False
+    # If enabled, keep a `.cpp.bak_before_<transform>` snapshot before each C++ transform.
+    debug: bool = False
 
 
 @attrs.define
@@ -46,6 +80,68 @@ class CodeFileProcessorOutput:
     py_file: Path
     compiled_lib_file: Optional[Path]
     execution_context_collection: ExecutionContextCollection
+    artifact_cache_level: Optional[ArtifactCacheLevel] = None
+    # Set instead of `compiled_lib_file` in the unity build,
+    # along with the configured `ext_module` for linking.
+    compiled_object_file: Optional[Path] = None
+    ext_module: Optional[Extension] = None
+    compiled_lib_size_report: Optional[CompiledLibSizeReport] = None
+
+    @property
+    def succeeded(self):
+        return bool(self.compiled_lib_file or self.compiled_object_file)
+
+
+@attrs.define
+class CodeFileProcessorIntermediateOutput:
+    # The state handed over from `run_generate` to `run_compile`.
+    py_file: Path
+    build_fd: Path
+    execution_context_collection: ExecutionContextCollection
+    ext_module: Optional[Extension] = None
+    include_fds: List[Path] = attrs.field(factory=list)
+    string_literal_obfuscator_activated: bool = False
+    source_code_injector_activated: bool = False
+    cpp_level_cache_key: Optional[str] = None
+    lib_level_cache_key: Optional[str] = None
+    artifact_cache_level: Optional[ArtifactCacheLevel] = None
+    # Overrides `setup_build_ext_timeout` if set.
+    cpp_compiler_timeout: Optional[float] = None
+    # If set, compile to an object file for the unity build.
+    unity_build_index: Optional[int] = None
+    # Set if hitting the LIB level cache.
+    compiled_lib_file: Optional[Path] = None
+    compiled_lib_size_report: Optional[CompiledLibSizeReport] = None
+    compiled_object_file: Optional[Path] = None
+
+    @property
+    def should_compile(self):
+        return (
+            self.execution_context_collection.succeeded and self.compiled_lib_file is None
+            and self.compiled_object_file is None
+        )
+
+    def to_output(self):
+        compiled_lib_file = None
+        compiled_lib_size_report = None
+        compiled_object_file = None
+        ext_module = None
+        if self.execution_context_collection.succeeded:
+            compiled_lib_file = self.compiled_lib_file
+            compiled_lib_size_report = self.compiled_lib_size_report
+            compiled_object_file = self.compiled_object_file
+            if compiled_object_file:
+                ext_module = self.ext_module
+
+        return CodeFileProcessorOutput(
+            py_file=self.py_file,
+            compiled_lib_file=compiled_lib_file,
+            execution_context_collection=self.execution_context_collection,
+            artifact_cache_level=self.artifact_cache_level,
+            compiled_object_file=compiled_object_file,
+            ext_module=ext_module,
+            compiled_lib_size_report=compiled_lib_size_report,
+        )
 
 
 class CodeFileProcessor:
@@ -58,7 +154,11 @@ class CodeFileProcessor:
         self.string_literal_obfuscator = \
             StringLiteralObfuscator(config.string_literal_obfuscator_config)
         self.source_code_injector = SourceCodeInjector(config.source_code_injector_config)
-        self.cpp_compiler = CppCompiler(config.cpp_compiler_config)
+        self.cpp_compiler = CppCompiler(config.cpp_compiler_config, verbose=config.verbose)
+
+        self.artifact_cache = None
+        if config.artifact_cache_config.cache_folder:
+            self.artifact_cache = ArtifactCache(config.artifact_cache_config)
 
     @classmethod
     def prep_fds(
@@ -84,15 +184,88 @@ class CodeFileProcessor:
 
         return build_fd, logging_fd, cpp_generator_working_fd
 
-    def run(
+    def get_cpp_level_cache_key(
+        self,
+        py_file: Path,
+        py_root_fd: Optional[Path] = None,
+        dependency_hash: Optional[str] = None,
+    ):
+        # Exclude the fields irrelevant to the C++ file generation.
+        config_struct = cattrs.unstructure(self.config)
+        for key in ('cpp_compiler_config', 'artifact_cache_config', 'verbose', 'debug'):
+            config_struct.pop(key)
+        config_struct['cpp_generator_config'].pop('file_link_strategy')
+
+        # The module name and the encrypted file description depend on the relative path.
+        if py_root_fd:
+            py_file_desc = str(Path(py_root_fd.name) / py_file.relative_to(py_root_fd))
+        else:
+            py_file_desc = py_file.name
+
+        parts = [
+            py_file.read_bytes(),
+            py_file_desc,
+            cython_version,
+            compute_component_code_hash(),
+            json.dumps(config_struct, sort_keys=True),
+        ]
+        if dependency_hash:
+            # The `.pxd` and the `.pxi` files.
+            parts.append(dependency_hash)
+        return compute_artifact_cache_key(*parts)
+
+    def get_lib_level_cache_key(self, cpp_level_cache_key: str):
+        return compute_artifact_cache_key(
+            cpp_level_cache_key,
+            json.dumps(cattrs.unstructure(self.config.cpp_compiler_config), sort_keys=True),
+            self.cpp_compiler.get_toolchain_signature(),
+        )
+
+    def should_use_lib_level_cache(self, unity_build_index: Optional[int]):
+        # Object files of the unity build are not cached.
+        # The PGO libraries depend on the profiles, which are not part of the key.
+        return (
+            unity_build_index is None
+            and self.config.cpp_compiler_config.pgo_stage == CppCompilerPgoStage.NONE
+        )
+
+    def artifact_cache_get_lib(self, output: CodeFileProcessorIntermediateOutput, output_fd: Path):
+        assert self.artifact_cache and output.lib_level_cache_key
+        metadata = self.artifact_cache.get(
+            level=ArtifactCacheLevel.LIB,
+            key=output.lib_level_cache_key,
+            output_fd=output_fd,
+        )
+        if metadata is None:
+            return False
+
+        output.artifact_cache_level = ArtifactCacheLevel.LIB
+        output.compiled_lib_file = output_fd / metadata['compiled_lib_file_name']
+        if metadata.get('compiled_lib_size_report'):
+            output.compiled_lib_size_report = cattrs.structure(
+                metadata['compiled_lib_size_report'],
+                CompiledLibSizeReport,
+            )
+        return True
+
+    def run_generate(
         self,
         py_file: Path,
         build_fd: Path,
         logging_fd: Path,
         py_root_fd: Optional[Path] = None,
+        cpp_compiler_timeout: Optional[float] = None,
+        unity_build_index: Optional[int] = None,
+        enable_lib_level_cache: bool = True,
+        dependency_hash: Optional[str] = None,
     ):
-        include_fds: List[Path] = []
-
+        '''
+        The stages before C++ compilation.
+        If `enable_lib_level_cache` is false, the LIB level cache is left to `run_compile`,
+        which is required if the output is compiled by processors with different compilers.
+        `dependency_hash` covers the files cimported or included by `py_file`, see
+        `CodeFileDependencyResolver`.
+        '''
         build_fd, logging_fd, cpp_generator_working_fd = self.prep_fds(
             py_file=py_file,
             build_fd=build_fd,
@@ -104,53 +277,231 @@ class CodeFileProcessor:
             logging_fd=logging_fd,
             verbose=self.config.verbose,
         )
+        output = CodeFileProcessorIntermediateOutput(
+            py_file=py_file,
+            build_fd=build_fd,
+            execution_context_collection=execution_context_collection,
+            cpp_compiler_timeout=cpp_compiler_timeout,
+            unity_build_index=unity_build_index,
+        )
 
         with execution_context_collection.guard('prep') as should_run:
             assert should_run
             assert py_file.is_file()
             assert py_file.suffix in ('.py', '.pyx')
 
+        if self.artifact_cache:
+            with execution_context_collection.guard('artifact_cache_get') as should_run:
+                if should_run:
+                    cpp_level_cache_key = self.get_cpp_level_cache_key(
+                        py_file,
+                        py_root_fd,
+                        dependency_hash,
+                    )
+                    output.cpp_level_cache_key = cpp_level_cache_key
+
+                    lib_level_cache_hit = False
+                    if enable_lib_level_cache \
+                            and self.should_use_lib_level_cache(unity_build_index):
+                        output.lib_level_cache_key = \
+                            self.get_lib_level_cache_key(cpp_level_cache_key)
+                        lib_level_cache_hit = \
+                            self.artifact_cache_get_lib(output, cpp_generator_working_fd)
+
+                    if not lib_level_cache_hit:
+                        metadata = self.artifact_cache.get(
+                            level=ArtifactCacheLevel.CPP,
+                            key=cpp_level_cache_key,
+                            output_fd=cpp_generator_working_fd,
+                        )
+                        if metadata is not None:
+                            output.artifact_cache_level = ArtifactCacheLevel.CPP
+                            output.ext_module = load_ext_module(
+                                metadata['ext_module'],
+                                cpp_generator_working_fd,
+                            )
+                            output.string_literal_obfuscator_activated = \
+                                metadata['string_literal_obfuscator_activated']
+                            if output.string_literal_obfuscator_activated:
+                                output.include_fds.extend(
+                                    self.get_string_literal_obfuscator_include_fds()
+                                )
+                            output.source_code_injector_activated = \
+                                metadata['source_code_injector_activated']
+
+        if output.artifact_cache_level is not None:
+            return output
+
         with execution_context_collection.guard('cpp_generator') as should_run:
             if should_run:
-                cpp_file, ext_module = self.cpp_generator.run(
+                cpp_file, output.ext_module = self.cpp_generator.run(
                     py_file=py_file,
                     working_fd=cpp_generator_working_fd,
                 )
 
-        with execution_context_collection.guard('flag_setter') as should_run:
-            if should_run:
-                self.flag_setter.run(cpp_file=cpp_file)
-
-        with execution_context_collection.guard('string_literal_obfuscator') as should_run:
-            if should_run:
-                (
-                    string_literal_obfuscator_activated,
-                    include_fd,
-                ) = self.string_literal_obfuscator.run(cpp_file=cpp_file)
-                if include_fd:
-                    include_fds.append(include_fd)
-
-        with execution_context_collection.guard('source_code_injector') as should_run:
-            if should_run:
-                source_code_injector_activated = self.source_code_injector.run(
-                    py_file=py_file,
-                    cpp_file=cpp_file,
+        # The C++ file is streamed line by line through all the transforms, and written once.
+        cpp_transform_pipeline = CppTransformPipeline(self.config.debug)
+        if self.flag_setter.config.enable:
+            cpp_transform_pipeline.register('flag_setter', self.flag_setter.transform_lines)
+        if self.string_literal_obfuscator.config.enable:
+            cpp_transform_pipeline.register(
+                'string_literal_obfuscator',
+                self.string_literal_obfuscator.transform_lines,
+            )
+            output.string_literal_obfuscator_activated = True
+            output.include_fds.extend(self.get_string_literal_obfuscator_include_fds())
+        if self.source_code_injector.is_activated():
+            cpp_transform_pipeline.register(
+                'source_code_injector',
+                functools.partial(
+                    self.source_code_injector.transform_lines,
+                    py_file,
                     py_root_fd=py_root_fd,
+                ),
+            )
+            output.source_code_injector_activated = True
+        if cpp_transform_pipeline.transforms and execution_context_collection.succeeded:
+            cpp_transform_pipeline.run(cpp_file, execution_context_collection)
+
+        if self.artifact_cache:
+            with execution_context_collection.guard('artifact_cache_put_cpp') as should_run:
+                if should_run:
+                    assert output.ext_module
+                    self.artifact_cache.put(
+                        level=ArtifactCacheLevel.CPP,
+                        key=cpp_level_cache_key,
+                        files=[cpp_file],
+                        metadata={
+                            'ext_module': dump_ext_module(output.ext_module),
+                            'string_literal_obfuscator_activated':
+                                output.string_literal_obfuscator_activated,
+                            'source_code_injector_activated':
+                                output.source_code_injector_activated,
+                        },
+                    )
+
+        return output
+
+    def get_string_literal_obfuscator_include_fds(self):
+        # `obfuscate.h` is included by the TEMPLATE mode only.
+        if self.string_literal_obfuscator.config.mode == StringLiteralObfuscatorMode.TEMPLATE:
+            return [StringLiteralObfuscator.get_include_fd()]
+        return []
+
+    def get_precompiled_header_codes(self, output: CodeFileProcessorIntermediateOutput):
+        # Follows the order of `run_generate`, the last transform injects the first header.
+        precompiled_header_codes: List[str] = []
+        if output.source_code_injector_activated:
+            precompiled_header_codes.append(self.source_code_injector.get_header_code())
+        if output.string_literal_obfuscator_activated:
+            precompiled_header_codes.append(
+                self.string_literal_obfuscator.get_header_code(
+                    self.string_literal_obfuscator.config.mode
                 )
+            )
+        return precompiled_header_codes
+
+    def run_compile(self, output: CodeFileProcessorIntermediateOutput):
+        '''
+        The C++ compilation stage, could be executed in another process.
+        '''
+        if not output.should_compile:
+            return output.to_output()
+
+        execution_context_collection = output.execution_context_collection
+
+        if output.unity_build_index is not None:
+            with execution_context_collection.guard('cpp_compiler') as should_run:
+                if should_run:
+                    assert output.ext_module
+                    output.compiled_object_file = self.cpp_compiler.run_object(
+                        ext_module=output.ext_module,
+                        working_fd=output.build_fd,
+                        include_fds=output.include_fds,
+                        string_literal_obfuscator_activated=(
+                            output.string_literal_obfuscator_activated
+                        ),
+                        source_code_injector_activated=output.source_code_injector_activated,
+                        string_literal_obfuscator_mode=(
+                            self.string_literal_obfuscator.config.mode
+                        ),
+                        init_symbol=get_unity_build_init_symbol(output.unity_build_index),
+                        precompiled_header_codes=self.get_precompiled_header_codes(output),
+                        timeout=output.cpp_compiler_timeout,
+                    )
+            return output.to_output()
+
+        if self.artifact_cache and self.should_use_lib_level_cache(output.unity_build_index) \
+                and output.cpp_level_cache_key and output.lib_level_cache_key is None:
+            # Not looked up by `run_generate`.
+            with execution_context_collection.guard('artifact_cache_get_lib') as should_run:
+                if should_run:
+                    assert output.ext_module
+                    output.lib_level_cache_key = \
+                        self.get_lib_level_cache_key(output.cpp_level_cache_key)
+                    self.artifact_cache_get_lib(
+                        output,
+                        Path(output.ext_module.sources[0]).parent,
+                    )
+            if output.compiled_lib_file:
+                return output.to_output()
 
-        compiled_lib_file = None
         with execution_context_collection.guard('cpp_compiler') as should_run:
             if should_run:
-                compiled_lib_file = self.cpp_compiler.run(
-                    ext_module=ext_module,
-                    working_fd=build_fd,
-                    include_fds=include_fds,
-                    string_literal_obfuscator_activated=string_literal_obfuscator_activated,
-                    source_code_injector_activated=source_code_injector_activated,
+                assert output.ext_module
+                output.compiled_lib_file = self.cpp_compiler.run(
+                    ext_module=output.ext_module,
+                    working_fd=output.build_fd,
+                    include_fds=output.include_fds,
+                    string_literal_obfuscator_activated=output.string_literal_obfuscator_activated,
+                    source_code_injector_activated=output.source_code_injector_activated,
+                    string_literal_obfuscator_mode=self.string_literal_obfuscator.config.mode,
+                    precompiled_header_codes=self.get_precompiled_header_codes(output),
+                    timeout=output.cpp_compiler_timeout,
                 )
 
-        return CodeFileProcessorOutput(
-            py_file=py_file,
-            compiled_lib_file=compiled_lib_file,
-            execution_context_collection=execution_context_collection,
+        with execution_context_collection.guard('cpp_stripper') as should_run:
+            if should_run:
+                assert output.compiled_lib_file
+                output.compiled_lib_size_report = self.cpp_compiler.strip(
+                    output.compiled_lib_file
+                )
+
+        if self.artifact_cache and self.should_use_lib_level_cache(output.unity_build_index):
+            with execution_context_collection.guard('artifact_cache_put_lib') as should_run:
+                if should_run:
+                    assert output.lib_level_cache_key and output.compiled_lib_file
+                    self.artifact_cache.put(
+                        level=ArtifactCacheLevel.LIB,
+                        key=output.lib_level_cache_key,
+                        files=[output.compiled_lib_file],
+                        metadata={
+                            'compiled_lib_file_name': output.compiled_lib_file.name,
+                            'compiled_lib_size_report':
+                                cattrs.unstructure(output.compiled_lib_size_report),
+                        },
+                    )
+
+        return output.to_output()
+
+    def run(
+        self,
+        py_file: Path,
+        build_fd: Path,
+        logging_fd: Path,
+        py_root_fd: Optional[Path] = None,
+        cpp_compiler_timeout: Optional[float] = None,
+        unity_build_index: Optional[int] = None,
+        dependency_hash: Optional[str] = None,
+    ):
+        return self.run_compile(
+            self.run_generate(
+                py_file=py_file,
+                build_fd=build_fd,
+                logging_fd=logging_fd,
+                py_root_fd=py_root_fd,
+                cpp_compiler_timeout=cpp_compiler_timeout,
+                unity_build_index=unity_build_index,
+                dependency_hash=dependency_hash,
+            )
         )
@@ -18,6 +18,7 @@ import fire
 import fire.core
 
 from .component.source_code_injector import SourceCodeInjector
+from .component.cpp_compiler import CppCompilerConfig, CppCompilerBuildProfile
 from .code_file_processor import CodeFileProcessorConfig, CodeFileProcessor
 from .package_folder_processor import PackageFolderProcessorConfig, PackageFolderProcessor
 from .wheel_file_processor import WheelFileProcessorConfig, WheelFileProcessor
@@ -47,6 +48,25 @@ def assign_fernet_key(config: CodeFileProcessorConfig, fernet_key: Optional[str]
     config.source_code_injector_config.fernet_key = fernet_key
 
 
+def assign_build_profile(config: CppCompilerConfig, build_profile: Optional[str]):
+    if not build_profile:
+        return
+
+    try:
+        config.build_profile = CppCompilerBuildProfile(build_profile)
+    except ValueError:
+        choices = ', '.join(profile.value for profile in CppCompilerBuildProfile)
+        print(f'Invalid build_profile={build_profile}, should be one of {choices}', file=sys.stderr)
+        sys.exit(1)
+
+
+def enable_reproducible(config: WheelFileProcessorConfig):
+    config.wheel_writer_config.enable_reproducible = True
+    code_file_processor_config = config.package_folder_processor_config.code_file_processor_config
+    code_file_processor_config.cpp_compiler_config.enable_reproducible = True
+    code_file_processor_config.source_code_injector_config.enable_deterministic_encryption = True
+
+
 def write_json(path: Optional[str], struct: Mapping[str, Any]):
     try:
         text = json.dumps(struct, ensure_ascii=True, indent=2)
@@ -133,6 +153,7 @@ class CommandLineInterface:
         output_folder: Optional[str] = None,
         working_folder: Optional[str] = None,
         verbose: bool = False,
+        build_profile: Optional[str] = None,
     ):
         '''
         Obfuscate a single code file.
@@ -148,8 +169,12 @@ class CommandLineInterface:
             An optional working folder. If not provided, the program will create a temporary folder.
         :param verbose:
             An optional flag. If set, the program will print the logging message.
+        :param build_profile:
+            An optional build profile (`default`, `fast-build`, `release` or `release-lto`)
+            overriding the one in the JSON config.
         '''
         config = read_config(config_file, CodeFileProcessorConfig)
+        assign_build_profile(config.cpp_compiler_config, build_profile)
         code_file_processor = CodeFileProcessor(config)
 
         try:
@@ -214,6 +239,8 @@ class CommandLineInterface:
         output_folder: Optional[str] = None,
         working_folder: Optional[str] = None,
         verbose: bool = False,
+        build_profile: Optional[str] = None,
+        incremental: bool = False,
     ):
         '''
         Obfuscate a package folder.
@@ -229,8 +256,20 @@ class CommandLineInterface:
             An optional working folder. If not provided, the program will create a temporary folder.
         :param verbose:
             An optional flag. If set, the program will print the logging message.
+        :param build_profile:
+            An optional build profile (`default`, `fast-build`, `release` or `release-lto`)
+            overriding the one in the JSON config.
+        :param incremental:
+            An optional flag. If set, the program will keep `working_folder` and only process
+            the code files changed since the previous run with the same `working_folder`.
         '''
         config = read_config(config_file, PackageFolderProcessorConfig)
+        assign_build_profile(
+            config.code_file_processor_config.cpp_compiler_config,
+            build_profile,
+        )
+        if incremental:
+            config.enable_incremental = True
         package_folder_processor = PackageFolderProcessor(config)
 
         try:
@@ -295,6 +334,9 @@ class CommandLineInterface:
         output_platform_tag: Optional[str] = None,
         working_folder: Optional[str] = None,
         verbose: bool = False,
+        build_profile: Optional[str] = None,
+        reproducible: bool = False,
+        incremental: bool = False,
     ):
         '''
         Obfuscate a wheel file.
@@ -319,8 +361,25 @@ class CommandLineInterface:
             An optional working folder. If not provided, the program will create a temporary folder.
         :param verbose:
             An optional flag. If set, the program will print the logging message.
+        :param build_profile:
+            An optional build profile (`default`, `fast-build`, `release` or `release-lto`)
+            overriding the one in the JSON config.
+        :param reproducible:
+            An optional flag. If set, the output wheel only depends on the input wheel, the config
+            and environment variable `SOURCE_DATE_EPOCH`, not on the build time and folder.
+        :param incremental:
+            An optional flag. If set, the program will keep `working_folder` and only process
+            the code files changed since the previous run with the same `working_folder`.
         '''
         config = read_config(config_file, WheelFileProcessorConfig)
+        assign_build_profile(
+            config.package_folder_processor_config.code_file_processor_config.cpp_compiler_config,
+            build_profile,
+        )
+        if reproducible:
+            enable_reproducible(config)
+        if incremental:
+            config.package_folder_processor_config.enable_incremental = True
         wheel_file_processor = WheelFileProcessor(config)
 
         try:
@@ -360,9 +419,11 @@ class CommandLineInterface:
                 output_fd = wheel_file.parent
 
             assert output.output_wheel_file
-            output_file = output_fd / output.output_wheel_file.name
-            print(f'Saving to {output_file}')
-            shutil.copyfile(output.output_wheel_file, output_file)
+            # One wheel per target if `cpp_compiler_targets` is set.
+            for output_wheel_file in (output.output_wheel_files or [output.output_wheel_file]):
+                output_file = output_fd / output_wheel_file.name
+                print(f'Saving to {output_file}')
+                shutil.copyfile(output_wheel_file, output_file)
 
         else:
             print('Failed!', file=sys.stderr)
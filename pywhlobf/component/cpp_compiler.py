@@ -1,18 +1,83 @@
-from typing import Sequence
+from typing import Sequence, Mapping, Any, Optional, List
 from enum import unique, Enum
 from pathlib import Path
 import os
+import sys
 import subprocess
 from multiprocessing import Process, ProcessError
 import re
 import sysconfig
 import tempfile
 import shutil
+import shlex
+import time
+import hashlib
+import json
 
 import attrs
 import iolite as io
 from setuptools import setup, Extension
 
+from ..artifact_cache import lock_file
+from .string_literal_obfuscator import StringLiteralObfuscatorMode
+
+
+@unique
+class CppCompilerKind(Enum):
+    MSVC = 'msvc'
+    CLANG = 'clang'
+    GCC = 'gcc'
+
+
+@unique
+class CppCompilerBackend(Enum):
+    # Run the compiler and the linker as subprocesses. Fall back to SETUPTOOLS for MSVC.
+    DIRECT = 'direct'
+    # Run `setup.py build_ext -i` in a child process.
+    SETUPTOOLS = 'setuptools'
+
+
+@unique
+class CppCompilerBuildProfile(Enum):
+    # Keep the flags of the Python build.
+    DEFAULT = 'default'
+    # Minimal optimization for the development loop.
+    FAST_BUILD = 'fast-build'
+    # Full optimization with hidden symbols.
+    RELEASE = 'release'
+    # RELEASE with link-time optimization.
+    RELEASE_LTO = 'release-lto'
+
+
+@unique
+class CppCompilerPgoStage(Enum):
+    NONE = 'none'
+    # Build instrumented libraries writing profiles to `pgo_profile_folder`.
+    GENERATE = 'generate'
+    # Build optimized libraries with the profiles in `pgo_profile_folder`.
+    USE = 'use'
+
+
+@unique
+class CppCompilerStripMode(Enum):
+    NONE = 'none'
+    # Remove the debugging symbols.
+    DEBUG = 'debug'
+    # Remove all the symbols not needed by the dynamic linker.
+    UNNEEDED = 'unneeded'
+
+
+@attrs.define
+class CppCompilerTargetConfig:
+    # Resolve the target from a local interpreter, e.g. `/usr/bin/python3.10`.
+    python_executable: Optional[str] = None
+    # Otherwise, the compiler settings of the current interpreter are used,
+    # with the headers and the tags of the target.
+    python_include_dirs: Sequence[str] = ()
+    ext_suffix: Optional[str] = None
+    python_tag: Optional[str] = None
+    abi_tag: Optional[str] = None
+
 
 @attrs.define
 class CppCompilerConfig:
@@ -20,13 +85,206 @@ class CppCompilerConfig:
     # https://setuptools.pypa.io/en/latest/userguide/ext_modules.html#setuptools.Extension
     setup_build_ext_timeout: int = 120
     delete_temp_fd: bool = True
+    backend: CppCompilerBackend = CppCompilerBackend.DIRECT
+    # Build one precompiled header per compile flags and header set, shared by all the modules
+    # compiled in the same working folder. Only works with the DIRECT backend and GCC/Clang.
+    enable_precompiled_header: bool = True
+    # The flags are appended after the flags of the Python build, and are part of the cache keys.
+    build_profile: CppCompilerBuildProfile = CppCompilerBuildProfile.DEFAULT
+    # The number of parallel LTO jobs in RELEASE_LTO. Default to the number of CPUs.
+    lto_jobs: Optional[int] = None
+    # Profile-guided optimization, usually driven by `PackageFolderProcessor`.
+    # Only works with the DIRECT backend and GCC/Clang, since the profiles are matched by
+    # the object file paths.
+    pgo_stage: CppCompilerPgoStage = CppCompilerPgoStage.NONE
+    pgo_profile_folder: Optional[str] = None
+    # Place functions and data in separate sections and drop the unreferenced ones at link time.
+    enable_section_gc: bool = False
+    # Strip the compiled library after linking, using `$STRIP` or `strip`.
+    strip_mode: CppCompilerStripMode = CppCompilerStripMode.NONE
+    # Compile against the stable ABI of the given minimum version (e.g. `cp39`), producing
+    # `.abi3.so` libraries loadable by all the later CPython versions.
+    # NOTE: Cython 3.3 requires `cp39` or later.
+    py_limited_api: Optional[str] = None
+    # Compile for another CPython interpreter. Only works with the DIRECT backend and GCC/Clang.
+    target: Optional[CppCompilerTargetConfig] = None
+    # Map the working folder to `.` in the file paths embedded in the compiled libraries
+    # (debugging information and `__FILE__`), so that the output doesn't depend on where
+    # it is built.
+    enable_reproducible: bool = False
 
 
-@unique
-class CppCompilerKind(Enum):
-    MSVC = 'msvc'
-    CLANG = 'clang'
-    GCC = 'gcc'
+@attrs.define
+class CppCompilerToolchain:
+    '''
+    The command lines used by the DIRECT backend, resolved once from `sysconfig`.
+    '''
+    compiler_so_cxx: Sequence[str]
+    linker_so_cxx: Sequence[str]
+    python_include_dirs: Sequence[str]
+    ext_suffix: str
+
+    @classmethod
+    def from_config_vars(
+        cls,
+        config_vars: Mapping[str, Any],
+        python_include_dirs: Sequence[str],
+        environ: Optional[Mapping[str, str]] = None,
+    ):
+        # Follows `customize_compiler` of distutils.
+        if environ is None:
+            environ = os.environ
+
+        cc: str = config_vars['CC']
+        cxx: str = config_vars['CXX']
+        cflags: str = config_vars['CFLAGS']
+        ccshared: str = config_vars['CCSHARED']
+        ldshared: str = config_vars['LDSHARED']
+
+        if 'CC' in environ:
+            if 'LDSHARED' not in environ and ldshared.startswith(cc):
+                ldshared = environ['CC'] + ldshared[len(cc):]
+            cc = environ['CC']
+        if 'CXX' in environ:
+            cxx = environ['CXX']
+        if 'LDSHARED' in environ:
+            ldshared = environ['LDSHARED']
+        if 'LDFLAGS' in environ:
+            ldshared = ldshared + ' ' + environ['LDFLAGS']
+        if 'CFLAGS' in environ:
+            cflags = cflags + ' ' + environ['CFLAGS']
+            ldshared = ldshared + ' ' + environ['CFLAGS']
+        if 'CPPFLAGS' in environ:
+            cflags = cflags + ' ' + environ['CPPFLAGS']
+            ldshared = ldshared + ' ' + environ['CPPFLAGS']
+
+        compiler_so_cxx = shlex.split(cxx) + shlex.split(cflags) + shlex.split(ccshared)
+
+        # Link with the C++ compiler driver, as distutils does for `language='c++'`.
+        linker_so_cxx = shlex.split(ldshared)
+        cxx_executable = shlex.split(cxx)[0]
+        if os.path.basename(linker_so_cxx[0]) == 'env':
+            idx = 1
+            while '=' in linker_so_cxx[idx]:
+                idx += 1
+            linker_so_cxx[idx] = cxx_executable
+        else:
+            linker_so_cxx[0] = cxx_executable
+
+        return cls(
+            compiler_so_cxx=compiler_so_cxx,
+            linker_so_cxx=linker_so_cxx,
+            python_include_dirs=python_include_dirs,
+            ext_suffix=config_vars['EXT_SUFFIX'],
+        )
+
+    @classmethod
+    def create_from_sysconfig(cls):
+        paths = sysconfig.get_paths()
+        python_include_dirs = [paths['include']]
+        if paths['platinclude'] != paths['include']:
+            python_include_dirs.append(paths['platinclude'])
+
+        return cls.from_config_vars(
+            config_vars=sysconfig.get_config_vars(),
+            python_include_dirs=python_include_dirs,
+        )
+
+
+@attrs.define
+class CompiledLibSizeReport:
+    # In bytes.
+    before_strip: int
+    after_strip: int
+
+
+# Executed by the target interpreter.
+QUERY_TARGET_CODE = '''
+import json
+import sys
+import sysconfig
+
+paths = sysconfig.get_paths()
+print(json.dumps({
+    'config_vars': {
+        key: sysconfig.get_config_var(key)
+        for key in ('CC', 'CXX', 'CFLAGS', 'CCSHARED', 'LDSHARED', 'EXT_SUFFIX', 'SOABI')
+    },
+    'include': paths['include'],
+    'platinclude': paths['platinclude'],
+    'version': list(sys.version_info[:2]),
+}))
+'''
+
+
+def get_abi_tag_from_soabi(soabi: Optional[str], version: Sequence[int]):
+    # `cpython-311-x86_64-linux-gnu` -> `cp311`, `cpython-313t-...` -> `cp313t`.
+    if soabi and soabi.startswith('cpython-'):
+        return 'cp' + soabi.split('-')[1]
+    return 'cp' + ''.join(map(str, version))
+
+
+@attrs.define
+class CppCompilerTarget:
+    '''
+    The resolved target interpreter.
+    '''
+    toolchain: CppCompilerToolchain
+    python_tag: str
+    abi_tag: str
+
+    @classmethod
+    def create_from_python_executable(cls, python_executable: str):
+        process = subprocess.run(
+            [python_executable, '-c', QUERY_TARGET_CODE],
+            capture_output=True,
+            check=True,
+            text=True,
+        )
+        struct = json.loads(process.stdout)
+
+        python_include_dirs = [struct['include']]
+        if struct['platinclude'] != struct['include']:
+            python_include_dirs.append(struct['platinclude'])
+
+        config_vars = struct['config_vars']
+        version = struct['version']
+        return cls(
+            toolchain=CppCompilerToolchain.from_config_vars(
+                config_vars=config_vars,
+                python_include_dirs=python_include_dirs,
+            ),
+            python_tag='cp' + ''.join(map(str, version)),
+            abi_tag=get_abi_tag_from_soabi(config_vars['SOABI'], version),
+        )
+
+    @classmethod
+    def create_from_config(
+        cls,
+        config: CppCompilerTargetConfig,
+        toolchain: CppCompilerToolchain,
+    ):
+        if config.python_executable:
+            return cls.create_from_python_executable(config.python_executable)
+
+        assert config.python_include_dirs and config.ext_suffix \
+            and config.python_tag and config.abi_tag
+        return cls(
+            toolchain=attrs.evolve(
+                toolchain,
+                python_include_dirs=list(config.python_include_dirs),
+                ext_suffix=config.ext_suffix,
+            ),
+            python_tag=config.python_tag,
+            abi_tag=config.abi_tag,
+        )
+
+
+def get_py_limited_api_hex(py_limited_api: str):
+    match = re.fullmatch(r'cp3(\d+)', py_limited_api)
+    if not match:
+        raise ValueError(f'Invalid py_limited_api={py_limited_api}, should be like cp39.')
+    return f'0x03{int(match.group(1)):02X}0000'
 
 
 def get_cpp_file_from_ext_module(ext_module: Extension):
@@ -54,13 +312,30 @@ def setup_build_ext(
     )
 
 
+def run_command(command: Sequence[str], deadline: float, verbose: bool = False):
+    if verbose:
+        print(shlex.join(command), flush=True)
+    try:
+        process = subprocess.run(command, timeout=max(0.0, deadline - time.monotonic()))
+    except subprocess.TimeoutExpired:
+        raise ProcessError('Compilation timeout.')
+    if process.returncode != 0:
+        raise ProcessError('Compilation failed.')
+
+
 class CppCompiler:
 
-    def __init__(self, config: CppCompilerConfig):
+    def __init__(self, config: CppCompilerConfig, verbose: bool = False):
         self.config = config
+        # Print the compile and link commands.
+        self.verbose = verbose
 
         # Detect C++ compiler.
         cxx = sysconfig.get_config_var('CXX')
+        self.cxx = cxx
+        self.cxx_version = None
+        self.toolchain = None
+
         if not cxx:
             assert os.name == 'nt'
             self.cpp_compiler_kind = CppCompilerKind.MSVC
@@ -88,6 +363,10 @@ class CppCompiler:
             gunc_match = re.search(r'__GNUC__ (\d+)', stdout)
             gunc_minor_match = re.search(r'__GNUC_MINOR__ (\d+)', stdout)
 
+            version_match = re.search(r'__VERSION__ "(.+)"', stdout)
+            if version_match:
+                self.cxx_version = version_match.group(1)
+
             if libcpp_version_match:
                 # VRRR format.
                 self.cpp_compiler_kind = CppCompilerKind.CLANG
@@ -103,18 +382,272 @@ class CppCompiler:
             else:
                 raise NotImplementedError()
 
-    def run(
+            self.toolchain = CppCompilerToolchain.create_from_sysconfig()
+
+        self.target = None
+        if config.target:
+            if not self.toolchain or config.backend != CppCompilerBackend.DIRECT:
+                raise NotImplementedError('Requires the DIRECT backend with GCC or Clang.')
+            self.target = CppCompilerTarget.create_from_config(config.target, self.toolchain)
+            self.toolchain = self.target.toolchain
+
+    def get_ext_suffix(self, toolchain: CppCompilerToolchain):
+        if self.config.py_limited_api and os.name == 'posix':
+            # See `importlib.machinery.EXTENSION_SUFFIXES`.
+            return '.abi3.so'
+        return toolchain.ext_suffix
+
+    def get_toolchain_signature(self):
+        '''
+        Identify the compiler and the target Python ABI, used in cache keys.
+        '''
+        components = [self.cpp_compiler_kind.value, self.cxx, self.cxx_version]
+        if self.target:
+            components.extend([
+                self.target.python_tag,
+                self.target.abi_tag,
+                self.target.toolchain.ext_suffix,
+                *self.target.toolchain.python_include_dirs,
+            ])
+        else:
+            components.extend([
+                sys.implementation.cache_tag,
+                sysconfig.get_config_var('EXT_SUFFIX'),
+            ])
+        components.append(sysconfig.get_platform())
+        return '\n'.join(map(str, components))
+
+    def get_build_profile_args(self):
+        '''
+        Return the extra compile and link arguments of the build profile.
+        '''
+        build_profile = self.config.build_profile
+        compile_args: List[str] = []
+        link_args: List[str] = []
+
+        if build_profile == CppCompilerBuildProfile.DEFAULT:
+            pass
+
+        elif self.cpp_compiler_kind == CppCompilerKind.MSVC:
+            if build_profile == CppCompilerBuildProfile.FAST_BUILD:
+                compile_args.append('/Od')
+            elif build_profile == CppCompilerBuildProfile.RELEASE:
+                compile_args.append('/O2')
+            elif build_profile == CppCompilerBuildProfile.RELEASE_LTO:
+                compile_args.extend(['/O2', '/GL'])
+                link_args.append('/LTCG')
+            else:
+                raise NotImplementedError()
+
+        elif self.cpp_compiler_kind in (CppCompilerKind.CLANG, CppCompilerKind.GCC):
+            if build_profile == CppCompilerBuildProfile.FAST_BUILD:
+                compile_args.append('-O0')
+
+            elif build_profile in (
+                CppCompilerBuildProfile.RELEASE,
+                CppCompilerBuildProfile.RELEASE_LTO,
+            ):
+                # The module init function is exported explicitly by `PyMODINIT_FUNC`.
+                compile_args.extend(['-O3', '-fvisibility=hidden'])
+                # NOTE: Clang with libstdc++ is detected as GCC with `__GNUC__ == 4`.
+                if self.cpp_compiler_kind == CppCompilerKind.GCC \
+                        and self.gcc_version_major and self.gcc_version_major >= 5:
+                    compile_args.append('-fno-semantic-interposition')
+
+                if build_profile == CppCompilerBuildProfile.RELEASE_LTO:
+                    lto_jobs = self.config.lto_jobs or os.cpu_count() or 1
+                    if self.cpp_compiler_kind == CppCompilerKind.CLANG:
+                        compile_args.append('-flto=thin')
+                        link_args.extend(['-flto=thin', f'-flto-jobs={lto_jobs}'])
+                    elif self.gcc_version_major and self.gcc_version_major >= 5:
+                        compile_args.append('-flto')
+                        link_args.extend(['-O3', f'-flto={lto_jobs}'])
+                    else:
+                        compile_args.append('-flto')
+                        link_args.extend(['-O3', '-flto'])
+
+            else:
+                raise NotImplementedError()
+
+        else:
+            raise NotImplementedError()
+
+        return compile_args, link_args
+
+    def get_pgo_profile_fd(self):
+        assert self.config.pgo_profile_folder
+        return Path(self.config.pgo_profile_folder).expanduser().absolute()
+
+    def get_pgo_args(self):
+        '''
+        Return the extra compile and link arguments of the PGO stage.
+        '''
+        pgo_stage = self.config.pgo_stage
+        compile_args: List[str] = []
+        link_args: List[str] = []
+
+        if pgo_stage == CppCompilerPgoStage.NONE:
+            return compile_args, link_args
+
+        if self.cpp_compiler_kind not in (CppCompilerKind.CLANG, CppCompilerKind.GCC):
+            raise NotImplementedError()
+
+        pgo_profile_fd = self.get_pgo_profile_fd()
+
+        if pgo_stage == CppCompilerPgoStage.GENERATE:
+            compile_args.append(f'-fprofile-generate={pgo_profile_fd}')
+            link_args.append(f'-fprofile-generate={pgo_profile_fd}')
+            if self.cpp_compiler_kind == CppCompilerKind.GCC \
+                    and self.gcc_version_major and self.gcc_version_major >= 7:
+                # The workload could be multi-threaded.
+                compile_args.append('-fprofile-update=atomic')
+
+        elif pgo_stage == CppCompilerPgoStage.USE:
+            # Clang looks for `default.profdata` in the folder.
+            compile_args.append(f'-fprofile-use={pgo_profile_fd}')
+            link_args.append(f'-fprofile-use={pgo_profile_fd}')
+            if self.cpp_compiler_kind == CppCompilerKind.CLANG:
+                compile_args.append('-Wno-profile-instr-unprofiled')
+            else:
+                # Tolerate the modules not covered by the workload.
+                compile_args.extend(['-fprofile-correction', '-Wno-missing-profile'])
+
+        else:
+            raise NotImplementedError()
+
+        return compile_args, link_args
+
+    def merge_pgo_profiles(self, timeout: Optional[float] = None):
+        '''
+        Merge the raw profiles generated by Clang instrumented libraries to `default.profdata`.
+        No-op for GCC.
+        '''
+        pgo_profile_fd = self.get_pgo_profile_fd()
+        profraw_files = sorted(pgo_profile_fd.glob('*.profraw'))
+        if not profraw_files:
+            return
+
+        if timeout is None:
+            timeout = self.config.setup_build_ext_timeout
+
+        llvm_profdata = os.environ.get('LLVM_PROFDATA', 'llvm-profdata')
+        run_command(
+            [
+                *shlex.split(llvm_profdata),
+                'merge',
+                f'-output={pgo_profile_fd / "default.profdata"}',
+                *map(str, profraw_files),
+            ],
+            time.monotonic() + timeout,
+            verbose=self.verbose,
+        )
+
+    def get_section_gc_args(self):
+        '''
+        Return the extra compile and link arguments of the section garbage collection.
+        '''
+        compile_args: List[str] = []
+        link_args: List[str] = []
+
+        if not self.config.enable_section_gc:
+            return compile_args, link_args
+
+        if self.cpp_compiler_kind == CppCompilerKind.MSVC:
+            compile_args.extend(['/Gy', '/Gw'])
+            link_args.extend(['/OPT:REF', '/OPT:ICF'])
+
+        elif self.cpp_compiler_kind in (CppCompilerKind.CLANG, CppCompilerKind.GCC):
+            compile_args.extend(['-ffunction-sections', '-fdata-sections'])
+            if sys.platform == 'darwin':
+                link_args.append('-Wl,-dead_strip')
+            else:
+                link_args.append('-Wl,--gc-sections')
+
+        else:
+            raise NotImplementedError()
+
+        return compile_args, link_args
+
+    def get_reproducible_args(self, ext_module: Extension, working_fd: Path):
+        '''
+        Return the extra compile and link arguments of the reproducible build.
+        '''
+        compile_args: List[str] = []
+        link_args: List[str] = []
+
+        if not self.config.enable_reproducible:
+            return compile_args, link_args
+
+        if self.cpp_compiler_kind == CppCompilerKind.MSVC:
+            compile_args.append('/Brepro')
+            link_args.append('/Brepro')
+
+        elif self.cpp_compiler_kind in (CppCompilerKind.CLANG, CppCompilerKind.GCC):
+            # The paths passed to the compiler might not be resolved.
+            working_fd_paths = [str(working_fd.absolute())]
+            resolved_working_fd_path = str(working_fd.resolve())
+            if resolved_working_fd_path != working_fd_paths[0]:
+                working_fd_paths.append(resolved_working_fd_path)
+
+            for working_fd_path in working_fd_paths:
+                compile_args.extend([
+                    f'-ffile-prefix-map={working_fd_path}=.',
+                    # For the compilers without `-ffile-prefix-map`.
+                    f'-fdebug-prefix-map={working_fd_path}=.',
+                ])
+
+            if self.cpp_compiler_kind == CppCompilerKind.GCC:
+                # Seed the names GCC would otherwise randomize, e.g. in the LTO sections.
+                compile_args.append(f'-frandom-seed={ext_module.name}')
+
+        else:
+            raise NotImplementedError()
+
+        return compile_args, link_args
+
+    def strip(self, compiled_lib_file: Path, timeout: Optional[float] = None):
+        '''
+        Strip the compiled library in place and report the sizes.
+        '''
+        before_strip = compiled_lib_file.stat().st_size
+
+        strip_mode = self.config.strip_mode
+        # MSVC keeps the debugging information in PDB.
+        if strip_mode != CppCompilerStripMode.NONE \
+                and self.cpp_compiler_kind != CppCompilerKind.MSVC:
+            if timeout is None:
+                timeout = self.config.setup_build_ext_timeout
+
+            command = shlex.split(os.environ.get('STRIP', 'strip'))
+            if strip_mode == CppCompilerStripMode.DEBUG:
+                command.append('-S' if sys.platform == 'darwin' else '--strip-debug')
+            elif strip_mode == CppCompilerStripMode.UNNEEDED:
+                command.append('-x' if sys.platform == 'darwin' else '--strip-unneeded')
+            else:
+                raise NotImplementedError()
+            command.append(str(compiled_lib_file))
+
+            run_command(command, time.monotonic() + timeout, verbose=self.verbose)
+
+        return CompiledLibSizeReport(
+            before_strip=before_strip,
+            after_strip=compiled_lib_file.stat().st_size,
+        )
+
+    def configure_ext_module(
         self,
         ext_module: Extension,
-        working_fd: Path,
         include_fds: Sequence[Path],
         string_literal_obfuscator_activated: bool,
         source_code_injector_activated: bool,
+        string_literal_obfuscator_mode: StringLiteralObfuscatorMode = (
+            StringLiteralObfuscatorMode.TEMPLATE
+        ),
+        working_fd: Optional[Path] = None,
     ):
         '''
-        `working_fd` could be the python package root folder.
+        `working_fd` is mapped to `.` in the reproducible build.
         '''
-
         # Configure compiler.
         if source_code_injector_activated:
             if self.cpp_compiler_kind == CppCompilerKind.CLANG:
@@ -143,7 +676,9 @@ class CppCompiler:
             else:
                 raise NotImplementedError()
 
-        elif string_literal_obfuscator_activated:
+        elif string_literal_obfuscator_activated \
+                and string_literal_obfuscator_mode == StringLiteralObfuscatorMode.TEMPLATE:
+            # The XOR and the ARENA modes are fine with C++11.
             if self.cpp_compiler_kind in (CppCompilerKind.CLANG, CppCompilerKind.GCC):
                 ext_module.extra_compile_args.append('-std=c++14')
             elif self.cpp_compiler_kind == CppCompilerKind.MSVC:
@@ -159,10 +694,246 @@ class CppCompiler:
             else:
                 raise NotImplementedError()
 
+        # Add build profile.
+        compile_args, link_args = self.get_build_profile_args()
+        ext_module.extra_compile_args.extend(compile_args)
+        ext_module.extra_link_args.extend(link_args)
+
+        # Add PGO.
+        compile_args, link_args = self.get_pgo_args()
+        ext_module.extra_compile_args.extend(compile_args)
+        ext_module.extra_link_args.extend(link_args)
+
+        # Add section GC.
+        compile_args, link_args = self.get_section_gc_args()
+        ext_module.extra_compile_args.extend(compile_args)
+        ext_module.extra_link_args.extend(link_args)
+
+        # Add reproducible build.
+        if working_fd is not None:
+            compile_args, link_args = self.get_reproducible_args(ext_module, working_fd)
+            ext_module.extra_compile_args.extend(compile_args)
+            ext_module.extra_link_args.extend(link_args)
+
+        # Add limited API.
+        if self.config.py_limited_api:
+            ext_module.define_macros.append(
+                ('Py_LIMITED_API', get_py_limited_api_hex(self.config.py_limited_api))
+            )
+            # For the SETUPTOOLS backend to name the library.
+            ext_module.py_limited_api = True
+
         # Add include_dirs.
         for include_fd in include_fds:
             ext_module.include_dirs.append(str(include_fd))
 
+    def build_compile_flags(
+        self,
+        toolchain: CppCompilerToolchain,
+        ext_module: Extension,
+    ):
+        command: List[str] = list(toolchain.compiler_so_cxx)
+
+        for name, value in ext_module.define_macros:
+            if value is None:
+                command.append(f'-D{name}')
+            else:
+                command.append(f'-D{name}={value}')
+        for name in ext_module.undef_macros:
+            command.append(f'-U{name}')
+
+        for include_dir in (*ext_module.include_dirs, *toolchain.python_include_dirs):
+            command.append(f'-I{include_dir}')
+
+        command.extend(ext_module.extra_compile_args)
+        return command
+
+    def build_compile_command(
+        self,
+        toolchain: CppCompilerToolchain,
+        ext_module: Extension,
+        cpp_file: Path,
+        object_file: Path,
+        precompiled_header_file: Optional[Path] = None,
+        init_symbol: Optional[str] = None,
+    ):
+        command = self.build_compile_flags(toolchain, ext_module)
+        if init_symbol:
+            # Rename the module init function. Not part of the precompiled header flags
+            # since the headers don't reference the macro.
+            # For `pkg/__init__.py`, the name is `pkg.__init__` but the function is `PyInit_pkg`.
+            leaf_name = ext_module.name.split('.')[-1]
+            if leaf_name == '__init__':
+                leaf_name = ext_module.name.split('.')[-2]
+            command.append(f'-DPyInit_{leaf_name}={init_symbol}')
+        if precompiled_header_file:
+            # GCC & Clang pick up the `.gch` file next to the header.
+            command.extend(['-include', str(precompiled_header_file), '-Winvalid-pch'])
+        command.extend(['-c', str(cpp_file), '-o', str(object_file)])
+        return command
+
+    def prepare_precompiled_header(
+        self,
+        toolchain: CppCompilerToolchain,
+        ext_module: Extension,
+        precompiled_header_codes: Sequence[str],
+        working_fd: Path,
+        deadline: float,
+    ):
+        '''
+        Build (or reuse) the precompiled header and return the header file,
+        or `None` if failed to build.
+        '''
+        # Follows the order of headers in the generated C++ file.
+        header_code = '\n'.join([
+            *precompiled_header_codes,
+            '#ifndef PY_SSIZE_T_CLEAN',
+            '#define PY_SSIZE_T_CLEAN',
+            '#endif',
+            '#include "Python.h"',
+            '',
+        ])
+        # The per-module seed of the reproducible build is replaced by a fixed one, otherwise every
+        # module builds its own precompiled header.
+        compile_flags = [
+            '-frandom-seed=pywhlobf_pch' if flag.startswith('-frandom-seed=') else flag
+            for flag in self.build_compile_flags(toolchain, ext_module)
+        ]
+
+        # The key doesn't depend on `working_fd`, which holds the precompiled header. Otherwise the
+        # path of the precompiled header breaks the reproducible build.
+        working_fd_path = str(working_fd.absolute())
+        key_flags = [flag.replace(working_fd_path, '.') for flag in compile_flags]
+        key = hashlib.sha256('\n'.join([*key_flags, header_code]).encode()).hexdigest()
+        pch_fd = working_fd / 'pywhlobf_pch' / key[:16]
+        pch_fd.mkdir(exist_ok=True, parents=True)
+
+        header_file = pch_fd / 'pywhlobf_pch.h'
+        gch_file = pch_fd / 'pywhlobf_pch.h.gch'
+        failed_file = pch_fd / 'failed'
+
+        # Built by the first process.
+        with lock_file(pch_fd / '.lock'):
+            if gch_file.is_file():
+                return header_file
+            if failed_file.exists():
+                return None
+
+            header_file.write_text(header_code)
+            temp_gch_file = pch_fd / 'pywhlobf_pch.h.gch.tmp'
+            try:
+                run_command(
+                    [*compile_flags, '-x', 'c++-header',
+                     str(header_file), '-o', str(temp_gch_file)],
+                    deadline,
+                    verbose=self.verbose,
+                )
+            except ProcessError:
+                print('Failed to build the precompiled header, skip.', flush=True)
+                failed_file.touch()
+                return None
+
+            os.replace(temp_gch_file, gch_file)
+            return header_file
+
+    def build_link_command(
+        self,
+        toolchain: CppCompilerToolchain,
+        ext_module: Extension,
+        object_files: Sequence[Path],
+        compiled_lib_file: Path,
+    ):
+        command: List[str] = list(toolchain.linker_so_cxx)
+        command.extend(map(str, object_files))
+        command.extend(ext_module.extra_objects)
+
+        for library_dir in ext_module.library_dirs:
+            command.append(f'-L{library_dir}')
+        for runtime_library_dir in ext_module.runtime_library_dirs:
+            command.append(f'-Wl,-rpath,{runtime_library_dir}')
+        for library in ext_module.libraries:
+            command.append(f'-l{library}')
+
+        command.extend(['-o', str(compiled_lib_file)])
+        command.extend(ext_module.extra_link_args)
+        return command
+
+    def compile_object(
+        self,
+        toolchain: CppCompilerToolchain,
+        ext_module: Extension,
+        working_fd: Path,
+        precompiled_header_codes: Sequence[str],
+        deadline: float,
+        init_symbol: Optional[str] = None,
+    ):
+        cpp_file = get_cpp_file_from_ext_module(ext_module)
+        object_file = cpp_file.with_suffix('.o')
+
+        precompiled_header_file = None
+        if self.config.enable_precompiled_header:
+            precompiled_header_file = self.prepare_precompiled_header(
+                toolchain=toolchain,
+                ext_module=ext_module,
+                precompiled_header_codes=precompiled_header_codes,
+                working_fd=working_fd,
+                deadline=deadline,
+            )
+
+        run_command(
+            self.build_compile_command(
+                toolchain=toolchain,
+                ext_module=ext_module,
+                cpp_file=cpp_file,
+                object_file=object_file,
+                precompiled_header_file=precompiled_header_file,
+                init_symbol=init_symbol,
+            ),
+            deadline,
+            verbose=self.verbose,
+        )
+
+        return object_file
+
+    def run_direct(
+        self,
+        toolchain: CppCompilerToolchain,
+        ext_module: Extension,
+        working_fd: Path,
+        precompiled_header_codes: Sequence[str],
+        timeout: float,
+    ):
+        cpp_file = get_cpp_file_from_ext_module(ext_module)
+        compiled_lib_name = ext_module.name.split('.')[-1] + self.get_ext_suffix(toolchain)
+        compiled_lib_file = cpp_file.parent / compiled_lib_name
+
+        deadline = time.monotonic() + timeout
+
+        object_file = self.compile_object(
+            toolchain=toolchain,
+            ext_module=ext_module,
+            working_fd=working_fd,
+            precompiled_header_codes=precompiled_header_codes,
+            deadline=deadline,
+        )
+        run_command(
+            self.build_link_command(
+                toolchain=toolchain,
+                ext_module=ext_module,
+                object_files=[object_file],
+                compiled_lib_file=compiled_lib_file,
+            ),
+            deadline,
+            verbose=self.verbose,
+        )
+
+        if self.config.delete_temp_fd:
+            object_file.unlink()
+
+        assert compiled_lib_file.is_file()
+        return compiled_lib_file
+
+    def run_setuptools(self, ext_module: Extension, working_fd: Path, timeout: float):
         # Build the shared library.
         cpp_file = get_cpp_file_from_ext_module(ext_module)
         temp_fd = io.folder(tempfile.mkdtemp(), exists=True)
@@ -176,7 +947,7 @@ class CppCompiler:
             },
         )
         process.start()
-        process.join(timeout=self.config.setup_build_ext_timeout)
+        process.join(timeout=timeout)
 
         if process.exitcode != 0:
             process.kill()
@@ -201,3 +972,124 @@ class CppCompiler:
         compiled_lib_files = tuple(cpp_file.parent.glob(f'{cpp_file.stem}.*{ext}'))
         assert len(compiled_lib_files) == 1
         return compiled_lib_files[0]
+
+    def run(
+        self,
+        ext_module: Extension,
+        working_fd: Path,
+        include_fds: Sequence[Path],
+        string_literal_obfuscator_activated: bool,
+        source_code_injector_activated: bool,
+        string_literal_obfuscator_mode: StringLiteralObfuscatorMode = (
+            StringLiteralObfuscatorMode.TEMPLATE
+        ),
+        precompiled_header_codes: Sequence[str] = (),
+        timeout: Optional[float] = None,
+    ):
+        '''
+        `working_fd` could be the python package root folder.
+        `precompiled_header_codes` are the headers injected by the components,
+        to be included in the precompiled header.
+        `timeout` overrides `setup_build_ext_timeout` if provided.
+        '''
+        self.configure_ext_module(
+            ext_module=ext_module,
+            include_fds=include_fds,
+            string_literal_obfuscator_activated=string_literal_obfuscator_activated,
+            source_code_injector_activated=source_code_injector_activated,
+            string_literal_obfuscator_mode=string_literal_obfuscator_mode,
+            working_fd=working_fd,
+        )
+
+        if timeout is None:
+            timeout = self.config.setup_build_ext_timeout
+
+        if self.config.backend == CppCompilerBackend.DIRECT and self.toolchain:
+            return self.run_direct(
+                toolchain=self.toolchain,
+                ext_module=ext_module,
+                working_fd=working_fd,
+                precompiled_header_codes=precompiled_header_codes,
+                timeout=timeout,
+            )
+        else:
+            return self.run_setuptools(
+                ext_module=ext_module,
+                working_fd=working_fd,
+                timeout=timeout,
+            )
+
+    def get_direct_toolchain(self):
+        if self.config.backend != CppCompilerBackend.DIRECT or not self.toolchain:
+            raise NotImplementedError('Requires the DIRECT backend with GCC or Clang.')
+        return self.toolchain
+
+    def run_object(
+        self,
+        ext_module: Extension,
+        working_fd: Path,
+        include_fds: Sequence[Path],
+        string_literal_obfuscator_activated: bool,
+        source_code_injector_activated: bool,
+        init_symbol: str,
+        string_literal_obfuscator_mode: StringLiteralObfuscatorMode = (
+            StringLiteralObfuscatorMode.TEMPLATE
+        ),
+        precompiled_header_codes: Sequence[str] = (),
+        timeout: Optional[float] = None,
+    ):
+        '''
+        Compile `ext_module` to an object file without linking, with the module init function
+        renamed to `init_symbol`. Used by the unity build.
+        '''
+        toolchain = self.get_direct_toolchain()
+
+        self.configure_ext_module(
+            ext_module=ext_module,
+            include_fds=include_fds,
+            string_literal_obfuscator_activated=string_literal_obfuscator_activated,
+            source_code_injector_activated=source_code_injector_activated,
+            string_literal_obfuscator_mode=string_literal_obfuscator_mode,
+            working_fd=working_fd,
+        )
+
+        if timeout is None:
+            timeout = self.config.setup_build_ext_timeout
+
+        return self.compile_object(
+            toolchain=toolchain,
+            ext_module=ext_module,
+            working_fd=working_fd,
+            precompiled_header_codes=precompiled_header_codes,
+            deadline=time.monotonic() + timeout,
+            init_symbol=init_symbol,
+        )
+
+    def link(
+        self,
+        ext_module: Extension,
+        object_files: Sequence[Path],
+        compiled_lib_file: Path,
+        timeout: Optional[float] = None,
+    ):
+        '''
+        Link `object_files` into `compiled_lib_file`. The link arguments are taken from
+        `ext_module`.
+        '''
+        toolchain = self.get_direct_toolchain()
+
+        if timeout is None:
+            timeout = self.config.setup_build_ext_timeout
+
+        run_command(
+            self.build_link_command(
+                toolchain=toolchain,
+                ext_module=ext_module,
+                object_files=object_files,
+                compiled_lib_file=compiled_lib_file,
+            ),
+            time.monotonic() + timeout,
+            verbose=self.verbose,
+        )
+        assert compiled_lib_file.is_file()
+        return compiled_lib_file
@@ -1,4 +1,4 @@
-from typing import Mapping, Union
+from typing import Mapping, Union, Any, Dict
 from pathlib import Path
 import shutil
 import re
@@ -8,6 +8,8 @@ from setuptools import Extension
 from Cython.Build.Dependencies import cythonize
 from Cython.Compiler import Options
 
+from ..file_link import FileLinkStrategy, link_file
+
 
 @attrs.define
 class CppGeneratorConfig:
@@ -18,6 +20,48 @@ class CppGeneratorConfig:
     compiler_directives: Mapping[str, Union[bool, str]] = attrs.field(factory=dict)
     cythonize_options: Mapping[str, Union[bool, int, str]] = attrs.field(factory=dict)
     compiler_options: Mapping[str, Union[bool, int, str]] = attrs.field(factory=dict)
+    # How `py_file` is brought into the working folder.
+    file_link_strategy: FileLinkStrategy = FileLinkStrategy.COPY
+
+
+# The `Extension` fields that might be set by `cythonize`.
+EXT_MODULE_FIELDS = (
+    'include_dirs',
+    'define_macros',
+    'undef_macros',
+    'library_dirs',
+    'libraries',
+    'runtime_library_dirs',
+    'extra_objects',
+    'extra_compile_args',
+    'extra_link_args',
+    'export_symbols',
+    'depends',
+    'language',
+)
+
+
+def dump_ext_module(ext_module: Extension):
+    assert len(ext_module.sources) == 1
+    struct: Dict[str, Any] = {
+        'name': ext_module.name,
+        'source_name': Path(ext_module.sources[0]).name,
+    }
+    for field in EXT_MODULE_FIELDS:
+        struct[field] = getattr(ext_module, field, None)
+    return struct
+
+
+def load_ext_module(struct: Mapping[str, Any], working_fd: Path):
+    kwargs = {field: struct[field] for field in EXT_MODULE_FIELDS if struct[field] is not None}
+    if 'define_macros' in kwargs:
+        # JSON turns tuples into lists.
+        kwargs['define_macros'] = [tuple(macro) for macro in kwargs['define_macros']]
+    return Extension(
+        name=struct['name'],
+        sources=[str(working_fd / struct['source_name'])],
+        **kwargs,
+    )
 
 
 class CppGenerator:
@@ -74,7 +118,7 @@ __Pyx_PyMODINIT_FUNC PyInit___init__(void) {{ return PyInit_{py_file.parent.name
 
         # Copy python file to the working folder.
         working_py_file = working_fd / py_file.name
-        shutil.copyfile(py_file, working_py_file)
+        link_file(py_file, working_py_file, self.config.file_link_strategy)
         py_file = working_py_file
 
         cpp_file = py_file.with_suffix('.cpp')
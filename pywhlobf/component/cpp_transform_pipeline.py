@@ -0,0 +1,83 @@
+from typing import Callable, Iterable, Iterator, List, Optional
+from pathlib import Path
+import os
+
+import attrs
+
+from ..execution_context import ExecutionContextCollection
+
+# A transform consumes and yields single lines, with the line endings.
+CppLinesTransformFunc = Callable[[Iterable[str]], Iterable[str]]
+
+
+@attrs.define
+class CppTransform:
+    name: str
+    func: CppLinesTransformFunc
+
+
+def split_lines(code: str):
+    return code.splitlines(keepends=True)
+
+
+class CppTransformPipeline:
+    '''
+    Stream the lines of the C++ file through the registered transforms in order, and write
+    the result back once. The memory is bounded by the state kept by the transforms, instead
+    of the size of the C++ file.
+    '''
+
+    def __init__(self, debug: bool = False):
+        # If enabled, keep a `.cpp.bak_before_<name>` snapshot before each transform.
+        self.debug = debug
+        self.transforms: List[CppTransform] = []
+
+    def register(self, name: str, func: CppLinesTransformFunc):
+        self.transforms.append(CppTransform(name=name, func=func))
+
+    @classmethod
+    def tee(cls, lines: Iterable[str], backup_file: Path) -> Iterator[str]:
+        with backup_file.open('w') as fout:
+            for line in lines:
+                fout.write(line)
+                yield line
+
+    def transform_lines(self, lines: Iterable[str], cpp_file: Optional[Path] = None):
+        for transform in self.transforms:
+            if self.debug and cpp_file:
+                lines = self.tee(lines, cpp_file.with_suffix(f'.cpp.bak_before_{transform.name}'))
+            lines = transform.func(lines)
+        return lines
+
+    def transform_code(self, code: str):
+        return ''.join(self.transform_lines(split_lines(code)))
+
+    def run_transforms(self, cpp_file: Path):
+        temp_file = cpp_file.with_suffix('.cpp.tmp')
+        try:
+            with cpp_file.open() as fin, temp_file.open('w') as fout:
+                for line in self.transform_lines(fin, cpp_file):
+                    fout.write(line)
+        except Exception:
+            # Leave the C++ file untouched.
+            temp_file.unlink(missing_ok=True)
+            raise
+        os.replace(temp_file, cpp_file)
+
+    def run(
+        self,
+        cpp_file: Path,
+        execution_context_collection: Optional[ExecutionContextCollection] = None,
+        context_name: str = 'cpp_transform',
+    ):
+        '''
+        If `execution_context_collection` is provided, the transforms run in the guard of
+        `context_name`. Otherwise, the exception is raised.
+        '''
+        if execution_context_collection is None:
+            self.run_transforms(cpp_file)
+            return
+
+        with execution_context_collection.guard(context_name) as should_run:
+            if should_run:
+                self.run_transforms(cpp_file)
@@ -1,9 +1,11 @@
+from typing import Iterable
 from pathlib import Path
-import shutil
 import re
 
 import attrs
 
+from .cpp_transform_pipeline import CppTransformPipeline
+
 
 @attrs.define
 class FlagSetterConfig:
@@ -16,24 +18,25 @@ class FlagSetter:
     def __init__(self, config: FlagSetterConfig):
         self.config = config
 
-    def run(self, cpp_file: Path):
+    def transform_lines(self, lines: Iterable[str]):
+        flag_name = self.config.flag_name.lstrip('_')
+        pattern = re.compile(rf'(PyDict_SetItem\(__pyx_d, __pyx_n_s_{flag_name}, )([^\)]+)\)')
+        for line in lines:
+            if 'PyDict_SetItem' in line:
+                line = pattern.sub(
+                    # Always set to True.
+                    r'\1' + 'Py_True /* Changed by pywhlobf FlagSetter (prev: `\\2`) */ )',
+                    line,
+                )
+            yield line
+
+    def run(self, cpp_file: Path, debug: bool = False):
         if not self.config.enable:
             return False
 
-        # Backup for debugging.
-        shutil.copyfile(cpp_file, cpp_file.with_suffix('.cpp.bak_before_flag_setter'))
-
         # Change cpp file inplace.
-        code = cpp_file.read_text()
-
-        flag_name = self.config.flag_name.lstrip('_')
-        code = re.sub(
-            rf'(PyDict_SetItem\(__pyx_d, __pyx_n_s_{flag_name}, )([^\)]+)\)',
-            # Always set to True.
-            r'\1' + 'Py_True /* Changed by pywhlobf FlagSetter (prev: `\\2`) */ )',
-            code,
-        )
-
-        cpp_file.write_text(code)
+        cpp_transform_pipeline = CppTransformPipeline(debug)
+        cpp_transform_pipeline.register('flag_setter', self.transform_lines)
+        cpp_transform_pipeline.run(cpp_file)
 
         return True
@@ -1,19 +1,84 @@
-from typing import Optional
+from typing import Optional, Iterable, Sequence, List
+from enum import unique, Enum
 import logging
 from pathlib import Path
-import shutil
+import base64
+import functools
 import re
+import zlib
 
 import attrs
 from cryptography.fernet import Fernet
+from cryptography.hazmat.primitives import hashes, hmac, padding
+from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
+
+from .cpp_transform_pipeline import CppTransformPipeline, split_lines
 
 logger = logging.getLogger(__name__)
 
 
+@unique
+class SourceCodePayloadFormat(Enum):
+    # Encrypt each line, the traceback shows the encrypted source line.
+    LINES = 'lines'
+    # Compress and encrypt the whole file once, embedded as a byte array.
+    # The traceback doesn't show the source line, decrypt the temporary file instead.
+    COMPACT = 'compact'
+
+
+@unique
+class SourceCodeTraceMode(Enum):
+    # Write the encrypted source code to a file in `temp_directory_path()`.
+    TEMP_FILE = 'temp_file'
+    # Register the encrypted source code to `linecache.cache` in memory.
+    # NOTE: Before Python 3.13, the default `sys.excepthook` reads the source file directly,
+    # only the `traceback` module (logging, pytest, etc.) shows the source line.
+    LINECACHE = 'linecache'
+
+
 @attrs.define
 class SourceCodeInjectorConfig:
     enable: bool = True
     fernet_key: Optional[str] = ''
+    payload_format: SourceCodePayloadFormat = SourceCodePayloadFormat.LINES
+    trace_mode: SourceCodeTraceMode = SourceCodeTraceMode.TEMP_FILE
+    # If enabled, the same input always generates the same C++ code.
+    enable_deterministic_encryption: bool = False
+
+
+class DeterministicFernet(Fernet):
+    '''
+    Fernet with the IV derived from the key and the plaintext (SIV-style) and a zero timestamp,
+    hence the same plaintext always gives the same token. The token is decrypted by `Fernet`.
+    NOTE: Reveals whether two tokens share the same plaintext.
+    '''
+
+    def __init__(self, key: bytes):
+        super().__init__(key)
+        raw_key = base64.urlsafe_b64decode(key)
+        self.signing_key = raw_key[:16]
+        self.encryption_key = raw_key[16:]
+
+    def derive_iv(self, data: bytes):
+        # Domain separated from the token HMAC, which starts with the version byte 0x80.
+        iv_hmac = hmac.HMAC(self.signing_key, hashes.SHA256())
+        iv_hmac.update(b'pywhlobf-siv\0')
+        iv_hmac.update(data)
+        return iv_hmac.finalize()[:16]
+
+    def encrypt(self, data: bytes):
+        # https://github.com/fernet/spec/blob/master/Spec.md
+        iv = self.derive_iv(data)
+
+        padder = padding.PKCS7(algorithms.AES.block_size).padder()
+        padded_data = padder.update(data) + padder.finalize()
+        encryptor = Cipher(algorithms.AES(self.encryption_key), modes.CBC(iv)).encryptor()
+        ciphertext = encryptor.update(padded_data) + encryptor.finalize()
+
+        basic_parts = b'\x80' + (0).to_bytes(8, 'big') + iv + ciphertext
+        token_hmac = hmac.HMAC(self.signing_key, hashes.SHA256())
+        token_hmac.update(basic_parts)
+        return base64.urlsafe_b64encode(basic_parts + token_hmac.finalize())
 
 
 class SourceCodeInjector:
@@ -25,21 +90,34 @@ class SourceCodeInjector:
     def encrypt(cls, fernet: Fernet, text: str):
         return f'(pywhlobf {fernet.encrypt(text.encode()).decode()})'
 
+    @classmethod
+    def encrypt_compact(cls, fernet: Fernet, text: str):
+        # The Fernet token without the base64 encoding.
+        return base64.urlsafe_b64decode(fernet.encrypt(zlib.compress(text.encode(), 9)))
+
     @classmethod
     def decrept(cls, fernet: Fernet, text: str):
+        # https://datatracker.ietf.org/doc/html/rfc3548.html#page-6
+        text = re.sub(
+            r'\(pywhlobf-compact ([a-zA-Z0-9=_-]+?)\)',
+            lambda match: zlib.decompress(fernet.decrypt(match.group(1))).decode(),
+            text,
+        )
         return re.sub(
-            # https://datatracker.ietf.org/doc/html/rfc3548.html#page-6
             r'\(pywhlobf ([a-zA-Z0-9=_-]+?)\)',
             lambda match: fernet.decrypt(match.group(1)).decode(),
             text,
         )
 
     @classmethod
-    def inject_header(cls, code: str):
-        header = '''
+    def get_header_code(cls):
+        # NOTE: Also used in the precompiled header.
+        return '''
 /* >>> Generated by pywhlobf SourceCodeInjector. */
 #include <string>
 #include <fstream>
+#include <mutex>
+#include <atomic>
 #if __has_include(<filesystem>)
     #include <filesystem>
     namespace fs = std::filesystem;
@@ -51,25 +129,169 @@ class SourceCodeInjector:
 #endif
 /* <<< Generated by pywhlobf SourceCodeInjector. */
 
+'''.lstrip()
+
+    @classmethod
+    def generate_encrypted_src_code(cls, py_file: Path, fernet: Fernet):
+        lines = ['const std::string encrypted_source_code =']
+        for src_line in py_file.read_text().splitlines():
+            encrypted_src_line = cls.encrypt(fernet, src_line)
+            lines.append(f'    "{encrypted_src_line}\\n"')
+        # Adding empty string to handle empty file.
+        lines.append('    "";')
+        return '\n    '.join(lines)
+
+    @classmethod
+    def generate_compact_encrypted_src_code(cls, py_file: Path, fernet: Fernet):
+        payload = cls.encrypt_compact(fernet, py_file.read_text())
+
+        lines = ['static const unsigned char encrypted_source_code_payload[] = {']
+        for begin in range(0, len(payload), 24):
+            lines.append('    ' + ','.join(str(val) for val in payload[begin:begin + 24]) + ',')
+        lines.append('};')
+        # Encode the Fernet token in the URL-safe base64 form, as `decrypt_message` expects.
+        lines.extend(
+            '''
+static const char base64_alphabet[] =
+    "ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz0123456789-_";
+const size_t size = sizeof(encrypted_source_code_payload);
+std::string encrypted_source_code;
+encrypted_source_code.reserve((size + 2) / 3 * 4 + 20);
+encrypted_source_code += "(pywhlobf-compact ";
+for (size_t idx = 0; idx < size; idx += 3) {
+    unsigned long bits = (unsigned long)encrypted_source_code_payload[idx] << 16;
+    if (idx + 1 < size) bits |= (unsigned long)encrypted_source_code_payload[idx + 1] << 8;
+    if (idx + 2 < size) bits |= (unsigned long)encrypted_source_code_payload[idx + 2];
+    encrypted_source_code += base64_alphabet[(bits >> 18) & 63];
+    encrypted_source_code += base64_alphabet[(bits >> 12) & 63];
+    encrypted_source_code += (idx + 1 < size) ? base64_alphabet[(bits >> 6) & 63] : '=';
+    encrypted_source_code += (idx + 2 < size) ? base64_alphabet[bits & 63] : '=';
+}
+encrypted_source_code += ")\\n";
+'''.strip().splitlines()
+        )
+        return '\n    '.join(lines)
+
+    @classmethod
+    def generate_temp_file_trace_code(cls, encrypted_py_file_desc: str):
+        return f'''
+static const char *__pyx_encrypted_src_code_file = NULL;
+static std::once_flag __pyx_encrypted_src_code_file_once;
+
+static void write_encrypted_src_code_to_temp_file() {{
+    try {{
+        auto temp_fd = fs::temp_directory_path();
+        auto temp_pywhlobf_fd = temp_fd / "pywhlobf";
+        auto temp_file = temp_pywhlobf_fd / "{encrypted_py_file_desc}";
+
+        if (!fs::exists(temp_file)) {{
+            // Make sure temp_pywhlobf_fd exists.
+            if (!fs::exists(temp_pywhlobf_fd)) {{
+                fs::create_directory(temp_pywhlobf_fd);
+            }}
+
+            std::ofstream fout(temp_file);
+            fout << get_encrypted_src_code();
+            fout.close();
+            if (!fout) {{
+                return;
+            }}
+        }}
+
+        static const std::string temp_file_str = temp_file.string();
+        __pyx_encrypted_src_code_file = temp_file_str.c_str();
+    }} catch (...) {{
+        // Keep the original file name.
+    }}
+}}
+
+static const char *get_encrypted_src_code_file() {{
+    // Materialized once per process, the following errors don't touch the file system.
+    std::call_once(__pyx_encrypted_src_code_file_once, write_encrypted_src_code_to_temp_file);
+    return __pyx_encrypted_src_code_file;
+}}
+'''
+
+    @classmethod
+    def generate_linecache_trace_code(cls, encrypted_py_file_desc: str):
+        return f'''
+static const char *__pyx_encrypted_src_code_file = "{encrypted_py_file_desc}";
+static std::atomic<bool> __pyx_encrypted_src_code_registered(false);
+
+static void register_encrypted_src_code_to_linecache() {{
+    // NOTE: Serialized by the GIL instead of a once flag, since a thread holding the flag
+    // could wait for the GIL forever.
+    PyGILState_STATE gil_state = PyGILState_Ensure();
+    if (!__pyx_encrypted_src_code_registered.load()) {{
+        // Keep the raised exception.
+#if PY_VERSION_HEX >= 0x030C0000
+        PyObject *raised_exception = PyErr_GetRaisedException();
+#else
+        PyObject *error_type, *error_value, *error_traceback;
+        PyErr_Fetch(&error_type, &error_value, &error_traceback);
+#endif
+
+        const std::string encrypted_source_code = get_encrypted_src_code();
+        PyObject *linecache = PyImport_ImportModule("linecache");
+        PyObject *cache = linecache ? PyObject_GetAttrString(linecache, "cache") : NULL;
+        PyObject *src = PyUnicode_FromStringAndSize(
+            encrypted_source_code.data(),
+            (Py_ssize_t)encrypted_source_code.size()
+        );
+        PyObject *lines = src ? PyUnicode_Splitlines(src, 1) : NULL;
+        if (cache && PyDict_Check(cache) && lines) {{
+            // Same as the entry of a module loaded by `__loader__`, kept by `checkcache`.
+            PyObject *entry = Py_BuildValue(
+                "(nOOs)",
+                (Py_ssize_t)encrypted_source_code.size(),
+                Py_None,
+                lines,
+                __pyx_encrypted_src_code_file
+            );
+            if (entry) {{
+                PyDict_SetItemString(cache, __pyx_encrypted_src_code_file, entry);
+                Py_DECREF(entry);
+            }}
+        }}
+        Py_XDECREF(lines);
+        Py_XDECREF(src);
+        Py_XDECREF(cache);
+        Py_XDECREF(linecache);
+        PyErr_Clear();
+
+#if PY_VERSION_HEX >= 0x030C0000
+        PyErr_SetRaisedException(raised_exception);
+#else
+        PyErr_Restore(error_type, error_value, error_traceback);
+#endif
+        __pyx_encrypted_src_code_registered.store(true);
+    }}
+    PyGILState_Release(gil_state);
+}}
+
+static const char *get_encrypted_src_code_file() {{
+    // Registered once per process.
+    if (!__pyx_encrypted_src_code_registered.load()) {{
+        register_encrypted_src_code_to_linecache();
+    }}
+    return __pyx_encrypted_src_code_file;
+}}
 '''
-        return header.lstrip() + code
 
     @classmethod
-    def encrypt_and_inject_source_code(
+    def generate_injection_codes(
         cls,
         py_file: Path,
         py_root_fd: Optional[Path],
         fernet: Fernet,
-        code: str,
+        payload_format: SourceCodePayloadFormat = SourceCodePayloadFormat.LINES,
+        trace_mode: SourceCodeTraceMode = SourceCodeTraceMode.TEMP_FILE,
     ):
         # Encrypt source code.
-        lines = ['const std::string encrypted_source_code =']
-        for src_line in py_file.read_text().splitlines():
-            encrypted_src_line = cls.encrypt(fernet, src_line)
-            lines.append(f'"{encrypted_src_line}\\\\n"')
-        # Adding empty string to handle empty file.
-        lines.append('""')
-        encrypted_src_code = '\n'.join(lines) + ';'
+        if payload_format == SourceCodePayloadFormat.COMPACT:
+            encrypted_src_code = cls.generate_compact_encrypted_src_code(py_file, fernet)
+        else:
+            encrypted_src_code = cls.generate_encrypted_src_code(py_file, fernet)
 
         # Encrypt file name or relative path.
         if py_root_fd:
@@ -78,121 +300,119 @@ class SourceCodeInjector:
             py_file_desc = py_file.name
         encrypted_py_file_desc = cls.encrypt(fernet, py_file_desc)
 
-        # Code snippet for saving encrypted source code.
-        write_encrypted_src_code_to_tempfile_code = f'''
-/* >>> Generated by pywhlobf SourceCodeInjector. */
-static fs::path write_encrypted_src_code_to_temp_file() {{
-    auto temp_fd = fs::temp_directory_path();
-    auto temp_pywhlobf_fd = temp_fd / "pywhlobf";
-    auto temp_file = temp_pywhlobf_fd / "{encrypted_py_file_desc}";
-
-    if (fs::exists(temp_file)) {{
-        // No need to update.
-        return temp_file;
-    }}
-
-    // Make sure temp_fd exists.
-    if (!fs::exists(temp_fd)) {{
-        return temp_file;
-    }}
-
-    // Make sure temp_pywhlobf_fd exists.
-    if (!fs::exists(temp_pywhlobf_fd)) {{
-        if (!fs::create_directory(temp_pywhlobf_fd)) {{
-            return temp_file;
-        }}
-    }}
+        if trace_mode == SourceCodeTraceMode.LINECACHE:
+            trace_code = cls.generate_linecache_trace_code(encrypted_py_file_desc)
+        else:
+            trace_code = cls.generate_temp_file_trace_code(encrypted_py_file_desc)
 
-    // Write the encrypted code to file.
+        # Code snippet for providing the encrypted source code to the traceback.
+        definitions_code = f'''
+/* >>> Generated by pywhlobf SourceCodeInjector. */
+static std::string get_encrypted_src_code() {{
     {encrypted_src_code}
-    std::ofstream fout(temp_file);
-    fout << encrypted_source_code;
-
-    return temp_file;
+    return encrypted_source_code;
 }}
+{trace_code}
 /* <<< Generated by pywhlobf SourceCodeInjector. */
 
-'''
-        write_encrypted_src_code_to_tempfile_code = \
-            write_encrypted_src_code_to_tempfile_code.lstrip()
-
-        # NOTE: This snippet will be injected into __PYX_ERR macro.
-        # __PYX_ERR changes the variables in the scope, such as `__pyx_filename` variable.
-        # In order to trace the temporary file, we will inject a `std::string __pyx_temp_file;`
-        # statement after all appearances of `const char *__pyx_filename = NULL;`
-        # and `static const char *__pyx_filename;`.
+'''.lstrip()
+
+        # NOTE: This snippet will be injected into __PYX_ERR macro, hence only the error path
+        # is affected. The macro changes the `__pyx_filename` variable in the scope.
         pyx_mark_err_pos_code = '''
-auto temp_file = write_encrypted_src_code_to_temp_file();
-if (fs::exists(temp_file)) {
-    __pyx_temp_file = temp_file.string();
-    __pyx_filename = __pyx_temp_file.c_str();
+{
+    const char *encrypted_src_code_file = get_encrypted_src_code_file();
+    if (encrypted_src_code_file) {
+        __pyx_filename = encrypted_src_code_file;
+    }
 }
 /* Generated by pywhlobf SourceCodeInjector. */
 '''
         # Flatten to one line.
         pyx_mark_err_pos_code = ' '.join(pyx_mark_err_pos_code.split())
 
-        # Code injection.
-        code = re.sub(
-            r'(#define __PYX_MARK_ERR_POS.+?\\\s+\{.+?)\}',
-            '\n'.join([
-                write_encrypted_src_code_to_tempfile_code,
-                r'\1' + pyx_mark_err_pos_code + '}',
-            ]),
-            code,
-            flags=re.MULTILINE,
-        )
-
-        code = re.sub(
-            r'^(static const char \*__pyx_filename;)',
-            '\n'.join([
-                r'\1',
-                '/* Added by pywhlobf SourceCodeInjector. */',
-                r'static std::string __pyx_temp_file;',
-            ]),
-            code,
-            flags=re.MULTILINE,
-        )
+        return definitions_code, pyx_mark_err_pos_code
 
-        code = re.sub(
-            r'^(\s+)(const char \*__pyx_filename = NULL;)',
-            '\n'.join([
-                r'\1\2',
-                r'\1' + '/* Added by pywhlobf SourceCodeInjector. */',
-                r'\1std::string __pyx_temp_file;',
-            ]),
-            code,
-            flags=re.MULTILINE,
-        )
-
-        code = re.sub(
-            r'__Pyx_AddTraceback\(\"(.+?)\"',
-            lambda match: (
-                f'__Pyx_AddTraceback("{cls.encrypt(fernet, match.group(1))}" '
-                '/* Changed by pywhlobf SourceCodeInjector. */'
-            ),
-            code,
-            flags=re.MULTILINE,
-        )
-
-        code = re.sub(
-            r'__Pyx_RaiseArgtupleInvalid\(\"(.+?)\"',
-            lambda match: (
-                f'__Pyx_RaiseArgtupleInvalid("{cls.encrypt(fernet, match.group(1))}" '
-                '/* Changed by pywhlobf SourceCodeInjector. */'
-            ),
-            code,
-            flags=re.MULTILINE,
-        )
-
-        return code
+    @classmethod
+    def inject_into_pyx_mark_err_pos(
+        cls,
+        macro_lines: Sequence[str],
+        definitions_code: str,
+        pyx_mark_err_pos_code: str,
+    ):
+        # The macro body `{ ... }` ends in the last line.
+        last_line = macro_lines[-1]
+        idx = last_line.rfind('}')
+        if idx < 0:
+            yield from macro_lines
+            return
+        yield from split_lines(definitions_code)
+        yield from macro_lines[:-1]
+        yield last_line[:idx] + pyx_mark_err_pos_code + last_line[idx:]
 
-    def run(
-        self,
+    @classmethod
+    def encrypt_and_inject_source_code_lines(
+        cls,
         py_file: Path,
-        cpp_file: Path,
-        py_root_fd: Optional[Path] = None,
+        py_root_fd: Optional[Path],
+        fernet: Fernet,
+        lines: Iterable[str],
+        payload_format: SourceCodePayloadFormat = SourceCodePayloadFormat.LINES,
+        trace_mode: SourceCodeTraceMode = SourceCodeTraceMode.TEMP_FILE,
     ):
+        definitions_code, pyx_mark_err_pos_code = cls.generate_injection_codes(
+            py_file,
+            py_root_fd,
+            fernet,
+            payload_format,
+            trace_mode,
+        )
+
+        pattern_add_traceback = re.compile(r'__Pyx_AddTraceback\(\"(.+?)\"')
+        pattern_raise_argtuple_invalid = re.compile(r'__Pyx_RaiseArgtupleInvalid\(\"(.+?)\"')
+
+        # The `__PYX_MARK_ERR_POS` macro might be continued with backslashes.
+        macro_lines: Optional[List[str]] = None
+
+        for line in lines:
+            if macro_lines is None and line.startswith('#define __PYX_MARK_ERR_POS'):
+                macro_lines = []
+            if macro_lines is not None:
+                macro_lines.append(line)
+                if not line.rstrip().endswith('\\'):
+                    yield from cls.inject_into_pyx_mark_err_pos(
+                        macro_lines,
+                        definitions_code,
+                        pyx_mark_err_pos_code,
+                    )
+                    macro_lines = None
+                continue
+
+            if '__Pyx_AddTraceback' in line:
+                line = pattern_add_traceback.sub(
+                    lambda match: (
+                        f'__Pyx_AddTraceback("{cls.encrypt(fernet, match.group(1))}" '
+                        '/* Changed by pywhlobf SourceCodeInjector. */'
+                    ),
+                    line,
+                )
+
+            if '__Pyx_RaiseArgtupleInvalid' in line:
+                line = pattern_raise_argtuple_invalid.sub(
+                    lambda match: (
+                        f'__Pyx_RaiseArgtupleInvalid("{cls.encrypt(fernet, match.group(1))}" '
+                        '/* Changed by pywhlobf SourceCodeInjector. */'
+                    ),
+                    line,
+                )
+
+            yield line
+
+        if macro_lines:
+            # Unterminated, leave it as is.
+            yield from macro_lines
+
+    def is_activated(self):
         if not self.config.enable:
             return False
 
@@ -200,21 +420,49 @@ if (fs::exists(temp_file)) {
             logger.warning('SourceCodeInjector is enabled but fernet_key is missing, abort.')
             return False
 
-        # Backup for debugging.
-        shutil.copyfile(cpp_file, cpp_file.with_suffix('.cpp.bak_before_source_code_injector'))
+        return True
 
+    def create_fernet(self):
+        assert self.config.fernet_key
         fernet_key = self.config.fernet_key.encode()
-        fernet = Fernet(fernet_key)
+        if self.config.enable_deterministic_encryption:
+            return DeterministicFernet(fernet_key)
+        return Fernet(fernet_key)
 
-        # Change cpp file inplace.
-        code = cpp_file.read_text()
-        code = self.encrypt_and_inject_source_code(
+    def transform_lines(
+        self,
+        py_file: Path,
+        lines: Iterable[str],
+        py_root_fd: Optional[Path] = None,
+    ):
+        fernet = self.create_fernet()
+
+        yield from split_lines(self.get_header_code())
+        yield from self.encrypt_and_inject_source_code_lines(
             py_file=py_file,
             py_root_fd=py_root_fd,
             fernet=fernet,
-            code=code,
+            lines=lines,
+            payload_format=self.config.payload_format,
+            trace_mode=self.config.trace_mode,
+        )
+
+    def run(
+        self,
+        py_file: Path,
+        cpp_file: Path,
+        py_root_fd: Optional[Path] = None,
+        debug: bool = False,
+    ):
+        if not self.is_activated():
+            return False
+
+        # Change cpp file inplace.
+        cpp_transform_pipeline = CppTransformPipeline(debug)
+        cpp_transform_pipeline.register(
+            'source_code_injector',
+            functools.partial(self.transform_lines, py_file, py_root_fd=py_root_fd),
         )
-        code = self.inject_header(code)
-        cpp_file.write_text(code)
+        cpp_transform_pipeline.run(cpp_file)
 
         return True
@@ -1,13 +1,185 @@
+from typing import Dict, Iterable
+from enum import unique, Enum
 from pathlib import Path
-import shutil
+import hashlib
 import re
 
 import attrs
 
+from .cpp_transform_pipeline import CppTransformPipeline, split_lines
+
+
+@unique
+class StringLiteralObfuscatorMode(Enum):
+    # Encrypted at compile time by the `AY_OBFUSCATE` constexpr templates (C++14).
+    TEMPLATE = 'template'
+    # Encrypted in the transform, emitted as byte arrays decoded by a shared routine (C++11).
+    XOR = 'xor'
+    # Same as XOR, but all the literals share one blob decoded in one pass on loading (C++11).
+    ARENA = 'arena'
+
 
 @attrs.define
 class StringLiteralObfuscatorConfig:
     enable: bool = True
+    mode: StringLiteralObfuscatorMode = StringLiteralObfuscatorMode.TEMPLATE
+
+
+# https://en.cppreference.com/w/cpp/language/escape
+C_SIMPLE_ESCAPE_SEQUENCES = {
+    "'": 0x27,
+    '"': 0x22,
+    '?': 0x3f,
+    '\\': 0x5c,
+    'a': 0x07,
+    'b': 0x08,
+    'f': 0x0c,
+    'n': 0x0a,
+    'r': 0x0d,
+    't': 0x09,
+    'v': 0x0b,
+}
+OCT_DIGITS = frozenset('01234567')
+HEX_DIGITS = frozenset('0123456789abcdefABCDEF')
+
+
+def parse_c_string_literal_value(value: str):
+    '''
+    Convert the content of a C string literal (without the surrounding quotes) to bytes,
+    the adjacent literals like `"a" "b"` are concatenated.
+    '''
+    data = bytearray()
+    idx = 0
+    while idx < len(value):
+        char = value[idx]
+
+        if char == '"':
+            # Skip to the opening quote of the next literal.
+            idx = value.index('"', idx + 1) + 1
+            continue
+
+        if char != '\\':
+            data.extend(char.encode())
+            idx += 1
+            continue
+
+        char = value[idx + 1]
+        if char in C_SIMPLE_ESCAPE_SEQUENCES:
+            data.append(C_SIMPLE_ESCAPE_SEQUENCES[char])
+            idx += 2
+
+        elif char in OCT_DIGITS:
+            end = idx + 1
+            while end < len(value) and end < idx + 4 and value[end] in OCT_DIGITS:
+                end += 1
+            data.append(int(value[idx + 1:end], 8) & 0xff)
+            idx = end
+
+        elif char == 'x':
+            end = idx + 2
+            while end < len(value) and value[end] in HEX_DIGITS:
+                end += 1
+            data.append(int(value[idx + 2:end], 16) & 0xff)
+            idx = end
+
+        else:
+            raise ValueError(f'Unsupported escape sequence in {value}')
+
+    return bytes(data)
+
+
+def generate_xor_key(salt: str, data: bytes):
+    # Deterministic for the same input, hence the C++ file is reproducible.
+    key = int.from_bytes(
+        hashlib.blake2b(salt.encode() + b'\0' + data, digest_size=8).digest(),
+        'little',
+    )
+    # Same as `ay::generate_key`, no byte of the key is zero.
+    return key | 0x0101010101010101
+
+
+def xor_encrypt(salt: str, data: bytes):
+    key = generate_xor_key(salt, data)
+    encrypted_data = bytes(
+        val ^ ((key >> ((idx % 8) * 8)) & 0xff) for idx, val in enumerate(data)
+    )
+    return key, encrypted_data
+
+
+UINT64_MASK = 0xFFFFFFFFFFFFFFFF
+
+
+def mix_arena_block_key(key: int, block_idx: int):
+    # The finalizer of SplitMix64, same as `pywhlobf_mix_arena_block_key`.
+    value = (key + (block_idx + 1) * 0x9E3779B97F4A7C15) & UINT64_MASK
+    value = ((value ^ (value >> 30)) * 0xBF58476D1CE4E5B9) & UINT64_MASK
+    value = ((value ^ (value >> 27)) * 0x94D049BB133111EB) & UINT64_MASK
+    value ^= value >> 31
+    return value | 0x0101010101010101
+
+
+def xor_encrypt_arena(data: bytes):
+    # Each 8-byte block is keyed by its offset, the literals don't share the same keystream.
+    key = generate_xor_key('__pywhlobf_arena', data)
+    encrypted_data = bytearray(data)
+    for begin in range(0, len(data), 8):
+        block_key = mix_arena_block_key(key, begin // 8).to_bytes(8, 'little')
+        for idx in range(begin, min(begin + 8, len(data))):
+            encrypted_data[idx] ^= block_key[idx - begin]
+    return key, bytes(encrypted_data)
+
+
+class StringLiteralArena:
+    '''
+    Collect the literals of a module into one encrypted blob, decrypted in one pass when the
+    module is loaded, right before `PyInit_*` is called.
+    '''
+
+    def __init__(self):
+        self.data = bytearray()
+
+    @classmethod
+    def generate_declaration_lines(cls):
+        # NOTE: Must be in the file scope, the literals might be defined in functions.
+        # The arena is defined after all the literals.
+        yield '/* Added by pywhlobf StringLiteralObfuscator. */\n'
+        yield 'namespace { extern unsigned char __pywhlobf_arena[]; }\n'
+
+    def generate_definition_lines(self, with_const: bool, var_name: str, value: str):
+        # With the null terminator, same as `sizeof`.
+        data = parse_c_string_literal_value(value) + b'\0'
+        offset = len(self.data)
+        self.data.extend(data)
+
+        yield StringLiteralObfuscator.drop_const(
+            with_const,
+            f'static const char *{var_name} = (const char *)(__pywhlobf_arena + {offset});\n',
+        )
+        yield f'static const long __length{var_name} = {len(data)};'
+
+    def generate_arena_lines(self):
+        if not self.data:
+            yield '/* Added by pywhlobf StringLiteralObfuscator. */\n'
+            yield 'namespace { unsigned char __pywhlobf_arena[1]; }\n'
+            return
+
+        key, encrypted_data = xor_encrypt_arena(bytes(self.data))
+        encrypted_data_code = ','.join(str(val) for val in encrypted_data)
+        yield from split_lines(f'''
+/* >>> Generated by pywhlobf StringLiteralObfuscator. */
+namespace {{
+unsigned char __pywhlobf_arena[{len(encrypted_data)}] = {{{encrypted_data_code}}};
+
+struct PywhlobfArenaDecoder {{
+    PywhlobfArenaDecoder() {{
+        pywhlobf_decode_arena(__pywhlobf_arena, {len(encrypted_data)}, {key}ULL);
+    }}
+}};
+
+PywhlobfArenaDecoder __pywhlobf_arena_decoder;
+}}
+/* <<< Generated by pywhlobf StringLiteralObfuscator. */
+''')
 
 
 class StringLiteralObfuscator:
@@ -16,8 +188,78 @@ class StringLiteralObfuscator:
         self.config = config
 
     @classmethod
-    def inject_header(cls, code: str):
-        header = '''
+    def get_include_fd(cls):
+        include_fd = Path(__file__).parent / 'string_literal_obfuscator_asset'
+        assert (include_fd / 'obfuscate.h').is_file()
+        return include_fd
+
+    @classmethod
+    def get_header_code(
+        cls,
+        mode: StringLiteralObfuscatorMode = StringLiteralObfuscatorMode.TEMPLATE,
+    ):
+        # NOTE: Also used in the precompiled header.
+        if mode == StringLiteralObfuscatorMode.ARENA:
+            return '''
+/* >>> Generated by pywhlobf StringLiteralObfuscator. */
+/* NOTE: Guarded since it's also included in the precompiled header. */
+#ifndef PYWHLOBF_DECODE_ARENA
+#define PYWHLOBF_DECODE_ARENA
+static unsigned long long pywhlobf_mix_arena_block_key(
+    unsigned long long key,
+    unsigned long long block_idx
+) {
+    unsigned long long value = key + (block_idx + 1) * 0x9E3779B97F4A7C15ULL;
+    value = (value ^ (value >> 30)) * 0xBF58476D1CE4E5B9ULL;
+    value = (value ^ (value >> 27)) * 0x94D049BB133111EBULL;
+    value ^= value >> 31;
+    return value | 0x0101010101010101ULL;
+}
+
+static void pywhlobf_decode_arena(
+    unsigned char *data,
+    unsigned long size,
+    unsigned long long key
+) {
+    /* The volatile access stops the compiler from decoding at compile time. */
+    volatile unsigned char *volatile_data = data;
+    unsigned long long block_key = 0;
+    for (unsigned long idx = 0; idx < size; ++idx) {
+        if (idx % 8 == 0) {
+            block_key = pywhlobf_mix_arena_block_key(key, idx / 8);
+        }
+        volatile_data[idx] ^= (unsigned char)((block_key >> ((idx % 8) * 8)) & 0xFF);
+    }
+}
+#endif
+/* <<< Generated by pywhlobf StringLiteralObfuscator. */
+
+'''.lstrip()
+
+        if mode == StringLiteralObfuscatorMode.XOR:
+            return '''
+/* >>> Generated by pywhlobf StringLiteralObfuscator. */
+/* NOTE: Guarded since it's also included in the precompiled header. */
+#ifndef PYWHLOBF_DECODE_STRING_LITERAL
+#define PYWHLOBF_DECODE_STRING_LITERAL
+static char *pywhlobf_decode_string_literal(
+    unsigned char *data,
+    unsigned long size,
+    unsigned long long key
+) {
+    /* The volatile access stops the compiler from decoding at compile time. */
+    volatile unsigned char *volatile_data = data;
+    for (unsigned long idx = 0; idx < size; ++idx) {
+        volatile_data[idx] ^= (unsigned char)((key >> ((idx % 8) * 8)) & 0xFF);
+    }
+    return (char *)data;
+}
+#endif
+/* <<< Generated by pywhlobf StringLiteralObfuscator. */
+
+'''.lstrip()
+
+        return '''
 /* >>> Generated by pywhlobf StringLiteralObfuscator. */
 #include "obfuscate.h"
 
@@ -28,8 +270,7 @@ class StringLiteralObfuscator:
     }()
 /* <<< Generated by pywhlobf StringLiteralObfuscator. */
 
-'''
-        return header.lstrip() + code
+'''.lstrip()
 
     @classmethod
     def drop_const(cls, with_const: bool, pattern: str):
@@ -38,52 +279,110 @@ class StringLiteralObfuscator:
         return pattern
 
     @classmethod
-    def obfuscate_static_char_literal(cls, with_const: bool, code: str):
-        pattern = cls.drop_const(with_const, r'^static const char (\w+)\[\] = \"(.*?)\";$')
-
-        var_names = []
-        for var_name, _ in re.findall(pattern, code, flags=re.MULTILINE):
-            var_names.append(var_name)
-
-        code = re.sub(
-            pattern,
-            '\n'.join([
-                f'/* Changed by pywhlobf StringLiteralObfuscator (with_const={with_const}). */',
-                cls.drop_const(with_const, r'static const char *\1 = AY_OBFUSCATE("\2");'),
-                r'static const long __length\1 = AY_OBFUSCATE_HACK_LENGTH("\2");',
-            ]),
-            code,
-            flags=re.MULTILINE,
+    def generate_xor_definition_lines(cls, with_const: bool, var_name: str, value: str):
+        # With the null terminator, same as `sizeof`.
+        data = parse_c_string_literal_value(value) + b'\0'
+        key, encrypted_data = xor_encrypt(var_name, data)
+        encrypted_data_code = ','.join(str(val) for val in encrypted_data)
+        yield f'static unsigned char __pywhlobf_data{var_name}[] = {{{encrypted_data_code}}};\n'
+        yield cls.drop_const(
+            with_const,
+            f'static const char *{var_name} = pywhlobf_decode_string_literal('
+            f'__pywhlobf_data{var_name}, {len(data)}, {key}ULL);\n',
         )
+        yield f'static const long __length{var_name} = {len(data)};'
 
-        for var_name in var_names:
-            code = re.sub(
-                r'sizeof\(' + var_name + r'\)',
-                (
-                    f'__length{var_name} '
-                    f'/* Changed by pywhlobf StringLiteralObfuscator (with_const={with_const}). */'
-                ),
-                code,
+    @classmethod
+    def generate_template_definition_lines(cls, with_const: bool, var_name: str, value: str):
+        yield cls.drop_const(
+            with_const,
+            f'static const char *{var_name} = AY_OBFUSCATE("{value}");\n',
+        )
+        yield f'static const long __length{var_name} = AY_OBFUSCATE_HACK_LENGTH("{value}");'
+
+    @classmethod
+    def obfuscate_static_char_literal_lines(
+        cls,
+        lines: Iterable[str],
+        mode: StringLiteralObfuscatorMode = StringLiteralObfuscatorMode.TEMPLATE,
+    ):
+        '''
+        Rewrite the `static [const ]char` literal definitions and the `sizeof` of them in one
+        scan, as a variable is always defined before its uses.
+        '''
+        arena = None
+        if mode == StringLiteralObfuscatorMode.XOR:
+            generate_definition_lines = cls.generate_xor_definition_lines
+        elif mode == StringLiteralObfuscatorMode.ARENA:
+            arena = StringLiteralArena()
+            generate_definition_lines = arena.generate_definition_lines
+            yield from arena.generate_declaration_lines()
+        else:
+            generate_definition_lines = cls.generate_template_definition_lines
+
+        pattern_definition = re.compile(
+            r'^static (?P<const>const )?char (?P<var_name>\w+)\[\] = \"(?P<value>.*?)\";$'
+        )
+        pattern_sizeof = re.compile(r'sizeof\((\w+)\)')
+
+        # Variable name -> with_const.
+        var_names: Dict[str, bool] = {}
+
+        def replace_sizeof(match: re.Match):
+            var_name = match.group(1)
+            with_const = var_names.get(var_name)
+            if with_const is None:
+                return match.group(0)
+            return (
+                f'__length{var_name} '
+                f'/* Changed by pywhlobf StringLiteralObfuscator (with_const={with_const}). */'
             )
 
-        return code
+        for line in lines:
+            if line.startswith('static '):
+                match = pattern_definition.match(line)
+                if match:
+                    var_name = match.group('var_name')
+                    with_const = bool(match.group('const'))
+                    var_names.setdefault(var_name, with_const)
+                    value = match.group('value')
+                    yield (
+                        '/* Changed by pywhlobf StringLiteralObfuscator '
+                        f'(with_const={with_const}). */\n'
+                    )
+                    *definition_lines, length_line = \
+                        generate_definition_lines(with_const, var_name, value)
+                    yield from definition_lines
+                    # Keep the line ending.
+                    yield length_line + line[match.end():]
+                    continue
+
+            if var_names and 'sizeof(' in line:
+                line = pattern_sizeof.sub(replace_sizeof, line)
+            yield line
 
-    def run(self, cpp_file: Path):
+        if arena:
+            yield from arena.generate_arena_lines()
+
+    @classmethod
+    def obfuscate_static_char_literals(
+        cls,
+        code: str,
+        mode: StringLiteralObfuscatorMode = StringLiteralObfuscatorMode.TEMPLATE,
+    ):
+        return ''.join(cls.obfuscate_static_char_literal_lines(split_lines(code), mode))
+
+    def transform_lines(self, lines: Iterable[str]):
+        yield from split_lines(self.get_header_code(self.config.mode))
+        yield from self.obfuscate_static_char_literal_lines(lines, self.config.mode)
+
+    def run(self, cpp_file: Path, debug: bool = False):
         if not self.config.enable:
             return False, None
 
-        # Backup for debugging.
-        shutil.copyfile(cpp_file, cpp_file.with_suffix('.cpp.bak_before_string_literal_obfuscator'))
-
         # Change cpp file inplace.
-        code = cpp_file.read_text()
-        code = self.obfuscate_static_char_literal(with_const=True, code=code)
-        code = self.obfuscate_static_char_literal(with_const=False, code=code)
-        code = self.inject_header(code)
-        cpp_file.write_text(code)
-
-        # Get include folder.
-        include_fd = Path(__file__).parent / 'string_literal_obfuscator_asset'
-        assert (include_fd / 'obfuscate.h').is_file()
+        cpp_transform_pipeline = CppTransformPipeline(debug)
+        cpp_transform_pipeline.register('string_literal_obfuscator', self.transform_lines)
+        cpp_transform_pipeline.run(cpp_file)
 
-        return True, include_fd
+        return True, self.get_include_fd()
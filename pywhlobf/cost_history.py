@@ -0,0 +1,152 @@
+from typing import Dict, Any, Mapping, Optional, Set
+from pathlib import Path
+import os
+import json
+import hashlib
+import tempfile
+import logging
+
+from .artifact_cache import lock_file
+
+logger = logging.getLogger(__name__)
+
+
+def get_default_cost_history_fd():
+    # Survives the runs, unlike the working folder.
+    if os.name == 'nt' and os.environ.get('LOCALAPPDATA'):
+        cache_fd = Path(os.environ['LOCALAPPDATA'])
+    else:
+        cache_fd = Path(os.environ.get('XDG_CACHE_HOME') or '~/.cache').expanduser()
+    return cache_fd.absolute() / 'pywhlobf'
+
+
+class CostHistory:
+    '''
+    Per-file stage durations recorded in previous runs, keyed by the file (usually the relative
+    path with the compiler config) and checked against the content hash of the code file.
+    '''
+
+    HISTORY_JSON = 'cost_history.json'
+
+    def __init__(self, history_fd: Path):
+        self.history_fd = history_fd
+        self.history_json = history_fd / self.HISTORY_JSON
+        self.entries = self.load()
+        self.updated_entries: Dict[str, Dict[str, Any]] = {}
+        self.removed_keys: Set[str] = set()
+
+    def load(self) -> Dict[str, Dict[str, Any]]:
+        try:
+            if not self.history_json.is_file():
+                return {}
+            return json.loads(self.history_json.read_text())
+        except OSError:
+            logger.warning(f'Failed to read {self.history_json}, ignored.', exc_info=True)
+            return {}
+        except Exception:
+            # Broken history, start over.
+            return {}
+
+    @classmethod
+    def compute_content_hash(cls, code_file: Path):
+        return hashlib.sha256(code_file.read_bytes()).hexdigest()
+
+    def get_seconds_per_byte(self):
+        total_duration = 0.0
+        total_size = 0
+        for entry in self.entries.values():
+            total_duration += sum(entry['durations'].values())
+            total_size += entry['size']
+        if total_duration <= 0.0 or total_size <= 0:
+            return 1.0
+        return total_duration / total_size
+
+    def get_scaled_duration(
+        self,
+        key: str,
+        content_hash: str,
+        size: int,
+        context_name: Optional[str] = None,
+    ):
+        entry = self.entries.get(key)
+        if entry is None:
+            return None
+
+        durations: Mapping[str, float] = entry['durations']
+        if context_name is None:
+            duration = sum(durations.values())
+        elif context_name in durations:
+            duration = durations[context_name]
+        else:
+            return None
+
+        if entry['content_hash'] != content_hash and entry['size'] > 0:
+            # The file has been changed, scale by size.
+            duration *= size / entry['size']
+
+        return duration
+
+    def estimate_cost(self, key: str, content_hash: str, size: int):
+        duration = self.get_scaled_duration(key, content_hash, size)
+        if duration is None:
+            # Fallback to the source size.
+            duration = size * self.get_seconds_per_byte()
+        return duration
+
+    def get_cpp_compiler_timeout(
+        self,
+        key: str,
+        content_hash: str,
+        size: int,
+        multiplier: float,
+        min_timeout: float,
+    ):
+        duration = self.get_scaled_duration(key, content_hash, size, 'cpp_compiler')
+        if duration is None:
+            return None
+        return max(min_timeout, multiplier * duration)
+
+    def record(
+        self,
+        key: str,
+        content_hash: str,
+        size: int,
+        durations: Mapping[str, float],
+    ):
+        self.removed_keys.discard(key)
+        self.updated_entries[key] = {
+            'content_hash': content_hash,
+            'size': size,
+            'durations': dict(durations),
+        }
+
+    def remove(self, key: str):
+        # E.g. the file timed out, the recorded durations are no longer representative.
+        self.updated_entries.pop(key, None)
+        self.removed_keys.add(key)
+
+    def save(self):
+        if not self.updated_entries and not self.removed_keys:
+            return
+
+        try:
+            self.history_fd.mkdir(exist_ok=True, parents=True)
+            with lock_file(self.history_fd / f'.{self.HISTORY_JSON}.lock'):
+                # Merge with the updates from other processes.
+                entries = self.load()
+                for key in self.removed_keys:
+                    entries.pop(key, None)
+                entries.update(self.updated_entries)
+
+                fd, temp_path = tempfile.mkstemp(dir=self.history_fd)
+                with os.fdopen(fd, 'w') as fout:
+                    json.dump(entries, fout, indent=2, sort_keys=True)
+                os.replace(temp_path, self.history_json)
+        except OSError:
+            # E.g. read-only or owned by another user, the history is advisory.
+            logger.warning(f'Failed to write {self.history_json}, ignored.', exc_info=True)
+            return
+
+        self.entries = entries
+        self.updated_entries = {}
+        self.removed_keys = set()
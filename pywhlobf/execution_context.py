@@ -4,6 +4,7 @@ import os
 import sys
 from contextlib import contextmanager
 import traceback
+import time
 
 
 class ExecutionContext:
@@ -14,6 +15,8 @@ class ExecutionContext:
         self.stderr_file = logging_fd / f'{context_name}_stderr.txt'
         self.executed = False
         self.succeeded = False
+        # In seconds.
+        self.elapsed = 0.0
 
     @contextmanager
     def guard(self):
@@ -24,6 +27,7 @@ class ExecutionContext:
             os.dup2(stdout_fout.fileno(), sys.stdout.fileno())
             os.dup2(stderr_fout.fileno(), sys.stderr.fileno())
 
+            begin = time.perf_counter()
             try:
                 self.executed = True
                 yield
@@ -33,6 +37,7 @@ class ExecutionContext:
                 stderr_fout.write('\n')
                 stderr_fout.write(traceback.format_exc())
                 self.succeeded = False
+            self.elapsed = time.perf_counter() - begin
 
             os.dup2(prev_stdout_fileno, sys.stdout.fileno())
             os.dup2(prev_stderr_fileno, sys.stderr.fileno())
@@ -40,7 +45,7 @@ class ExecutionContext:
     def get_logging_message(self, verbose: bool):
         lines = [(
             f'# ExecutionContext: {self.context_name} '
-            f'executed={self.executed}, succeeded={self.succeeded}'
+            f'executed={self.executed}, succeeded={self.succeeded}, elapsed={self.elapsed:.3f}s'
         )]
 
         if self.executed:
@@ -86,6 +91,13 @@ class ExecutionContextCollection:
 
         self.execution_contexts.append(execution_context)
 
+    def get_elapsed_by_context_name(self):
+        return {
+            execution_context.context_name: execution_context.elapsed
+            for execution_context in self.execution_contexts
+            if execution_context.executed
+        }
+
     def get_logging_message(self):
         lines = []
         for execution_context in self.execution_contexts:
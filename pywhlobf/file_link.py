@@ -0,0 +1,87 @@
+from typing import Iterable, Optional, Tuple
+from enum import unique, Enum
+from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
+import os
+import shutil
+import sys
+
+if sys.platform.startswith('linux'):
+    import fcntl
+else:
+    fcntl = None
+
+# From `linux/fs.h`.
+FICLONE = 0x40049409
+
+
+@unique
+class FileLinkStrategy(Enum):
+    # Always copy.
+    COPY = 'copy'
+    # Try hard link, then reflink, then copy.
+    # NOTE: The hard linked output shares the content with the input, don't modify it inplace.
+    LINK = 'link'
+    # Try reflink (copy-on-write, e.g. Btrfs or XFS), then copy.
+    REFLINK = 'reflink'
+
+
+def reflink_file(src: Path, dst: Path):
+    if fcntl is None:
+        raise OSError('Reflink is not supported on this platform.')
+    with src.open('rb') as fin, dst.open('wb') as fout:
+        try:
+            fcntl.ioctl(fout.fileno(), FICLONE, fin.fileno())
+        except OSError:
+            fout.close()
+            dst.unlink()
+            raise
+
+
+def link_file(src: Path, dst: Path, strategy: FileLinkStrategy = FileLinkStrategy.COPY):
+    '''
+    Make `dst` a file with the content of `src`, replacing the existing one.
+    '''
+    # Never write through an existing hard link.
+    dst.unlink(missing_ok=True)
+
+    if strategy != FileLinkStrategy.COPY:
+        if strategy == FileLinkStrategy.LINK:
+            try:
+                os.link(src, dst)
+                return
+            except OSError:
+                # Cross device, or not supported by the filesystem.
+                pass
+
+        try:
+            reflink_file(src, dst)
+            return
+        except OSError:
+            pass
+
+    shutil.copyfile(src, dst)
+
+
+def link_files(
+    src_dst_pairs: Iterable[Tuple[Path, Path]],
+    strategy: FileLinkStrategy = FileLinkStrategy.COPY,
+    num_threads: Optional[int] = None,
+):
+    src_dst_pairs = list(src_dst_pairs)
+
+    for dst_fd in sorted({dst.parent for _, dst in src_dst_pairs}):
+        dst_fd.mkdir(exist_ok=True, parents=True)
+
+    if len(src_dst_pairs) <= 1:
+        for src, dst in src_dst_pairs:
+            link_file(src, dst, strategy)
+        return
+
+    # The file I/O releases the GIL.
+    with ThreadPoolExecutor(max_workers=num_threads or min(32, (os.cpu_count() or 1) + 4)) \
+            as executor:
+        for future in [
+            executor.submit(link_file, src, dst, strategy) for src, dst in src_dst_pairs
+        ]:
+            future.result()
@@ -1,19 +1,47 @@
-from typing import Sequence, Optional, List, Callable, Set
+from typing import (
+    Sequence, Optional, List, Callable, Set, Iterable, Deque, Mapping, Dict, Any, Tuple
+)
 from pathlib import Path
+import os
 import tempfile
 import functools
-from concurrent.futures import ProcessPoolExecutor
-import shutil
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, Future, wait, FIRST_COMPLETED
 import logging
+import multiprocessing
+import time
+import copy
+import shlex
+import subprocess
+import json
 
 import attrs
+import cattrs
 import iolite as io
+from setuptools import Extension
 
 from .code_file_processor import (
     CodeFileProcessorConfig,
     CodeFileProcessorOutput,
+    CodeFileProcessorIntermediateOutput,
     CodeFileProcessor,
 )
+from .component.cpp_compiler import (
+    CppCompilerPgoStage,
+    CppCompilerTargetConfig,
+    CompiledLibSizeReport,
+    CppCompiler,
+)
+from .artifact_cache import compute_artifact_cache_key
+from .cost_history import CostHistory, get_default_cost_history_fd
+from .build_manifest import CodeFileDependencyResolver, BuildManifest
+from .execution_context import ExecutionContextCollection
+from .file_link import FileLinkStrategy, link_files
+from .unity_build import (
+    UnityBuildModule,
+    generate_unity_build_bootstrap_code,
+    merge_link_args,
+)
 
 logger = logging.getLogger(__name__)
 
@@ -31,17 +59,70 @@ class PackageFolderProcessorConfig:
     bypass_py_file_patterns: Sequence[str] = ()
     delete_processed_code_file: bool = True
     num_processes: Optional[int] = None
+    # The start method of the worker processes (`fork`, `spawn` or `forkserver`), default to the
+    # platform default.
+    process_start_method: Optional[str] = None
     reset_output_fd: bool = False
+    # If enabled, cythonize and the C++ transforms run in `num_cpp_generator_processes` workers,
+    # streaming the generated C++ files to `num_cpp_compiler_processes` compiler workers
+    # through a queue bounded by `pipeline_queue_size`.
+    # `num_cpp_compiler_processes` defaults to `num_processes` or the number of CPUs,
+    # `num_cpp_generator_processes` defaults to a quarter of that,
+    # and `pipeline_queue_size` defaults to twice of `num_cpp_compiler_processes`.
+    enable_pipeline: bool = False
+    num_cpp_generator_processes: Optional[int] = None
+    num_cpp_compiler_processes: Optional[int] = None
+    pipeline_queue_size: Optional[int] = None
+    # If enabled, the per-file stage durations are recorded to `cost_history_folder`
+    # (default to the artifact cache folder, or `$XDG_CACHE_HOME/pywhlobf`), and the most expensive
+    # files are dispatched first. The entries are keyed by the package, the relative path and the
+    # compiler config. The C++ compilation timeout of a file with recorded duration is derived
+    # from the history, which only extends `setup_build_ext_timeout`. The entry of a failed file
+    # is dropped. The history is advisory, failing to read or write it doesn't fail the build.
+    enable_cost_history: bool = False
+    cost_history_folder: Optional[str] = None
+    cost_history_timeout_multiplier: float = 5.0
+    cost_history_min_timeout: float = 30.0
+    # If enabled, all the processed modules are linked into `__init__<EXT_SUFFIX>` of the
+    # package, which installs a meta path finder to resolve the submodules on import.
+    # Requires the DIRECT backend and the package `__init__.py` to be processed.
+    enable_unity_build: bool = False
+    # If `pgo_workload_command` is set, build in two passes for profile-guided optimization.
+    # The instrumented package is built first, then the workload command runs with the
+    # instrumented package prepended to `PYTHONPATH`, and finally the C++ files of the first
+    # pass are compiled again with the collected profiles.
+    # Requires the DIRECT backend with GCC or Clang (`llvm-profdata` or `$LLVM_PROFDATA`).
+    pgo_workload_command: Sequence[str] = ()
+    pgo_workload_timeout: float = 600.0
+    # How the files are brought into the output folder (and the `__init__.*` files into the
+    # build folder), with the file I/O in `num_io_threads` threads.
+    file_link_strategy: FileLinkStrategy = FileLinkStrategy.COPY
+    num_io_threads: Optional[int] = None
+    # If enabled, the working folder is kept across runs, along with a manifest of the compiled
+    # libraries. On a rerun, only the code files with changes in the content, the dependencies
+    # (`.pxd` and `.pxi` files), the config or the toolchain are processed again.
+    # Doesn't work with the unity build, PGO or multiple targets.
+    enable_incremental: bool = False
 
 
 @attrs.define
 class PackageFolderProcessorOutput:
     succeeded_outputs: Sequence[CodeFileProcessorOutput]
     failed_outputs: Sequence[CodeFileProcessorOutput]
+    # The package level stages, e.g. the unity build and the PGO workload.
+    execution_context_collection: Optional[ExecutionContextCollection] = None
+    unity_build_lib_file: Optional[Path] = None
+    # Keyed by the path of the compiled library relative to the package folder.
+    compiled_lib_size_reports: Mapping[str, CompiledLibSizeReport] = attrs.field(factory=dict)
 
     @property
     def succeeded(self):
-        return (not self.failed_outputs)
+        return (
+            not self.failed_outputs and (
+                self.execution_context_collection is None
+                or self.execution_context_collection.succeeded
+            )
+        )
 
     def get_logging_message(self, verbose: bool = False):
         logging_messages: List[str] = []
@@ -59,24 +140,161 @@ class PackageFolderProcessorOutput:
                 failed_output.execution_context_collection.get_logging_message()
             )
 
+        collection = self.execution_context_collection
+        if collection and collection.execution_contexts and (verbose or not collection.succeeded):
+            logging_messages.append('Package log:')
+            logging_messages.append(collection.get_logging_message())
+
+        if verbose and self.compiled_lib_size_reports:
+            logging_messages.append('Size report (before strip -> after strip, in bytes):')
+            for rel_path, size_report in sorted(self.compiled_lib_size_reports.items()):
+                logging_messages.append(
+                    f'  {rel_path}: {size_report.before_strip} -> {size_report.after_strip}'
+                )
+
         return '\n'.join(logging_messages)
 
 
+@attrs.define
+class PreparedPackageFolder:
+    # The state shared by the targets.
+    working_fd: Path
+    build_fd: Path
+    logging_fd: Path
+    excluded_files: Set[Path]
+    included_tbd_py_files: List[Path]
+    # Extra keyword arguments passed to `CodeFileProcessor.run*` for each file.
+    py_file_kwargs: Dict[Path, Dict[str, Any]]
+    unity_build_modules: List[UnityBuildModule]
+    cost_history: Optional[CostHistory]
+    # Keyed by the code file, if `cost_history` is set.
+    cost_history_keys: Dict[Path, str]
+    # The outputs of the previous runs reused in the incremental build.
+    reused_outputs: List[CodeFileProcessorOutput] = attrs.field(factory=list)
+    build_manifest: Optional[BuildManifest] = None
+    # Keyed by the code file, only in the incremental build.
+    build_manifest_keys: Dict[Path, str] = attrs.field(factory=dict)
+
+
+def create_process_pool(max_workers: Optional[int], start_method: Optional[str]):
+    return ProcessPoolExecutor(
+        max_workers=max_workers,
+        mp_context=multiprocessing.get_context(start_method),
+    )
+
+
 def process_py_file(
     num_processes: Optional[int],
-    func_process_py_file: Callable[[Path], CodeFileProcessorOutput],
+    func_process_py_file: Callable[..., CodeFileProcessorOutput],
     py_files: Sequence[Path],
+    py_file_kwargs: Mapping[Path, Mapping[str, Any]],
+    start_method: Optional[str] = None,
 ):
     if num_processes != 0:
         # NOTE: multiprocessing.Pool creates daemonic process, which is unsuitable.
-        with ProcessPoolExecutor(max_workers=num_processes) as pool:
-            yield from pool.map(
-                func_process_py_file,
-                py_files,
-            )
+        with create_process_pool(num_processes, start_method) as pool:
+            # Dispatched in order.
+            futures = [
+                pool.submit(
+                    func_process_py_file,
+                    py_file,
+                    **py_file_kwargs.get(py_file, {}),
+                ) for py_file in py_files
+            ]
+            for future in futures:
+                yield future.result()
     else:
         for py_file in py_files:
-            yield func_process_py_file(py_file)
+            yield func_process_py_file(py_file, **py_file_kwargs.get(py_file, {}))
+
+
+def process_py_file_pipelined(
+    num_cpp_generator_processes: int,
+    num_cpp_compiler_processes: int,
+    pipeline_queue_size: int,
+    func_generate: Callable[..., CodeFileProcessorIntermediateOutput],
+    func_compile: Callable[[CodeFileProcessorIntermediateOutput], CodeFileProcessorOutput],
+    py_files: Iterable[Path],
+    py_file_kwargs: Mapping[Path, Mapping[str, Any]],
+    start_method: Optional[str] = None,
+):
+    py_files_iter = iter(py_files)
+    py_files_exhausted = False
+
+    # The bounded queue between the two stages.
+    queue: Deque[CodeFileProcessorIntermediateOutput] = deque()
+
+    generate_futures: Set[Future[CodeFileProcessorIntermediateOutput]] = set()
+    compile_futures: Set[Future[CodeFileProcessorOutput]] = set()
+
+    with create_process_pool(num_cpp_generator_processes, start_method) as generator_pool, \
+            create_process_pool(num_cpp_compiler_processes, start_method) as compiler_pool:
+        while True:
+            # Back-pressure: stop generating if the queue is full.
+            while not py_files_exhausted \
+                    and len(generate_futures) < num_cpp_generator_processes \
+                    and len(queue) < pipeline_queue_size:
+                py_file = next(py_files_iter, None)
+                if py_file is None:
+                    py_files_exhausted = True
+                    break
+                generate_futures.add(
+                    generator_pool.submit(
+                        func_generate,
+                        py_file,
+                        **py_file_kwargs.get(py_file, {}),
+                    )
+                )
+
+            while queue and len(compile_futures) < num_cpp_compiler_processes:
+                compile_futures.add(compiler_pool.submit(func_compile, queue.popleft()))
+
+            if not generate_futures and not compile_futures:
+                assert py_files_exhausted and not queue
+                break
+
+            done_futures, _ = wait(
+                (*generate_futures, *compile_futures),
+                return_when=FIRST_COMPLETED,
+            )
+            for future in done_futures:
+                if future in generate_futures:
+                    generate_futures.remove(future)  # type: ignore
+                    intermediate_output: CodeFileProcessorIntermediateOutput = \
+                        future.result()  # type: ignore
+                    if intermediate_output.should_compile:
+                        queue.append(intermediate_output)
+                    else:
+                        # Failed or hit the cache.
+                        yield intermediate_output.to_output()
+                else:
+                    compile_futures.remove(future)  # type: ignore
+                    yield future.result()  # type: ignore
+
+
+def process_intermediate_output(
+    num_processes: Optional[int],
+    func_compile: Callable[[CodeFileProcessorIntermediateOutput], CodeFileProcessorOutput],
+    intermediate_outputs: Sequence[CodeFileProcessorIntermediateOutput],
+    start_method: Optional[str] = None,
+):
+    if num_processes != 0:
+        with create_process_pool(num_processes, start_method) as pool:
+            yield from pool.map(func_compile, intermediate_outputs)
+    else:
+        for intermediate_output in intermediate_outputs:
+            yield func_compile(intermediate_output)
+
+
+def split_outputs(outputs: Iterable[CodeFileProcessorOutput]):
+    succeeded_outputs: List[CodeFileProcessorOutput] = []
+    failed_outputs: List[CodeFileProcessorOutput] = []
+    for output in outputs:
+        if output.succeeded:
+            succeeded_outputs.append(output)
+        else:
+            failed_outputs.append(output)
+    return succeeded_outputs, failed_outputs
 
 
 class PackageFolderProcessor:
@@ -85,19 +303,200 @@ class PackageFolderProcessor:
         self.config = config
         self.code_file_processor = CodeFileProcessor(config.code_file_processor_config)
 
-    def run(
+    def get_cost_history_fd(self):
+        if self.config.cost_history_folder:
+            return Path(self.config.cost_history_folder).expanduser().absolute()
+
+        artifact_cache_config = self.config.code_file_processor_config.artifact_cache_config
+        if artifact_cache_config.cache_folder:
+            return Path(artifact_cache_config.cache_folder).expanduser().absolute()
+
+        return get_default_cost_history_fd()
+
+    def get_cost_history_config_hash(
+        self,
+        cpp_compiler_targets: Sequence[CppCompilerTargetConfig] = (),
+    ):
+        # The durations depend on the compiler config, e.g. the build profile.
+        return compute_artifact_cache_key(
+            json.dumps(
+                cattrs.unstructure(self.config.code_file_processor_config.cpp_compiler_config),
+                sort_keys=True,
+            ),
+            json.dumps(
+                [cattrs.unstructure(target) for target in cpp_compiler_targets],
+                sort_keys=True,
+            ),
+        )
+
+    def create_code_file_processor(self, **cpp_compiler_config_changes: Any):
+        code_file_processor_config = self.config.code_file_processor_config
+        return CodeFileProcessor(
+            attrs.evolve(
+                code_file_processor_config,
+                cpp_compiler_config=attrs.evolve(
+                    code_file_processor_config.cpp_compiler_config,
+                    **cpp_compiler_config_changes,
+                ),
+            )
+        )
+
+    def run_unity_build(
         self,
+        cpp_compiler: CppCompiler,
         input_fd: Path,
-        output_fd: Optional[Path] = None,
-        working_fd: Optional[Path] = None,
+        build_fd: Path,
+        unity_build_modules: Sequence[UnityBuildModule],
+        succeeded_outputs: Sequence[CodeFileProcessorOutput],
+        execution_context_collection: ExecutionContextCollection,
+        context_name: str = 'unity_build',
+    ):
+        compiled_lib_file = None
+        with execution_context_collection.guard(context_name) as should_run:
+            if should_run:
+                root_module = None
+                modules: List[UnityBuildModule] = []
+                for module in unity_build_modules:
+                    if module.name == input_fd.name:
+                        root_module = module
+                    else:
+                        modules.append(module)
+                assert root_module and root_module.is_package, \
+                    'The package __init__.py should be processed in the unity build.'
+
+                unity_build_fd = build_fd / input_fd.name
+                bootstrap_cpp_file = unity_build_fd / 'pywhlobf_unity.cpp'
+                bootstrap_cpp_file.write_text(
+                    generate_unity_build_bootstrap_code(root_module, modules)
+                )
+
+                object_files: List[Path] = []
+                ext_modules: List[Extension] = []
+                for succeeded_output in succeeded_outputs:
+                    assert succeeded_output.compiled_object_file and succeeded_output.ext_module
+                    object_files.append(succeeded_output.compiled_object_file)
+                    ext_modules.append(succeeded_output.ext_module)
+
+                ext_module = merge_link_args(
+                    name=input_fd.name,
+                    sources=[str(bootstrap_cpp_file)],
+                    ext_modules=ext_modules,
+                )
+                cpp_compiler.configure_ext_module(
+                    ext_module=ext_module,
+                    include_fds=[],
+                    string_literal_obfuscator_activated=False,
+                    source_code_injector_activated=False,
+                    working_fd=build_fd,
+                )
+                toolchain = cpp_compiler.get_direct_toolchain()
+                bootstrap_object_file = cpp_compiler.compile_object(
+                    toolchain=toolchain,
+                    ext_module=ext_module,
+                    working_fd=build_fd,
+                    precompiled_header_codes=(),
+                    deadline=time.monotonic() + cpp_compiler.config.setup_build_ext_timeout,
+                )
+                compiled_lib_file = cpp_compiler.link(
+                    ext_module=ext_module,
+                    object_files=[bootstrap_object_file, *object_files],
+                    compiled_lib_file=(
+                        unity_build_fd / ('__init__' + cpp_compiler.get_ext_suffix(toolchain))
+                    ),
+                )
+
+        return compiled_lib_file
+
+    def assemble_output(
+        self,
+        input_fd: Path,
+        output_fd: Optional[Path],
+        excluded_files: Set[Path],
+        succeeded_outputs: Sequence[CodeFileProcessorOutput],
+        unity_build_lib_file: Optional[Path],
+    ):
+        src_dst_pairs: List[Tuple[Path, Path]] = []
+
+        if output_fd is None:
+            for file in excluded_files:
+                file.unlink()
+            output_fd = input_fd
+            if self.config.delete_processed_code_file:
+                for succeeded_output in succeeded_outputs:
+                    succeeded_output.py_file.unlink()
+        else:
+            output_fd = io.folder(
+                output_fd,
+                touch=True,
+                reset=self.config.reset_output_fd,
+            )
+            # Skip the files not surviving into the output.
+            skipped_files = set(excluded_files)
+            if self.config.delete_processed_code_file:
+                skipped_files.update(
+                    succeeded_output.py_file for succeeded_output in succeeded_outputs
+                )
+            for input_file in input_fd.glob('**/*'):
+                if input_file in skipped_files or not input_file.is_file():
+                    continue
+                src_dst_pairs.append((input_file, output_fd / input_file.relative_to(input_fd)))
+
+            if self.config.delete_processed_code_file:
+                # Stale output from previous runs.
+                for succeeded_output in succeeded_outputs:
+                    output_py_file = output_fd / succeeded_output.py_file.relative_to(input_fd)
+                    output_py_file.unlink(missing_ok=True)
+
+        if unity_build_lib_file:
+            src_dst_pairs.append(
+                (unity_build_lib_file, output_fd / unity_build_lib_file.name)
+            )
+        else:
+            for succeeded_output in succeeded_outputs:
+                output_py_file = output_fd / succeeded_output.py_file.relative_to(input_fd)
+                compiled_lib_file = succeeded_output.compiled_lib_file
+                assert compiled_lib_file
+                src_dst_pairs.append(
+                    (compiled_lib_file, output_py_file.parent / compiled_lib_file.name)
+                )
+
+        link_files(
+            src_dst_pairs,
+            strategy=self.config.file_link_strategy,
+            num_threads=self.config.num_io_threads,
+        )
+
+        return output_fd
+
+    def run_pgo_workload(self, input_fd: Path, instrumented_fd: Path):
+        env = os.environ.copy()
+        # The instrumented package shadows the input package.
+        pythonpaths = [str(instrumented_fd.parent), str(input_fd.parent)]
+        if env.get('PYTHONPATH'):
+            pythonpaths.append(env['PYTHONPATH'])
+        env['PYTHONPATH'] = os.pathsep.join(pythonpaths)
+        env['PYWHLOBF_PGO_PACKAGE_FOLDER'] = str(instrumented_fd)
+
+        print('Running', shlex.join(self.config.pgo_workload_command), flush=True)
+        subprocess.run(
+            list(self.config.pgo_workload_command),
+            env=env,
+            timeout=self.config.pgo_workload_timeout,
+            check=True,
+        )
+
+    def prepare(
+        self,
+        input_fd: Path,
+        working_fd: Optional[Path],
+        cpp_compiler_targets: Sequence[CppCompilerTargetConfig] = (),
     ):
-        '''
-        `input_fd` should be a regular package.
-        See https://docs.python.org/3/glossary.html#term-regular-package
-        '''
         # Prepare the working folder.
         if working_fd is None:
             working_fd = io.folder(tempfile.mkdtemp(), exists=True)
+        elif self.config.enable_incremental:
+            # Keep the work of the previous runs.
+            working_fd = io.folder(working_fd, touch=True)
         else:
             working_fd = io.folder(working_fd, reset=True)
 
@@ -107,14 +506,26 @@ class PackageFolderProcessor:
         logging_fd = working_fd / 'l'
 
         # Copy __init__.* to the build folder, which is required by build_ext.
-        for init_py_file in input_fd.glob('**/__init__.*'):
+        # Also the `.pxd` and the `.pxi` files, which are required by cimport and include.
+        init_src_dst_pairs: List[Tuple[Path, Path]] = []
+        init_files: Set[Path] = set()
+        for pattern in ('**/__init__.*', '**/*.pxd', '**/*.pxi'):
+            init_files.update(input_fd.glob(pattern))
+        for init_file in sorted(init_files):
             _, _, cpp_generator_working_fd = CodeFileProcessor.prep_fds(
-                py_file=init_py_file,
+                py_file=init_file,
                 build_fd=build_fd,
                 logging_fd=logging_fd,
                 py_root_fd=input_fd,
             )
-            shutil.copyfile(init_py_file, cpp_generator_working_fd / init_py_file.name)
+            init_src_dst_pairs.append(
+                (init_file, cpp_generator_working_fd / init_file.name)
+            )
+        link_files(
+            init_src_dst_pairs,
+            strategy=self.config.file_link_strategy,
+            num_threads=self.config.num_io_threads,
+        )
 
         # Collect code files to process.
         excluded_files: Set[Path] = set()
@@ -148,63 +559,507 @@ class PackageFolderProcessor:
         for included_tbd_py_file in sorted(included_tbd_py_files):
             logger.info(f'  {included_tbd_py_file.relative_to(input_fd)}')
 
-        # Process.
-        logger.info('Processing...')
-        outputs = process_py_file(
-            num_processes=self.config.num_processes,
-            func_process_py_file=functools.partial(
-                self.code_file_processor.run,
-                build_fd=build_fd,
-                logging_fd=logging_fd,
-                py_root_fd=input_fd,
-            ),
-            py_files=included_tbd_py_files,
+        # Extra keyword arguments passed to `CodeFileProcessor.run*` for each file.
+        py_file_kwargs: Dict[Path, Dict[str, Any]] = {
+            py_file: {} for py_file in included_tbd_py_files
+        }
+
+        # The cached and the incremental builds are invalidated by the changed dependencies.
+        artifact_cache_config = self.config.code_file_processor_config.artifact_cache_config
+        if self.config.enable_incremental or artifact_cache_config.cache_folder:
+            dependency_resolver = CodeFileDependencyResolver(input_fd)
+            for py_file in included_tbd_py_files:
+                dependency_hash = dependency_resolver.compute_dependency_hash(py_file)
+                if dependency_hash:
+                    py_file_kwargs[py_file]['dependency_hash'] = dependency_hash
+
+        reused_outputs: List[CodeFileProcessorOutput] = []
+        build_manifest = None
+        build_manifest_keys: Dict[Path, str] = {}
+        if self.config.enable_incremental:
+            build_manifest = BuildManifest(working_fd)
+            code_file_processor = self.code_file_processor
+
+            changed_py_files: List[Path] = []
+            for py_file in included_tbd_py_files:
+                key = code_file_processor.get_lib_level_cache_key(
+                    code_file_processor.get_cpp_level_cache_key(
+                        py_file,
+                        input_fd,
+                        py_file_kwargs[py_file].get('dependency_hash'),
+                    )
+                )
+                build_manifest_keys[py_file] = key
+
+                entry = build_manifest.get(str(py_file.relative_to(input_fd)), key)
+                if entry is None:
+                    changed_py_files.append(py_file)
+                    continue
+
+                _, py_file_logging_fd, _ = CodeFileProcessor.prep_fds(
+                    py_file=py_file,
+                    build_fd=build_fd,
+                    logging_fd=logging_fd,
+                    py_root_fd=input_fd,
+                )
+                compiled_lib_size_report = None
+                if entry['metadata'].get('compiled_lib_size_report'):
+                    compiled_lib_size_report = cattrs.structure(
+                        entry['metadata']['compiled_lib_size_report'],
+                        CompiledLibSizeReport,
+                    )
+                reused_outputs.append(
+                    CodeFileProcessorOutput(
+                        py_file=py_file,
+                        compiled_lib_file=build_manifest.get_compiled_lib_file(entry),
+                        execution_context_collection=ExecutionContextCollection(
+                            logging_fd=py_file_logging_fd,
+                            verbose=self.config.code_file_processor_config.verbose,
+                        ),
+                        compiled_lib_size_report=compiled_lib_size_report,
+                    )
+                )
+
+            logger.info(
+                f'Incremental build: {len(changed_py_files)} changed, '
+                f'{len(reused_outputs)} reused.'
+            )
+            included_tbd_py_files = changed_py_files
+
+        unity_build_modules: List[UnityBuildModule] = []
+        if self.config.enable_unity_build:
+            # Indices follow the sorted module names.
+            for index, py_file in enumerate(
+                sorted(included_tbd_py_files, key=lambda path: path.relative_to(input_fd))
+            ):
+                unity_build_modules.append(
+                    UnityBuildModule.from_py_file(py_file, input_fd, index)
+                )
+                py_file_kwargs[py_file]['unity_build_index'] = index
+
+        # Dispatch the most expensive files first.
+        cost_history = None
+        cost_history_keys: Dict[Path, str] = {}
+        if self.config.enable_cost_history:
+            cost_history = CostHistory(self.get_cost_history_fd())
+            config_hash = self.get_cost_history_config_hash(cpp_compiler_targets)
+            # Never shorten the configured timeout.
+            min_timeout = max(
+                self.config.cost_history_min_timeout,
+                self.config.code_file_processor_config.cpp_compiler_config
+                .setup_build_ext_timeout,
+            )
+
+            costs: Dict[Path, float] = {}
+            for py_file in included_tbd_py_files:
+                key = '/'.join([
+                    config_hash[:16],
+                    input_fd.name,
+                    py_file.relative_to(input_fd).as_posix(),
+                ])
+                cost_history_keys[py_file] = key
+                content_hash = CostHistory.compute_content_hash(py_file)
+                size = py_file.stat().st_size
+                costs[py_file] = cost_history.estimate_cost(key, content_hash, size)
+
+                cpp_compiler_timeout = cost_history.get_cpp_compiler_timeout(
+                    key=key,
+                    content_hash=content_hash,
+                    size=size,
+                    multiplier=self.config.cost_history_timeout_multiplier,
+                    min_timeout=min_timeout,
+                )
+                if cpp_compiler_timeout is not None:
+                    py_file_kwargs[py_file]['cpp_compiler_timeout'] = cpp_compiler_timeout
+
+            included_tbd_py_files.sort(key=lambda py_file: costs[py_file], reverse=True)
+
+        return PreparedPackageFolder(
+            working_fd=working_fd,
+            build_fd=build_fd,
+            logging_fd=logging_fd,
+            excluded_files=excluded_files,
+            included_tbd_py_files=included_tbd_py_files,
+            py_file_kwargs=py_file_kwargs,
+            unity_build_modules=unity_build_modules,
+            cost_history=cost_history,
+            cost_history_keys=cost_history_keys,
+            reused_outputs=reused_outputs,
+            build_manifest=build_manifest,
+            build_manifest_keys=build_manifest_keys,
         )
 
-        succeeded_outputs: List[CodeFileProcessorOutput] = []
-        failed_outputs: List[CodeFileProcessorOutput] = []
-        for output in outputs:
-            if output.compiled_lib_file:
-                succeeded_outputs.append(output)
-            else:
-                failed_outputs.append(output)
+    def create_package_execution_context_collection(
+        self,
+        input_fd: Path,
+        prepared: PreparedPackageFolder,
+        name: Optional[str] = None,
+    ):
+        logging_fd = prepared.logging_fd / input_fd.name
+        if name:
+            logging_fd = logging_fd / name
+        return ExecutionContextCollection(
+            logging_fd=io.folder(logging_fd, touch=True),
+            verbose=self.config.code_file_processor_config.verbose,
+        )
 
-        # Post.
-        if not failed_outputs:
-            if output_fd is None:
-                for file in excluded_files:
-                    file.unlink()
-                output_fd = input_fd
-            else:
-                output_fd = io.folder(
-                    output_fd,
-                    touch=True,
-                    reset=self.config.reset_output_fd,
-                )
-                for input_file in input_fd.glob('**/*'):
-                    if not input_file.is_file():
-                        continue
-                    if input_file in excluded_files:
-                        continue
-                    output_file = output_fd / input_file.relative_to(input_fd)
-                    output_file.parent.mkdir(exist_ok=True, parents=True)
-                    shutil.copyfile(input_file, output_file)
+    def finalize(
+        self,
+        code_file_processor: CodeFileProcessor,
+        input_fd: Path,
+        output_fd: Optional[Path],
+        prepared: PreparedPackageFolder,
+        succeeded_outputs: List[CodeFileProcessorOutput],
+        failed_outputs: List[CodeFileProcessorOutput],
+        package_execution_context_collection: ExecutionContextCollection,
+        record_cost_history: bool = True,
+    ):
+        build_fd = prepared.build_fd
+        excluded_files = prepared.excluded_files
+        unity_build_modules = prepared.unity_build_modules
+        cost_history = prepared.cost_history if record_cost_history else None
 
-            if self.config.delete_processed_code_file:
-                for succeeded_output in succeeded_outputs:
-                    output_py_file = output_fd / succeeded_output.py_file.relative_to(input_fd)
-                    output_py_file.unlink()
+        unity_build_lib_file = None
+        if self.config.enable_unity_build and not failed_outputs \
+                and package_execution_context_collection.succeeded:
+            unity_build_lib_file = self.run_unity_build(
+                cpp_compiler=code_file_processor.cpp_compiler,
+                input_fd=input_fd,
+                build_fd=build_fd,
+                unity_build_modules=unity_build_modules,
+                succeeded_outputs=succeeded_outputs,
+                execution_context_collection=package_execution_context_collection,
+            )
 
+        compiled_lib_size_reports: Dict[str, CompiledLibSizeReport] = {}
+        if unity_build_lib_file:
+            with package_execution_context_collection.guard('cpp_stripper') as should_run:
+                if should_run:
+                    compiled_lib_size_reports[unity_build_lib_file.name] = \
+                        code_file_processor.cpp_compiler.strip(unity_build_lib_file)
+        else:
             for succeeded_output in succeeded_outputs:
-                output_py_file = output_fd / succeeded_output.py_file.relative_to(input_fd)
                 compiled_lib_file = succeeded_output.compiled_lib_file
-                assert compiled_lib_file
-                shutil.copyfile(
-                    compiled_lib_file,
-                    output_py_file.parent / compiled_lib_file.name,
-                )
+                size_report = succeeded_output.compiled_lib_size_report
+                if compiled_lib_file and size_report:
+                    rel_fd = succeeded_output.py_file.parent.relative_to(input_fd)
+                    compiled_lib_size_reports[str(rel_fd / compiled_lib_file.name)] = size_report
 
-        return PackageFolderProcessorOutput(
+        package_folder_processor_output = PackageFolderProcessorOutput(
             succeeded_outputs=succeeded_outputs,
             failed_outputs=failed_outputs,
+            execution_context_collection=package_execution_context_collection,
+            unity_build_lib_file=unity_build_lib_file,
+            compiled_lib_size_reports=compiled_lib_size_reports,
         )
+
+        reused_py_files = {reused_output.py_file for reused_output in prepared.reused_outputs}
+        if cost_history:
+            for succeeded_output in succeeded_outputs:
+                if succeeded_output.artifact_cache_level is not None \
+                        or succeeded_output.py_file in reused_py_files:
+                    # Not representative.
+                    continue
+                py_file = succeeded_output.py_file
+                cost_history.record(
+                    key=prepared.cost_history_keys[py_file],
+                    content_hash=CostHistory.compute_content_hash(py_file),
+                    size=py_file.stat().st_size,
+                    durations=succeeded_output.execution_context_collection
+                    .get_elapsed_by_context_name(),
+                )
+            for failed_output in failed_outputs:
+                # Might be timed out.
+                cost_history.remove(prepared.cost_history_keys[failed_output.py_file])
+            cost_history.save()
+
+        build_manifest = prepared.build_manifest
+        if build_manifest:
+            for succeeded_output in succeeded_outputs:
+                if succeeded_output.py_file in reused_py_files:
+                    continue
+                assert succeeded_output.compiled_lib_file
+                build_manifest.record(
+                    rel_path=str(succeeded_output.py_file.relative_to(input_fd)),
+                    key=prepared.build_manifest_keys[succeeded_output.py_file],
+                    compiled_lib_file=succeeded_output.compiled_lib_file,
+                    metadata={
+                        'compiled_lib_size_report':
+                            cattrs.unstructure(succeeded_output.compiled_lib_size_report),
+                    },
+                )
+            # Drop the removed code files.
+            build_manifest.save(
+                str(py_file.relative_to(input_fd)) for py_file in prepared.build_manifest_keys
+            )
+
+        # Post.
+        if package_folder_processor_output.succeeded:
+            self.assemble_output(
+                input_fd=input_fd,
+                output_fd=output_fd,
+                excluded_files=excluded_files,
+                succeeded_outputs=succeeded_outputs,
+                unity_build_lib_file=unity_build_lib_file,
+            )
+
+        return package_folder_processor_output
+
+    def run(
+        self,
+        input_fd: Path,
+        output_fd: Optional[Path] = None,
+        working_fd: Optional[Path] = None,
+    ):
+        '''
+        `input_fd` should be a regular package.
+        See https://docs.python.org/3/glossary.html#term-regular-package
+        '''
+        if self.config.enable_incremental \
+                and (self.config.enable_unity_build or self.config.pgo_workload_command):
+            raise NotImplementedError(
+                'The incremental build is not supported with the unity build or PGO.'
+            )
+
+        prepared = self.prepare(input_fd, working_fd)
+        working_fd = prepared.working_fd
+        build_fd = prepared.build_fd
+        logging_fd = prepared.logging_fd
+        excluded_files = prepared.excluded_files
+        included_tbd_py_files = prepared.included_tbd_py_files
+        py_file_kwargs = prepared.py_file_kwargs
+        unity_build_modules = prepared.unity_build_modules
+
+        package_execution_context_collection = \
+            self.create_package_execution_context_collection(input_fd, prepared)
+
+        # Process.
+        logger.info('Processing...')
+        code_file_processor = self.code_file_processor
+        if self.config.pgo_workload_command:
+            # The first pass.
+            pgo_fd = working_fd / 'p'
+            pgo_profile_fd = io.folder(pgo_fd / 'profile', touch=True)
+            code_file_processor = self.create_code_file_processor(
+                pgo_stage=CppCompilerPgoStage.GENERATE,
+                pgo_profile_folder=str(pgo_profile_fd),
+            )
+            intermediate_outputs: List[CodeFileProcessorIntermediateOutput] = list(
+                process_py_file(
+                    num_processes=self.config.num_processes,
+                    start_method=self.config.process_start_method,
+                    func_process_py_file=functools.partial(
+                        code_file_processor.run_generate,
+                        build_fd=build_fd,
+                        logging_fd=logging_fd,
+                        py_root_fd=input_fd,
+                    ),
+                    py_files=included_tbd_py_files,
+                    py_file_kwargs=py_file_kwargs,
+                )
+            )
+            succeeded_outputs, failed_outputs = split_outputs(
+                process_intermediate_output(
+                    num_processes=self.config.num_processes,
+                    start_method=self.config.process_start_method,
+                    func_compile=code_file_processor.run_compile,
+                    # Keep the intermediate outputs intact for the second pass.
+                    intermediate_outputs=copy.deepcopy(intermediate_outputs),
+                )
+            )
+
+            if not failed_outputs:
+                unity_build_lib_file = None
+                if self.config.enable_unity_build:
+                    unity_build_lib_file = self.run_unity_build(
+                        cpp_compiler=code_file_processor.cpp_compiler,
+                        input_fd=input_fd,
+                        build_fd=build_fd,
+                        unity_build_modules=unity_build_modules,
+                        succeeded_outputs=succeeded_outputs,
+                        execution_context_collection=package_execution_context_collection,
+                        context_name='pgo_generate_unity_build',
+                    )
+
+                with package_execution_context_collection.guard('pgo_workload') as should_run:
+                    if should_run:
+                        instrumented_fd = self.assemble_output(
+                            input_fd=input_fd,
+                            output_fd=io.folder(pgo_fd / 'i' / input_fd.name, reset=True),
+                            excluded_files=excluded_files,
+                            succeeded_outputs=succeeded_outputs,
+                            unity_build_lib_file=unity_build_lib_file,
+                        )
+                        self.run_pgo_workload(input_fd, instrumented_fd)
+
+                # The second pass, reusing the C++ files.
+                code_file_processor = self.create_code_file_processor(
+                    pgo_stage=CppCompilerPgoStage.USE,
+                    pgo_profile_folder=str(pgo_profile_fd),
+                )
+                with package_execution_context_collection.guard('pgo_merge') as should_run:
+                    if should_run:
+                        code_file_processor.cpp_compiler.merge_pgo_profiles()
+
+                if package_execution_context_collection.succeeded:
+                    succeeded_outputs, failed_outputs = split_outputs(
+                        process_intermediate_output(
+                            num_processes=self.config.num_processes,
+                            start_method=self.config.process_start_method,
+                            func_compile=code_file_processor.run_compile,
+                            intermediate_outputs=intermediate_outputs,
+                        )
+                    )
+
+        elif self.config.enable_pipeline and self.config.num_processes != 0:
+            num_cpp_compiler_processes = (
+                self.config.num_cpp_compiler_processes or self.config.num_processes
+                or os.cpu_count() or 1
+            )
+            num_cpp_generator_processes = (
+                self.config.num_cpp_generator_processes or max(1, num_cpp_compiler_processes // 4)
+            )
+            pipeline_queue_size = (
+                self.config.pipeline_queue_size or 2 * num_cpp_compiler_processes
+            )
+            succeeded_outputs, failed_outputs = split_outputs(
+                process_py_file_pipelined(
+                    num_cpp_generator_processes=num_cpp_generator_processes,
+                    num_cpp_compiler_processes=num_cpp_compiler_processes,
+                    pipeline_queue_size=pipeline_queue_size,
+                    start_method=self.config.process_start_method,
+                    func_generate=functools.partial(
+                        code_file_processor.run_generate,
+                        build_fd=build_fd,
+                        logging_fd=logging_fd,
+                        py_root_fd=input_fd,
+                    ),
+                    func_compile=code_file_processor.run_compile,
+                    py_files=included_tbd_py_files,
+                    py_file_kwargs=py_file_kwargs,
+                )
+            )
+
+        else:
+            succeeded_outputs, failed_outputs = split_outputs(
+                process_py_file(
+                    num_processes=self.config.num_processes,
+                    start_method=self.config.process_start_method,
+                    func_process_py_file=functools.partial(
+                        code_file_processor.run,
+                        build_fd=build_fd,
+                        logging_fd=logging_fd,
+                        py_root_fd=input_fd,
+                    ),
+                    py_files=included_tbd_py_files,
+                    py_file_kwargs=py_file_kwargs,
+                )
+            )
+
+        return self.finalize(
+            code_file_processor=code_file_processor,
+            input_fd=input_fd,
+            output_fd=output_fd,
+            prepared=prepared,
+            succeeded_outputs=[*prepared.reused_outputs, *succeeded_outputs],
+            failed_outputs=failed_outputs,
+            package_execution_context_collection=package_execution_context_collection,
+        )
+
+    def run_targets(
+        self,
+        input_fd: Path,
+        cpp_compiler_targets: Sequence[CppCompilerTargetConfig],
+        output_fds: Sequence[Path],
+        working_fd: Optional[Path] = None,
+    ):
+        '''
+        Cythonize and transform once, then compile for each of `cpp_compiler_targets`,
+        saving the output to the corresponding folder in `output_fds`.
+        '''
+        assert len(cpp_compiler_targets) == len(output_fds)
+        if self.config.pgo_workload_command:
+            raise NotImplementedError('PGO is not supported with multiple targets.')
+        if self.config.enable_incremental:
+            raise NotImplementedError(
+                'The incremental build is not supported with multiple targets.'
+            )
+        if self.config.code_file_processor_config.cpp_compiler_config.py_limited_api:
+            raise NotImplementedError(
+                'The limited API library is built once for all the targets, '
+                'unset the targets instead.'
+            )
+
+        prepared = self.prepare(input_fd, working_fd, cpp_compiler_targets)
+
+        # The LIB level cache is looked up by the compiler of each target.
+        intermediate_outputs: List[CodeFileProcessorIntermediateOutput] = list(
+            process_py_file(
+                num_processes=self.config.num_processes,
+                start_method=self.config.process_start_method,
+                func_process_py_file=functools.partial(
+                    self.code_file_processor.run_generate,
+                    build_fd=prepared.build_fd,
+                    logging_fd=prepared.logging_fd,
+                    py_root_fd=input_fd,
+                    enable_lib_level_cache=False,
+                ),
+                py_files=prepared.included_tbd_py_files,
+                py_file_kwargs=prepared.py_file_kwargs,
+            )
+        )
+
+        package_folder_processor_outputs: List[PackageFolderProcessorOutput] = []
+        for target_idx, (cpp_compiler_target, output_fd) in enumerate(
+            zip(cpp_compiler_targets, output_fds)
+        ):
+            logger.info(f'Compiling for cpp_compiler_target={cpp_compiler_target}')
+            target_name = f'target_{target_idx}'
+            package_execution_context_collection = \
+                self.create_package_execution_context_collection(input_fd, prepared, target_name)
+
+            code_file_processor = None
+            with package_execution_context_collection.guard('cpp_compiler_target') as should_run:
+                if should_run:
+                    code_file_processor = self.create_code_file_processor(
+                        target=cpp_compiler_target
+                    )
+
+            succeeded_outputs: List[CodeFileProcessorOutput] = []
+            failed_outputs: List[CodeFileProcessorOutput] = []
+            if code_file_processor:
+                # Keep the logs of the targets apart.
+                target_intermediate_outputs = copy.deepcopy(intermediate_outputs)
+                for intermediate_output in target_intermediate_outputs:
+                    collection = intermediate_output.execution_context_collection
+                    collection.logging_fd = io.folder(
+                        collection.logging_fd / target_name,
+                        touch=True,
+                    )
+
+                succeeded_outputs, failed_outputs = split_outputs(
+                    process_intermediate_output(
+                        num_processes=self.config.num_processes,
+                        start_method=self.config.process_start_method,
+                        func_compile=code_file_processor.run_compile,
+                        intermediate_outputs=target_intermediate_outputs,
+                    )
+                )
+            else:
+                code_file_processor = self.code_file_processor
+
+            package_folder_processor_outputs.append(
+                self.finalize(
+                    code_file_processor=code_file_processor,
+                    input_fd=input_fd,
+                    output_fd=output_fd,
+                    prepared=prepared,
+                    succeeded_outputs=succeeded_outputs,
+                    failed_outputs=failed_outputs,
+                    package_execution_context_collection=package_execution_context_collection,
+                    # Only the first target is recorded.
+                    record_cost_history=(target_idx == 0),
+                )
+            )
+
+        return package_folder_processor_outputs
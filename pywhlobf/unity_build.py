@@ -0,0 +1,251 @@
+from typing import Sequence, List
+from pathlib import Path
+
+import attrs
+from setuptools import Extension
+
+UNITY_BUILD_INIT_SYMBOL_PREFIX = 'PyInit_pywhlobf_unity_'
+
+
+def get_unity_build_init_symbol(index: int):
+    return f'{UNITY_BUILD_INIT_SYMBOL_PREFIX}{index}'
+
+
+@attrs.define
+class UnityBuildModule:
+    # The fully qualified module name, e.g. `pkg.sub.mod`.
+    name: str
+    is_package: bool
+    index: int
+
+    @classmethod
+    def from_py_file(cls, py_file: Path, py_root_fd: Path, index: int):
+        parts = [py_root_fd.name, *py_file.relative_to(py_root_fd).with_suffix('').parts]
+        is_package = (parts[-1] == '__init__')
+        if is_package:
+            parts.pop()
+        return cls(name='.'.join(parts), is_package=is_package, index=index)
+
+
+# Installed to `sys.meta_path` by the root package init function.
+# `_create` and `_exec` are provided by the bootstrap.
+UNITY_BUILD_FINDER_CODE = '''
+import sys
+import os.path
+from importlib.machinery import ModuleSpec
+
+
+class PywhlobfUnityFinder:
+
+    def __init__(self, root_name, modules):
+        self.pywhlobf_unity_root_name = root_name
+        self.modules = modules
+
+    def find_spec(self, fullname, path=None, target=None):
+        entry = self.modules.get(fullname)
+        if entry is None:
+            return None
+        index, is_package = entry
+
+        origin = sys.modules[self.pywhlobf_unity_root_name].__file__
+        spec = ModuleSpec(fullname, self, origin=origin, is_package=is_package)
+        spec.has_location = True
+        if is_package:
+            # Keep the data files and the bypassed modules reachable.
+            spec.submodule_search_locations = [
+                os.path.join(os.path.dirname(origin), *fullname.split('.')[1:])
+            ]
+        spec.loader_state = index
+        return spec
+
+    def create_module(self, spec):
+        return _create(spec, spec.loader_state)
+
+    def exec_module(self, module):
+        _exec(module, module.__spec__.loader_state)
+
+
+sys.meta_path[:] = [
+    finder for finder in sys.meta_path
+    if getattr(finder, 'pywhlobf_unity_root_name', None) != ROOT_NAME
+]
+sys.meta_path.insert(0, PywhlobfUnityFinder(ROOT_NAME, MODULES))
+'''
+
+UNITY_BUILD_BOOTSTRAP_CODE_TEMPLATE = '''
+/* Generated by pywhlobf unity build. */
+#ifndef PY_SSIZE_T_CLEAN
+#define PY_SSIZE_T_CLEAN
+#endif
+#include "Python.h"
+
+{init_function_declarations}
+
+typedef PyObject* (*pywhlobf_unity_init_function)(void);
+
+static pywhlobf_unity_init_function pywhlobf_unity_init_functions[] = {{
+{init_function_pointers}
+}};
+
+static const int pywhlobf_unity_num_modules = {num_modules};
+
+static PyModuleDef* pywhlobf_unity_get_def(int index) {{
+    if (index < 0 || index >= pywhlobf_unity_num_modules) {{
+        PyErr_SetString(PyExc_ImportError, "Invalid module index.");
+        return NULL;
+    }}
+    PyObject* def = pywhlobf_unity_init_functions[index]();
+    if (def == NULL) {{
+        return NULL;
+    }}
+    if (!PyObject_TypeCheck(def, &PyModuleDef_Type)) {{
+        PyErr_SetString(PyExc_ImportError, "Single-phase initialization is not supported.");
+        return NULL;
+    }}
+    return (PyModuleDef*)def;
+}}
+
+static PyObject* pywhlobf_unity_create(PyObject* self, PyObject* args) {{
+    PyObject* spec;
+    int index;
+    if (!PyArg_ParseTuple(args, "Oi", &spec, &index)) {{
+        return NULL;
+    }}
+    PyModuleDef* def = pywhlobf_unity_get_def(index);
+    if (def == NULL) {{
+        return NULL;
+    }}
+    return PyModule_FromDefAndSpec(def, spec);
+}}
+
+static PyObject* pywhlobf_unity_exec(PyObject* self, PyObject* args) {{
+    PyObject* module;
+    int index;
+    if (!PyArg_ParseTuple(args, "Oi", &module, &index)) {{
+        return NULL;
+    }}
+    PyModuleDef* def = pywhlobf_unity_get_def(index);
+    if (def == NULL) {{
+        return NULL;
+    }}
+    if (PyModule_ExecDef(module, def) < 0) {{
+        return NULL;
+    }}
+    Py_RETURN_NONE;
+}}
+
+static PyMethodDef pywhlobf_unity_methods[] = {{
+    {{"_create", pywhlobf_unity_create, METH_VARARGS, NULL}},
+    {{"_exec", pywhlobf_unity_exec, METH_VARARGS, NULL}},
+    {{NULL, NULL, 0, NULL}},
+}};
+
+static const char* pywhlobf_unity_finder_code = R"pywhlobf_unity(
+ROOT_NAME = {root_name}
+MODULES = {modules}
+{finder_code}
+)pywhlobf_unity";
+
+static int pywhlobf_unity_install_finder(void) {{
+    PyObject* globals = PyDict_New();
+    if (globals == NULL) {{
+        return -1;
+    }}
+    int ret = -1;
+    if (PyDict_SetItemString(globals, "__builtins__", PyEval_GetBuiltins()) < 0) {{
+        goto done;
+    }}
+    for (PyMethodDef* method = pywhlobf_unity_methods; method->ml_name != NULL; ++method) {{
+        PyObject* function = PyCFunction_New(method, NULL);
+        if (function == NULL) {{
+            goto done;
+        }}
+        int set_ret = PyDict_SetItemString(globals, method->ml_name, function);
+        Py_DECREF(function);
+        if (set_ret < 0) {{
+            goto done;
+        }}
+    }}
+    {{
+        // Avoid `PyRun_String`, which is not part of the limited API.
+        PyObject* code = Py_CompileString(
+            pywhlobf_unity_finder_code, "<pywhlobf_unity>", Py_file_input
+        );
+        if (code == NULL) {{
+            goto done;
+        }}
+        PyObject* result = PyEval_EvalCode(code, globals, globals);
+        Py_DECREF(code);
+        if (result == NULL) {{
+            goto done;
+        }}
+        Py_DECREF(result);
+    }}
+    ret = 0;
+done:
+    Py_DECREF(globals);
+    return ret;
+}}
+
+PyMODINIT_FUNC PyInit_{root_leaf_name}(void) {{
+    if (pywhlobf_unity_install_finder() < 0) {{
+        return NULL;
+    }}
+    return {root_init_symbol}();
+}}
+'''
+
+
+def generate_unity_build_bootstrap_code(
+    root_module: UnityBuildModule,
+    modules: Sequence[UnityBuildModule],
+):
+    '''
+    The bootstrap defines the init function of the root package, which installs a meta path
+    finder resolving the other modules to the renamed init functions in the same library.
+    '''
+    all_modules = sorted([root_module, *modules], key=lambda module: module.index)
+    assert [module.index for module in all_modules] == list(range(len(all_modules)))
+
+    init_function_declarations: List[str] = []
+    init_function_pointers: List[str] = []
+    for module in all_modules:
+        init_symbol = get_unity_build_init_symbol(module.index)
+        init_function_declarations.append(f'extern "C" PyObject* {init_symbol}(void);')
+        init_function_pointers.append(f'    {init_symbol},')
+
+    finder_modules = {
+        module.name: (module.index, module.is_package)
+        for module in modules
+    }
+
+    return UNITY_BUILD_BOOTSTRAP_CODE_TEMPLATE.format(
+        init_function_declarations='\n'.join(init_function_declarations),
+        init_function_pointers='\n'.join(init_function_pointers),
+        num_modules=len(all_modules),
+        root_name=repr(root_module.name),
+        modules=repr(finder_modules),
+        finder_code=UNITY_BUILD_FINDER_CODE,
+        root_leaf_name=root_module.name.split('.')[-1],
+        root_init_symbol=get_unity_build_init_symbol(root_module.index),
+    ).lstrip()
+
+
+def merge_link_args(name: str, sources: Sequence[str], ext_modules: Sequence[Extension]):
+    '''
+    Create the extension of the bootstrap, with the link arguments of all modules.
+    '''
+    merged = Extension(name=name, sources=list(sources), language='c++')
+    for ext_module in ext_modules:
+        for key in (
+            'extra_objects',
+            'library_dirs',
+            'runtime_library_dirs',
+            'libraries',
+            'extra_link_args',
+        ):
+            values: List[str] = getattr(merged, key)
+            for value in getattr(ext_module, key):
+                if value not in values:
+                    values.append(value)
+    return merged
@@ -1,21 +1,31 @@
 # pyright: reportUnboundVariable=false
-from typing import Optional, Sequence, List
+from typing import Optional, Sequence, List, Tuple
 from pathlib import Path
 import tempfile
 import zipfile
+import shutil
+import fnmatch
+from concurrent.futures import ThreadPoolExecutor
 import sys
 import logging
 
 import attrs
 import iolite as io
 from wheel.bdist_wheel import get_abi_tag, get_platform
-from wheel.wheelfile import WheelFile
 
 from .package_folder_processor import (
     PackageFolderProcessorConfig,
     PackageFolderProcessorOutput,
     PackageFolderProcessor,
 )
+from .component.cpp_compiler import CppCompilerTargetConfig, CppCompiler
+from .wheel_writer import (
+    WheelWriterConfig,
+    WheelWriter,
+    StreamingWheelWriter,
+    match_glob_pattern,
+    extract_members,
+)
 from .execution_context import ExecutionContextCollection
 
 logger = logging.getLogger(__name__)
@@ -26,6 +36,13 @@ class WheelFileProcessorConfig:
     package_folder_processor_config: PackageFolderProcessorConfig = attrs.field(
         factory=PackageFolderProcessorConfig
     )
+    # Cythonize once and produce one wheel per target, tagged accordingly.
+    cpp_compiler_targets: Sequence[CppCompilerTargetConfig] = ()
+    # If enabled, only the code files to be processed are extracted, and the other members are
+    # copied to the output wheel as is (compressed bytes and RECORD hashes) while processing.
+    enable_streaming: bool = False
+    # Compression of the output wheels.
+    wheel_writer_config: WheelWriterConfig = attrs.field(factory=WheelWriterConfig)
     verbose: bool = False
 
 
@@ -34,6 +51,8 @@ class WheelFileProcessorOutput:
     output_wheel_file: Optional[Path]
     package_folder_processor_outputs: Optional[Sequence[PackageFolderProcessorOutput]]
     execution_context_collection: ExecutionContextCollection
+    # One per target, if `cpp_compiler_targets` is set.
+    output_wheel_files: Sequence[Path] = ()
 
     @property
     def succeeded(self):
@@ -71,11 +90,12 @@ def generate_wheel_name(
     build_tag: Optional[str] = None,
     abi_tag: Optional[str] = None,
     platform_tag: Optional[str] = None,
+    python_tag: Optional[str] = None,
 ):
     '''
     See https://peps.python.org/pep-0425/
     '''
-    python_tag = 'cp' + ''.join(map(str, sys.version_info[:2]))
+    python_tag = python_tag or 'cp' + ''.join(map(str, sys.version_info[:2]))
 
     abi_tag = abi_tag or get_abi_tag()
     assert abi_tag
@@ -94,6 +114,15 @@ def generate_wheel_name(
     return '-'.join(components) + '.whl'
 
 
+def is_package_name(name: str):
+    # https://peps.python.org/pep-0427/#file-contents
+    return not name.endswith(('.dist-info', '.data'))
+
+
+def is_package_fd(fd: Path):
+    return fd.is_dir() and is_package_name(fd.name)
+
+
 class WheelFileProcessor:
 
     def __init__(self, config: WheelFileProcessorConfig):
@@ -101,6 +130,109 @@ class WheelFileProcessor:
         self.package_folder_processor = \
             PackageFolderProcessor(config.package_folder_processor_config)
 
+    def get_target_tags(self, cpp_compiler_target: CppCompilerTargetConfig):
+        cpp_compiler_config = self.config.package_folder_processor_config \
+            .code_file_processor_config.cpp_compiler_config
+        target = CppCompiler(attrs.evolve(cpp_compiler_config, target=cpp_compiler_target)).target
+        assert target
+        return target.python_tag, target.abi_tag
+
+    def generate_output_wheel_names(
+        self,
+        wheel_file: Path,
+        output_abi_tag: Optional[str],
+        output_platform_tag: Optional[str],
+    ):
+        (
+            distribution,
+            version,
+            build_tag,
+        ) = extract_components_from_wheel_file_stem(wheel_file.stem)
+        # The stable ABI wheel is tagged like `cp39-abi3`.
+        py_limited_api = self.config.package_folder_processor_config \
+            .code_file_processor_config.cpp_compiler_config.py_limited_api
+
+        if not self.config.cpp_compiler_targets:
+            tags = [(py_limited_api, None)]
+        else:
+            tags = [
+                self.get_target_tags(cpp_compiler_target)
+                for cpp_compiler_target in self.config.cpp_compiler_targets
+            ]
+
+        return [
+            generate_wheel_name(
+                distribution=distribution,
+                version=version,
+                build_tag=build_tag,
+                # NOTE: `py_limited_api` is rejected with the targets.
+                abi_tag=(output_abi_tag or abi_tag or ('abi3' if py_limited_api else None)),
+                platform_tag=output_platform_tag,
+                python_tag=python_tag,
+            ) for python_tag, abi_tag in tags
+        ]
+
+    def process_packages(
+        self,
+        input_fds: Sequence[Path],
+        working_fd: Path,
+        target_wheel_fds: Sequence[Path],
+        package_folder_processor: Optional[PackageFolderProcessor] = None,
+    ):
+        package_folder_processor = package_folder_processor or self.package_folder_processor
+        package_folder_processor_outputs: List[PackageFolderProcessorOutput] = []
+
+        for input_fd in input_fds:
+            logger.info(f'Processing input_fd={input_fd}')
+            if not self.config.cpp_compiler_targets:
+                package_folder_processor_outputs.append(
+                    package_folder_processor.run(
+                        input_fd=input_fd,
+                        working_fd=(working_fd / 'working' / input_fd.name),
+                    )
+                )
+            else:
+                package_folder_processor_outputs.extend(
+                    package_folder_processor.run_targets(
+                        input_fd=input_fd,
+                        cpp_compiler_targets=self.config.cpp_compiler_targets,
+                        output_fds=[
+                            target_wheel_fd / input_fd.name for target_wheel_fd in target_wheel_fds
+                        ],
+                        working_fd=(working_fd / 'working' / input_fd.name),
+                    )
+                )
+
+        for package_folder_processor_output in package_folder_processor_outputs:
+            if not package_folder_processor_output.succeeded:
+                raise RuntimeError('Failed to process code folder.')
+
+        return package_folder_processor_outputs
+
+    def is_materialized_member(self, zip_info: zipfile.ZipInfo):
+        parts = zip_info.filename.split('/')
+        if len(parts) < 2 or not is_package_name(parts[0]):
+            return False
+
+        config = self.config.package_folder_processor_config
+        if config.pgo_workload_command:
+            # The workload may need any file of the package.
+            return True
+
+        # Required in the build folder, see `PackageFolderProcessor.prepare`.
+        if any(
+            fnmatch.fnmatchcase(parts[-1], pattern)
+            for pattern in ('__init__.*', '*.pxd', '*.pxi')
+        ):
+            return True
+        rel_path = '/'.join(parts[1:])
+        return any(
+            match_glob_pattern(rel_path, pattern) for pattern in (
+                *config.include_py_file_patterns,
+                *config.exclude_file_patterns,
+            )
+        )
+
     def run(
         self,
         wheel_file: Path,
@@ -108,12 +240,32 @@ class WheelFileProcessor:
         output_platform_tag: Optional[str] = None,
         working_fd: Optional[Path] = None,
     ):
+        py_limited_api = self.config.package_folder_processor_config \
+            .code_file_processor_config.cpp_compiler_config.py_limited_api
+        if self.config.cpp_compiler_targets and py_limited_api:
+            # Otherwise one `cp3X-cp3X` wheel per target instead of one `cp3Y-abi3` wheel.
+            raise NotImplementedError(
+                'The limited API wheel is built once for all the targets, '
+                'unset the targets instead.'
+            )
+
         # Prepare the working folder.
         if working_fd is None:
             working_fd = io.folder(tempfile.mkdtemp(), exists=True)
+        elif self.config.package_folder_processor_config.enable_incremental:
+            # Keep the working folders of the packages.
+            working_fd = io.folder(working_fd, touch=True)
         else:
             working_fd = io.folder(working_fd, reset=True)
 
+        if self.config.enable_streaming:
+            return self.run_streaming(
+                wheel_file=wheel_file,
+                output_abi_tag=output_abi_tag,
+                output_platform_tag=output_platform_tag,
+                working_fd=working_fd,
+            )
+
         logging_fd = io.folder(working_fd / 'logging', touch=True)
 
         execution_context_collection = ExecutionContextCollection(
@@ -124,61 +276,192 @@ class WheelFileProcessor:
         with execution_context_collection.guard('unzip_wheel') as should_run:
             assert should_run
             # Unzip wheel.
-            wheel_fd = io.folder(working_fd / 'wheel', touch=True)
+            wheel_fd = io.folder(working_fd / 'wheel', reset=True)
             logger.info(f'Unzip wheel_file={wheel_file} to wheel_fd={wheel_fd}')
             assert wheel_file.is_file()
             with zipfile.ZipFile(wheel_file) as zip_file:
                 zip_file.extractall(wheel_fd)
 
+        target_wheel_fds = [
+            working_fd / f'wheel_{target_idx}'
+            for target_idx in range(len(self.config.cpp_compiler_targets))
+        ]
+
         package_folder_processor_outputs: Optional[List[PackageFolderProcessorOutput]] = None
         with execution_context_collection.guard('process_wheel') as should_run:
             if should_run:
-                # Process.
-                package_folder_processor_outputs = []
-                # https://peps.python.org/pep-0427/#file-contents
-                for input_fd in wheel_fd.glob('*/'):
-                    if not input_fd.is_dir():
-                        continue
-                    if input_fd.suffix in ('.dist-info', '.data'):
-                        continue
-                    logger.info(f'Processing input_fd={input_fd}')
-                    package_folder_processor_outputs.append(
-                        self.package_folder_processor.run(
-                            input_fd=input_fd,
-                            working_fd=(working_fd / 'working' / input_fd.name),
-                        )
-                    )
+                # Copy the rest of the wheel for each target.
+                for target_wheel_fd in target_wheel_fds:
+                    target_wheel_fd = io.folder(target_wheel_fd, reset=True)
+                    for path in wheel_fd.glob('*'):
+                        if is_package_fd(path):
+                            continue
+                        if path.is_dir():
+                            shutil.copytree(path, target_wheel_fd / path.name)
+                        else:
+                            shutil.copyfile(path, target_wheel_fd / path.name)
 
-                failed = False
-                for package_folder_processor_output in package_folder_processor_outputs:
-                    if not package_folder_processor_output.succeeded:
-                        failed = True
-                        break
-                if failed:
-                    raise RuntimeError('Failed to process code folder.')
+                # Process.
+                package_folder_processor_outputs = self.process_packages(
+                    input_fds=[fd for fd in sorted(wheel_fd.glob('*/')) if is_package_fd(fd)],
+                    working_fd=working_fd,
+                    target_wheel_fds=target_wheel_fds,
+                )
 
-        output_wheel_file = None
+        output_wheel_files: List[Path] = []
         with execution_context_collection.guard('zip_wheel') as should_run:
             if should_run:
                 # Zip wheel.
-                (
-                    distribution,
-                    version,
-                    build_tag,
-                ) = extract_components_from_wheel_file_stem(wheel_file.stem)
-                output_wheel_name = generate_wheel_name(
-                    distribution=distribution,
-                    version=version,
-                    build_tag=build_tag,
-                    abi_tag=output_abi_tag,
-                    platform_tag=output_platform_tag,
+                output_wheel_names = self.generate_output_wheel_names(
+                    wheel_file=wheel_file,
+                    output_abi_tag=output_abi_tag,
+                    output_platform_tag=output_platform_tag,
+                )
+                for output_wheel_name, output_wheel_fd in zip(
+                    output_wheel_names,
+                    target_wheel_fds or [wheel_fd],
+                ):
+                    output_wheel_file = working_fd / output_wheel_name
+                    wheel_writer = WheelWriter(output_wheel_file, self.config.wheel_writer_config)
+                    try:
+                        wheel_writer.write_fd(output_wheel_fd)
+                    except Exception:
+                        wheel_writer.close(succeeded=False)
+                        raise
+                    wheel_writer.close()
+                    output_wheel_files.append(output_wheel_file)
+
+        return WheelFileProcessorOutput(
+            output_wheel_file=(output_wheel_files[0] if output_wheel_files else None),
+            package_folder_processor_outputs=package_folder_processor_outputs,
+            execution_context_collection=execution_context_collection,
+            output_wheel_files=output_wheel_files,
+        )
+
+    def run_streaming(
+        self,
+        wheel_file: Path,
+        output_abi_tag: Optional[str],
+        output_platform_tag: Optional[str],
+        working_fd: Path,
+    ):
+        logging_fd = io.folder(working_fd / 'logging', touch=True)
+
+        execution_context_collection = ExecutionContextCollection(
+            logging_fd=logging_fd,
+            verbose=self.config.verbose,
+        )
+
+        stream_wheel_writers: List[StreamingWheelWriter] = []
+        with execution_context_collection.guard('unzip_wheel') as should_run:
+            assert should_run
+            # Only the members to be processed are extracted.
+            wheel_fd = io.folder(working_fd / 'wheel', reset=True)
+            logger.info(f'Extract the code files of wheel_file={wheel_file} to wheel_fd={wheel_fd}')
+            assert wheel_file.is_file()
+
+            output_wheel_names = self.generate_output_wheel_names(
+                wheel_file=wheel_file,
+                output_abi_tag=output_abi_tag,
+                output_platform_tag=output_platform_tag,
+            )
+            for output_wheel_name in output_wheel_names:
+                stream_wheel_writers.append(
+                    StreamingWheelWriter(
+                        wheel_file,
+                        working_fd / output_wheel_name,
+                        self.config.wheel_writer_config,
+                    )
                 )
-                output_wheel_file = working_fd / output_wheel_name
-                with WheelFile(output_wheel_file, 'w') as wf:
-                    wf.write_files(wheel_fd)
+
+            materialized_members: List[zipfile.ZipInfo] = []
+            pass_through_members: List[zipfile.ZipInfo] = []
+            for zip_info in stream_wheel_writers[0].get_input_members():
+                if self.is_materialized_member(zip_info):
+                    materialized_members.append(zip_info)
+                else:
+                    pass_through_members.append(zip_info)
+
+            with zipfile.ZipFile(wheel_file) as zip_file:
+                extract_members(zip_file, materialized_members, wheel_fd)
+
+        target_wheel_fds = [
+            working_fd / f'wheel_{target_idx}'
+            for target_idx in range(len(self.config.cpp_compiler_targets))
+        ]
+
+        package_folder_processor_outputs: Optional[List[PackageFolderProcessorOutput]] = None
+        with execution_context_collection.guard('process_wheel') as should_run:
+            if should_run:
+                # NOTE: The copy thread could hold a lock (e.g., of the logging module) while
+                # forking, hence the workers are spawned instead.
+                package_folder_processor_config = self.config.package_folder_processor_config
+                if package_folder_processor_config.process_start_method is None:
+                    package_folder_processor_config = attrs.evolve(
+                        package_folder_processor_config,
+                        process_start_method='spawn',
+                    )
+                package_folder_processor = PackageFolderProcessor(package_folder_processor_config)
+
+                # Copy the pass-through members while processing.
+                with ThreadPoolExecutor(max_workers=1) as executor:
+                    futures = [
+                        executor.submit(
+                            stream_wheel_writer.copy_raw_members,
+                            pass_through_members,
+                        ) for stream_wheel_writer in stream_wheel_writers
+                    ]
+                    try:
+                        package_folder_processor_outputs = self.process_packages(
+                            input_fds=[
+                                fd for fd in sorted(wheel_fd.glob('*/')) if is_package_fd(fd)
+                            ],
+                            working_fd=working_fd,
+                            target_wheel_fds=target_wheel_fds,
+                            package_folder_processor=package_folder_processor,
+                        )
+                    finally:
+                        for future in futures:
+                            future.result()
+
+        output_wheel_files: List[Path] = []
+        with execution_context_collection.guard('zip_wheel') as should_run:
+            if should_run:
+                input_names = {zip_info.filename for zip_info in materialized_members}
+                input_names.update(zip_info.filename for zip_info in pass_through_members)
+
+                for stream_wheel_writer, output_wheel_fd in zip(
+                    stream_wheel_writers,
+                    target_wheel_fds or [wheel_fd],
+                ):
+                    files: List[Tuple[Path, str]] = []
+                    # The processed members, dropping the deleted ones.
+                    for zip_info in materialized_members:
+                        file = output_wheel_fd / zip_info.filename
+                        if file.is_file():
+                            files.append((file, zip_info.filename))
+
+                    # The compiled libraries.
+                    for file in sorted(output_wheel_fd.glob('**/*')):
+                        if not file.is_file():
+                            continue
+                        arcname = file.relative_to(output_wheel_fd).as_posix()
+                        if arcname not in input_names:
+                            files.append((file, arcname))
+
+                    stream_wheel_writer.write_files(files)
+
+                for stream_wheel_writer in stream_wheel_writers:
+                    stream_wheel_writer.close()
+                    output_wheel_files.append(Path(stream_wheel_writer.wheel_file.filename))
+
+        if not output_wheel_files:
+            for stream_wheel_writer in stream_wheel_writers:
+                stream_wheel_writer.close(succeeded=False)
 
         return WheelFileProcessorOutput(
-            output_wheel_file=output_wheel_file,
+            output_wheel_file=(output_wheel_files[0] if output_wheel_files else None),
             package_folder_processor_outputs=package_folder_processor_outputs,
             execution_context_collection=execution_context_collection,
+            output_wheel_files=output_wheel_files,
         )
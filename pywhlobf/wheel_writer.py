@@ -0,0 +1,464 @@
+from typing import Dict, Iterable, List, Sequence, Tuple, Optional, Deque
+from pathlib import Path
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, Future
+import os
+import csv
+import io as std_io
+import copy
+import fnmatch
+import hashlib
+import stat
+import struct
+import zipfile
+import zlib
+
+import attrs
+from wheel.wheelfile import WheelFile, get_zipinfo_datetime, MINIMUM_TIMESTAMP
+from wheel.util import urlsafe_b64encode
+
+# https://pkware.cachefly.net/webdocs/casestudies/APPNOTE.TXT, 4.3.7
+LOCAL_FILE_HEADER_STRUCT = struct.Struct('<4s2B4HL2L2H')
+LOCAL_FILE_HEADER_SIGNATURE = b'PK\x03\x04'
+ZIP64_EXTRA_HEADER_ID = 0x0001
+DATA_DESCRIPTOR_FLAG = 0x08
+
+COPY_CHUNK_SIZE = 1024**2
+
+# https://pkware.cachefly.net/webdocs/casestudies/APPNOTE.TXT, 4.4.2
+ZIP_CREATE_SYSTEM_UNIX = 3
+
+
+def match_glob_pattern(rel_path: str, pattern: str):
+    '''
+    Match a relative POSIX path against a pattern of `Path.glob`, without listing a folder.
+    '''
+
+    def match_parts(parts: Sequence[str], pattern_parts: Sequence[str]) -> bool:
+        if not pattern_parts:
+            return not parts
+        head = pattern_parts[0]
+        if head == '**':
+            return any(
+                match_parts(parts[idx:], pattern_parts[1:]) for idx in range(len(parts) + 1)
+            )
+        return bool(parts) and fnmatch.fnmatchcase(parts[0], head) \
+            and match_parts(parts[1:], pattern_parts[1:])
+
+    return match_parts(rel_path.split('/'), pattern.split('/'))
+
+
+def read_record(zip_file: zipfile.ZipFile, record_path: str):
+    '''
+    Returns the mapping from path to `(algorithm, hash)`, as kept by `WheelFile`.
+    '''
+    file_hashes: Dict[str, Tuple[str, str]] = {}
+    if record_path not in zip_file.NameToInfo:
+        return file_hashes
+
+    with zip_file.open(record_path) as fin:
+        for row in csv.reader(std_io.TextIOWrapper(fin, newline='', encoding='utf-8')):
+            if len(row) != 3 or not row[1]:
+                continue
+            path, hash_sum, _ = row
+            algorithm, _, hash_value = hash_sum.partition('=')
+            if algorithm.lower() in ('md5', 'sha1'):
+                # Not allowed by PEP 427, rehash.
+                continue
+            file_hashes[path] = (algorithm, hash_value)
+    return file_hashes
+
+
+def find_record_path(zip_file: zipfile.ZipFile):
+    for name in zip_file.namelist():
+        parts = name.split('/')
+        if len(parts) == 2 and parts[0].endswith('.dist-info') and parts[1] == 'RECORD':
+            return name
+    return None
+
+
+def strip_zip64_extra(extra: bytes):
+    # The ZIP64 field is regenerated by `ZipInfo.FileHeader` if needed.
+    chunks = []
+    idx = 0
+    while idx + 4 <= len(extra):
+        header_id, size = struct.unpack('<HH', extra[idx:idx + 4])
+        if header_id != ZIP64_EXTRA_HEADER_ID:
+            chunks.append(extra[idx:idx + 4 + size])
+        idx += 4 + size
+    return b''.join(chunks)
+
+
+def get_reproducible_date_time():
+    # `SOURCE_DATE_EPOCH` if defined, otherwise the earliest timestamp supported by zip.
+    return get_zipinfo_datetime(MINIMUM_TIMESTAMP)
+
+
+def normalize_zip_info(zip_info: zipfile.ZipInfo, date_time: Tuple[int, ...]):
+    '''
+    Drop the timestamp, the owner permissions and the creator platform of the member.
+    '''
+    zip_info.date_time = date_time
+    # The extra fields might hold the timestamps and the owner, e.g. `UT` and `ux`.
+    zip_info.extra = b''
+    mode = zip_info.external_attr >> 16
+    zip_info.external_attr = (stat.S_IFREG | (0o755 if mode & 0o111 else 0o644)) << 16
+    zip_info.create_system = ZIP_CREATE_SYSTEM_UNIX
+
+
+def compute_file_hash(data: bytes):
+    sha256 = hashlib.sha256(data)
+    return sha256.name, urlsafe_b64encode(sha256.digest()).decode('ascii')
+
+
+@attrs.define
+class WheelWriterConfig:
+    # The zlib compression level, from 0 to 9. Default to the zlib default.
+    compress_level: Optional[int] = None
+    # Members matching any of the patterns are stored without compression,
+    # e.g. `**/*.so` for the libraries that barely compress.
+    store_file_patterns: Sequence[str] = ()
+    # The number of compression threads, default to the number of CPUs.
+    num_threads: Optional[int] = None
+    # Bound the memory held by the members in compression (by the size of the input files).
+    max_pending_size: int = 256 * 1024**2
+    # Members larger than this size are compressed in chunks, in the writing thread.
+    stream_file_size_threshold: int = 64 * 1024**2
+    # Produce the same wheel from the same members: the timestamps are set to
+    # `SOURCE_DATE_EPOCH` (or 1980-01-01), and the permissions are normalized to 644 or 755.
+    enable_reproducible: bool = False
+
+
+@attrs.define
+class CompressedMember:
+    zip_info: zipfile.ZipInfo
+    data: bytes
+    file_hash: Tuple[str, str]
+
+
+def create_zip_info(
+    file: Path,
+    arcname: str,
+    reproducible_date_time: Optional[Tuple[int, ...]] = None,
+):
+    # Mirrors `WheelFile.write`.
+    st = file.stat()
+    zip_info = zipfile.ZipInfo(arcname, date_time=get_zipinfo_datetime(st.st_mtime))
+    zip_info.external_attr = (stat.S_IMODE(st.st_mode) | stat.S_IFMT(st.st_mode)) << 16
+    if reproducible_date_time:
+        normalize_zip_info(zip_info, reproducible_date_time)
+    zip_info.file_size = st.st_size
+    return zip_info
+
+
+def compress_member(
+    file: Path,
+    arcname: str,
+    compress_level: Optional[int],
+    store: bool,
+    reproducible_date_time: Optional[Tuple[int, ...]] = None,
+):
+    zip_info = create_zip_info(file, arcname, reproducible_date_time)
+    data = file.read_bytes()
+    zip_info.file_size = len(data)
+    zip_info.CRC = zlib.crc32(data)
+
+    if store:
+        zip_info.compress_type = zipfile.ZIP_STORED
+        compressed_data = data
+    else:
+        zip_info.compress_type = zipfile.ZIP_DEFLATED
+        # Raw deflate stream, as in `zipfile`.
+        compressor = zlib.compressobj(
+            zlib.Z_DEFAULT_COMPRESSION if compress_level is None else compress_level,
+            zlib.DEFLATED,
+            -15,
+        )
+        compressed_data = compressor.compress(data) + compressor.flush()
+    zip_info.compress_size = len(compressed_data)
+
+    return CompressedMember(
+        zip_info=zip_info,
+        data=compressed_data,
+        file_hash=compute_file_hash(data),
+    )
+
+
+class WheelWriter:
+    '''
+    Write a wheel with the members compressed concurrently (zlib releases the GIL) and written
+    sequentially. The RECORD rows are kept by the writer and RECORD is written on closing.
+    '''
+
+    def __init__(self, output_wheel_file: Path, config: Optional[WheelWriterConfig] = None):
+        self.config = config or WheelWriterConfig()
+        # Only the members are written through `ZipFile`, hence RECORD is not written by
+        # `WheelFile.close`.
+        self.wheel_file = WheelFile(output_wheel_file, 'w')
+        # Mapping from path to `(algorithm, hash, size)`.
+        self.record_rows: Dict[str, Tuple[str, str, int]] = {}
+
+        # Resolved once, in case `SOURCE_DATE_EPOCH` changes while writing.
+        self.reproducible_date_time: Optional[Tuple[int, ...]] = None
+        if self.config.enable_reproducible:
+            self.reproducible_date_time = get_reproducible_date_time()
+
+    def add_record_row(self, path: str, file_hash: Tuple[str, str], size: int):
+        algorithm, hash_value = file_hash
+        self.record_rows[path] = (algorithm, hash_value, size)
+
+    def append_raw(
+        self,
+        zip_info: zipfile.ZipInfo,
+        chunks: Iterable[bytes],
+        file_hash: Tuple[str, str],
+    ):
+        '''
+        Append a member with the compressed data, CRC and sizes already known.
+        '''
+        wheel_file = self.wheel_file
+        fout = wheel_file.fp
+        assert fout
+        zip_info.header_offset = fout.tell()
+        fout.write(zip_info.FileHeader())
+        for chunk in chunks:
+            fout.write(chunk)
+
+        wheel_file.filelist.append(zip_info)
+        wheel_file.NameToInfo[zip_info.filename] = zip_info
+        wheel_file.start_dir = fout.tell()
+
+        self.add_record_row(zip_info.filename, file_hash, zip_info.file_size)
+
+    def write_large_member(self, file: Path, arcname: str):
+        '''
+        Compress in chunks through `ZipFile.open`, without loading the whole file.
+        '''
+        zip_info = create_zip_info(file, arcname, self.reproducible_date_time)
+        if self.should_store(arcname):
+            zip_info.compress_type = zipfile.ZIP_STORED
+        else:
+            zip_info.compress_type = zipfile.ZIP_DEFLATED
+            # Named `compress_level` since Python 3.13, with `_compresslevel` kept as an alias.
+            zip_info._compresslevel = self.config.compress_level  # type: ignore
+
+        sha256 = hashlib.sha256()
+        size = 0
+        with file.open('rb') as fin, self.wheel_file.open(zip_info, 'w') as fout:
+            for chunk in iter(lambda: fin.read(COPY_CHUNK_SIZE), b''):
+                sha256.update(chunk)
+                fout.write(chunk)
+                size += len(chunk)
+
+        self.add_record_row(
+            arcname,
+            (sha256.name, urlsafe_b64encode(sha256.digest()).decode('ascii')),
+            size,
+        )
+
+    def should_store(self, arcname: str):
+        return any(
+            match_glob_pattern(arcname, pattern) for pattern in self.config.store_file_patterns
+        )
+
+    def write_files(self, files: Sequence[Tuple[Path, str]]):
+        '''
+        Write `(file, arcname)` in order.
+        '''
+        num_threads = self.config.num_threads or os.cpu_count() or 1
+
+        with ThreadPoolExecutor(max_workers=num_threads) as executor:
+            pending: Deque[Tuple[Future, int]] = deque()
+            pending_size = 0
+
+            def append_first_pending():
+                nonlocal pending_size
+                future, size = pending.popleft()
+                pending_size -= size
+                self.append_compressed_member(future.result())
+
+            for file, arcname in files:
+                size = file.stat().st_size
+                if size > self.config.stream_file_size_threshold:
+                    # Keep the order.
+                    while pending:
+                        append_first_pending()
+                    self.write_large_member(file, arcname)
+                    continue
+
+                # Bound the memory held by the compressed members.
+                while pending and pending_size + size > self.config.max_pending_size:
+                    append_first_pending()
+
+                pending.append((
+                    executor.submit(
+                        compress_member,
+                        file,
+                        arcname,
+                        self.config.compress_level,
+                        self.should_store(arcname),
+                        self.reproducible_date_time,
+                    ),
+                    size,
+                ))
+                pending_size += size
+
+            while pending:
+                append_first_pending()
+
+    def append_compressed_member(self, compressed_member: CompressedMember):
+        self.append_raw(
+            compressed_member.zip_info,
+            [compressed_member.data],
+            compressed_member.file_hash,
+        )
+
+    def write_fd(self, base_fd: Path):
+        '''
+        Same as `WheelFile.write_files`, with the `.dist-info` members last.
+        '''
+        files: List[Tuple[Path, str]] = []
+        deferred: List[Tuple[Path, str]] = []
+        for root, dirnames, filenames in os.walk(base_fd):
+            dirnames.sort()
+            for name in sorted(filenames):
+                path = Path(os.path.normpath(os.path.join(root, name)))
+                if not path.is_file():
+                    continue
+                arcname = path.relative_to(base_fd).as_posix()
+                if arcname == self.wheel_file.record_path:
+                    continue
+                elif root.endswith('.dist-info'):
+                    deferred.append((path, arcname))
+                else:
+                    files.append((path, arcname))
+        deferred.sort()
+        self.write_files(files + deferred)
+
+    def write_record(self):
+        '''
+        Same as RECORD written by `WheelFile.close`, with the normalized timestamp and permissions
+        if reproducible.
+        '''
+        wheel_file = self.wheel_file
+
+        data = std_io.StringIO()
+        writer = csv.writer(data, delimiter=',', quotechar='"', lineterminator='\n')
+        writer.writerows(
+            (path, algorithm + '=' + hash_value, size)
+            for path, (algorithm, hash_value, size) in self.record_rows.items()
+        )
+        writer.writerow((wheel_file.record_path, '', ''))
+
+        zip_info = zipfile.ZipInfo(wheel_file.record_path, date_time=get_zipinfo_datetime())
+        zip_info.external_attr = 0o664 << 16
+        if self.reproducible_date_time:
+            normalize_zip_info(zip_info, self.reproducible_date_time)
+        zip_info.compress_type = wheel_file.compression
+        # Bypass `WheelFile.writestr`, RECORD is not a row of itself.
+        zipfile.ZipFile.writestr(wheel_file, zip_info, data.getvalue().encode('utf-8'))
+
+    def close(self, succeeded: bool = True):
+        if succeeded:
+            self.write_record()
+        self.wheel_file.close()
+        if not succeeded:
+            Path(self.wheel_file.filename).unlink()
+
+
+class StreamingWheelWriter(WheelWriter):
+    '''
+    Copy the members of the input wheel as is (compressed bytes and RECORD hashes).
+    '''
+
+    def __init__(
+        self,
+        input_wheel_file: Path,
+        output_wheel_file: Path,
+        config: Optional[WheelWriterConfig] = None,
+    ):
+        super().__init__(output_wheel_file, config)
+
+        self.input_zip_file = zipfile.ZipFile(input_wheel_file)
+        self.input_fin = input_wheel_file.open('rb')
+
+        record_path = find_record_path(self.input_zip_file)
+        self.input_record_path = record_path
+        self.input_file_hashes = read_record(self.input_zip_file, record_path) \
+            if record_path else {}
+
+    def is_record_member(self, name: str):
+        return self.input_record_path is not None and name in (
+            self.input_record_path,
+            self.input_record_path + '.jws',
+            self.input_record_path + '.p7s',
+        )
+
+    def get_input_members(self):
+        # RECORD and the signatures are regenerated or dropped.
+        return [
+            zip_info for zip_info in self.input_zip_file.infolist()
+            if not zip_info.is_dir() and not self.is_record_member(zip_info.filename)
+        ]
+
+    def get_file_hash(self, zip_info: zipfile.ZipInfo):
+        file_hash = self.input_file_hashes.get(zip_info.filename)
+        if file_hash is None:
+            # Not recorded, hash the decompressed content.
+            sha256 = hashlib.sha256()
+            with self.input_zip_file.open(zip_info) as fin:
+                for chunk in iter(lambda: fin.read(COPY_CHUNK_SIZE), b''):
+                    sha256.update(chunk)
+            file_hash = (sha256.name, urlsafe_b64encode(sha256.digest()).decode('ascii'))
+        return file_hash
+
+    def copy_raw(self, zip_info: zipfile.ZipInfo):
+        # Locate the compressed data of the input member.
+        self.input_fin.seek(zip_info.header_offset)
+        header = LOCAL_FILE_HEADER_STRUCT.unpack(
+            self.input_fin.read(LOCAL_FILE_HEADER_STRUCT.size)
+        )
+        if header[0] != LOCAL_FILE_HEADER_SIGNATURE:
+            raise zipfile.BadZipFile(f'Bad local file header of {zip_info.filename}')
+        filename_length, extra_length = header[-2:]
+        self.input_fin.seek(filename_length + extra_length, 1)
+
+        output_zip_info = copy.copy(zip_info)
+        # The sizes and CRC are known, no data descriptor is needed.
+        output_zip_info.flag_bits &= ~DATA_DESCRIPTOR_FLAG
+        output_zip_info.extra = strip_zip64_extra(zip_info.extra)
+        if self.reproducible_date_time:
+            normalize_zip_info(output_zip_info, self.reproducible_date_time)
+
+        def read_chunks():
+            remaining = zip_info.compress_size
+            while remaining > 0:
+                chunk = self.input_fin.read(min(COPY_CHUNK_SIZE, remaining))
+                if not chunk:
+                    raise zipfile.BadZipFile(f'Truncated data of {zip_info.filename}')
+                yield chunk
+                remaining -= len(chunk)
+
+        self.append_raw(output_zip_info, read_chunks(), self.get_file_hash(zip_info))
+
+    def copy_raw_members(self, zip_infos: Iterable[zipfile.ZipInfo]):
+        for zip_info in zip_infos:
+            self.copy_raw(zip_info)
+
+    def close(self, succeeded: bool = True):
+        self.input_fin.close()
+        self.input_zip_file.close()
+        super().close(succeeded)
+
+
+def extract_members(
+    zip_file: zipfile.ZipFile,
+    zip_infos: Iterable[zipfile.ZipInfo],
+    output_fd: Path,
+):
+    for zip_info in zip_infos:
+        output_file = output_fd / zip_info.filename
+        output_file.parent.mkdir(exist_ok=True, parents=True)
+        with zip_file.open(zip_info) as fin, output_file.open('wb') as fout:
+            for chunk in iter(lambda: fin.read(COPY_CHUNK_SIZE), b''):
+                fout.write(chunk)
@@ -1,6 +1,7 @@
 import os
 import os.path
 import inspect
+import subprocess
 
 import iolite as io
 from Cython.Compiler.Version import version as cython_version
@@ -99,3 +100,49 @@ print('b')
 '''
     py_file.write_text(code)
     return py_file
+
+
+def get_test_small_package_fd():
+    package_fd = io.folder(
+        '$PYWHLOBF_DATA/test-data/small_package/pkg',
+        expandvars=True,
+        reset=True,
+    )
+    (package_fd / '__init__.py').write_text('''\
+from .a import foo
+''')
+    (package_fd / 'a.py').write_text('''\
+def foo():
+    return 'foo'
+''')
+    io.folder(package_fd / 'sub', touch=True)
+    (package_fd / 'sub' / '__init__.py').write_text('')
+    (package_fd / 'sub' / 'b.py').write_text('''\
+from ..a import foo
+
+
+def bar(n):
+    return foo() * n
+''')
+    (package_fd / 'sub' / 'data.txt').write_text('data')
+    return package_fd
+
+
+def run_small_package(
+    python_executable: str,
+    pythonpath: os.PathLike,
+    code: str = 'import pkg.sub.b; print(pkg.sub.b.bar(2))',
+):
+    '''
+    Run `code` against the processed small package in `pythonpath`, returns the stripped stdout.
+    '''
+    env = os.environ.copy()
+    env['PYTHONPATH'] = str(pythonpath)
+    process = subprocess.run(
+        [python_executable, '-c', code],
+        env=env,
+        capture_output=True,
+        text=True,
+    )
+    print(process.stderr)
+    return process.stdout.strip()
@@ -0,0 +1,142 @@
+import os
+import time
+import json
+
+import iolite as io
+
+from pywhlobf.artifact_cache import (
+    ArtifactCacheConfig,
+    ArtifactCacheLevel,
+    ArtifactCache,
+    compute_artifact_cache_key,
+)
+from pywhlobf.code_file_processor import (
+    CodeFileProcessorConfig,
+    CodeFileProcessor,
+)
+from tests.opt import get_test_output_fd, get_test_customized_py_file
+
+
+def test_artifact_cache():
+    test_output_fd = get_test_output_fd()
+    cache_fd = test_output_fd / 'cache'
+
+    artifact_cache = ArtifactCache(
+        ArtifactCacheConfig(
+            cache_folder=str(cache_fd),
+            lib_level_max_size=25,
+        )
+    )
+
+    keys = []
+    for idx in range(3):
+        file = test_output_fd / f'{idx}.txt'
+        file.write_text('x' * 10)
+        key = compute_artifact_cache_key(str(idx))
+        keys.append(key)
+        artifact_cache.put(
+            level=ArtifactCacheLevel.LIB,
+            key=key,
+            files=[file],
+            metadata={'idx': idx},
+        )
+        # Make sure the mtimes are different.
+        time.sleep(0.05)
+
+    # The least recently used entry is evicted.
+    output_fd = io.folder(test_output_fd / 'output', touch=True)
+    assert artifact_cache.get(ArtifactCacheLevel.LIB, keys[0], output_fd) is None
+    assert artifact_cache.get(ArtifactCacheLevel.LIB, keys[1], output_fd) == {'idx': 1}
+    assert (output_fd / '1.txt').read_text() == 'x' * 10
+    assert artifact_cache.get(ArtifactCacheLevel.CPP, keys[1], output_fd) is None
+
+    # The running size.
+    assert artifact_cache.load_total_size(ArtifactCacheLevel.LIB) == 20
+
+
+def test_artifact_cache_evict_broken_entries():
+    test_output_fd = get_test_output_fd()
+    artifact_cache = ArtifactCache(
+        ArtifactCacheConfig(
+            cache_folder=str(test_output_fd / 'cache'),
+            lib_level_max_size=15,
+        )
+    )
+    level_fd = artifact_cache.get_level_fd(ArtifactCacheLevel.LIB)
+
+    # Broken entry.
+    broken_entry_fd = io.folder(level_fd / 'ab' / 'abc', touch=True)
+    (broken_entry_fd / 'meta.json').write_text('{')
+    # Orphaned temporary folders.
+    orphaned_temp_fd = io.folder(level_fd / '.tmp_orphaned', touch=True)
+    (orphaned_temp_fd / 'meta.json').write_text('{}')
+    mtime = time.time() - 2 * ArtifactCache.TEMP_FD_MAX_AGE
+    os.utime(orphaned_temp_fd, (mtime, mtime))
+    pending_temp_fd = io.folder(level_fd / '.tmp_pending', touch=True)
+
+    output_fd = io.folder(test_output_fd / 'output', touch=True)
+    assert artifact_cache.get(ArtifactCacheLevel.LIB, 'abc', output_fd) is None
+
+    keys = []
+    for idx in range(2):
+        file = test_output_fd / f'{idx}.txt'
+        file.write_text('x' * 10)
+        key = compute_artifact_cache_key(str(idx))
+        keys.append(key)
+        artifact_cache.put(
+            level=ArtifactCacheLevel.LIB,
+            key=key,
+            files=[file],
+            metadata={'idx': idx},
+        )
+        time.sleep(0.05)
+
+    assert not broken_entry_fd.exists()
+    assert not orphaned_temp_fd.exists()
+    assert pending_temp_fd.exists()
+    assert artifact_cache.load_total_size(ArtifactCacheLevel.LIB) == 10
+    assert artifact_cache.get(ArtifactCacheLevel.LIB, keys[0], output_fd) is None
+    assert artifact_cache.get(ArtifactCacheLevel.LIB, keys[1], output_fd) == {'idx': 1}
+
+    # Evicted while copying.
+    entry_fd = level_fd / keys[1][:2] / keys[1]
+    meta = json.loads((entry_fd / 'meta.json').read_text())
+    (entry_fd / meta['files'][0]).unlink()
+    assert artifact_cache.get(ArtifactCacheLevel.LIB, keys[1], output_fd) is None
+
+
+def test_code_file_processor_with_artifact_cache():
+    test_output_fd = get_test_output_fd()
+    test_py_file = get_test_customized_py_file()
+
+    config = CodeFileProcessorConfig(
+        artifact_cache_config=ArtifactCacheConfig(cache_folder=str(test_output_fd / 'cache'))
+    )
+    config.cpp_compiler_config.setup_build_ext_timeout = 600
+
+    outputs = []
+    for idx in range(2):
+        working_fd = io.folder(test_output_fd / f'working_{idx}', touch=True)
+        output = CodeFileProcessor(config).run(
+            py_file=test_py_file,
+            build_fd=working_fd,
+            logging_fd=working_fd,
+        )
+        print(output.execution_context_collection.get_logging_message())
+        assert output.compiled_lib_file and output.compiled_lib_file.is_file()
+        outputs.append(output)
+
+    assert outputs[0].artifact_cache_level is None
+    assert outputs[1].artifact_cache_level == ArtifactCacheLevel.LIB
+
+    # Drop the lib level to hit the cpp level.
+    config.cpp_compiler_config.delete_temp_fd = False
+    working_fd = io.folder(test_output_fd / 'working_cpp', touch=True)
+    output = CodeFileProcessor(config).run(
+        py_file=test_py_file,
+        build_fd=working_fd,
+        logging_fd=working_fd,
+    )
+    print(output.execution_context_collection.get_logging_message())
+    assert output.compiled_lib_file and output.compiled_lib_file.is_file()
+    assert output.artifact_cache_level == ArtifactCacheLevel.CPP
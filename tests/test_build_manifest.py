@@ -0,0 +1,112 @@
+import sys
+import shutil
+
+from pywhlobf.build_manifest import CodeFileDependencyResolver
+from pywhlobf.package_folder_processor import (
+    PackageFolderProcessorConfig,
+    PackageFolderProcessor,
+)
+from tests.opt import get_test_output_fd, get_test_small_package_fd, run_small_package
+
+
+def test_code_file_dependency_resolver():
+    test_output_fd = get_test_output_fd()
+    package_fd = test_output_fd / 'pkg'
+    (package_fd / 'sub').mkdir(parents=True)
+    (package_fd / '__init__.py').write_text('')
+    (package_fd / 'sub' / '__init__.py').write_text('')
+    (package_fd / 'a.pxd').write_text('from pkg.b cimport Y\n')
+    (package_fd / 'b.pxd').write_text('ctypedef int Y\n')
+    (package_fd / 'c.pxi').write_text('include "d.pxi"\n')
+    (package_fd / 'd.pxi').write_text('')
+    (package_fd / 'e.pxd').write_text('')
+    (package_fd / 'e.py').write_text('')
+    (package_fd / 'sub' / 'f.pyx').write_text(
+        'from pkg cimport a as aa, e\ninclude "../c.pxi"\n'
+    )
+    (package_fd / 'sub' / 'g.pyx').write_text('from ..b cimport Y\n')
+
+    dependency_resolver = CodeFileDependencyResolver(package_fd)
+    assert dependency_resolver.get_dependency_files(package_fd / 'sub' / 'f.pyx') == [
+        package_fd / name for name in ('a.pxd', 'b.pxd', 'c.pxi', 'd.pxi', 'e.pxd')
+    ]
+    assert dependency_resolver.get_dependency_files(package_fd / 'sub' / 'g.pyx') \
+        == [package_fd / 'b.pxd']
+    assert dependency_resolver.get_dependency_files(package_fd / 'e.py') \
+        == [package_fd / 'e.pxd']
+    assert dependency_resolver.compute_dependency_hash(package_fd / 'b.pxd') is None
+
+    # Changed by the dependencies only.
+    dependency_hash = dependency_resolver.compute_dependency_hash(package_fd / 'sub' / 'f.pyx')
+    (package_fd / 'd.pxi').write_text('X = 1\n')
+    dependency_resolver = CodeFileDependencyResolver(package_fd)
+    assert dependency_resolver.compute_dependency_hash(package_fd / 'sub' / 'f.pyx') \
+        != dependency_hash
+    assert dependency_resolver.compute_dependency_hash(package_fd / 'sub' / 'g.pyx') \
+        == dependency_resolver.compute_dependency_hash(package_fd / 'sub' / 'g.pyx')
+
+
+def test_package_folder_processor_incremental():
+    test_output_fd = get_test_output_fd()
+    input_fd = test_output_fd / 'input' / 'pkg'
+    shutil.copytree(get_test_small_package_fd(), input_fd)
+    (input_fd / 'c.pyx').write_text('''\
+from pkg.d cimport scale
+include "e.pxi"
+
+
+def baz():
+    return scale(OFFSET)
+''')
+    (input_fd / 'd.pxd').write_text('''\
+cdef inline int scale(int x):
+    return 2 * x
+''')
+    (input_fd / 'e.pxi').write_text('OFFSET = 1\n')
+
+    output_fd = test_output_fd / 'output' / 'pkg'
+    package_folder_processor = PackageFolderProcessor(
+        PackageFolderProcessorConfig(enable_incremental=True)
+    )
+
+    def run():
+        output = package_folder_processor.run(
+            input_fd=input_fd,
+            output_fd=output_fd,
+            working_fd=test_output_fd / 'working',
+        )
+        print(output.get_logging_message())
+        assert output.succeeded
+        assert len(output.succeeded_outputs) == 5
+
+        stdout = run_small_package(
+            sys.executable,
+            output_fd.parent,
+            'import pkg.c, pkg.sub.b; print(pkg.c.baz(), pkg.sub.b.bar(1))',
+        )
+
+        processed_rel_paths = sorted(
+            str(succeeded_output.py_file.relative_to(input_fd))
+            for succeeded_output in output.succeeded_outputs
+            if succeeded_output.execution_context_collection.execution_contexts
+        )
+        return processed_rel_paths, stdout
+
+    assert run() == (['__init__.py', 'a.py', 'c.pyx', 'sub/__init__.py', 'sub/b.py'], '2 foo')
+    # Nothing changed.
+    assert run() == ([], '2 foo')
+
+    (input_fd / 'a.py').write_text('''\
+def foo():
+    return 'bar'
+''')
+    assert run() == (['a.py'], '2 bar')
+
+    # The cimported `.pxd` and the included `.pxi` files.
+    (input_fd / 'd.pxd').write_text('''\
+cdef inline int scale(int x):
+    return 3 * x
+''')
+    assert run() == (['c.pyx'], '3 bar')
+    (input_fd / 'e.pxi').write_text('OFFSET = 2\n')
+    assert run() == (['c.pyx'], '6 bar')
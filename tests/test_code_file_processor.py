@@ -4,7 +4,14 @@ import os
 
 import iolite as io
 
+from cryptography.fernet import Fernet
+
 from pywhlobf.component.cpp_compiler import CppCompilerConfig
+from pywhlobf.component.source_code_injector import (
+    SourceCodePayloadFormat,
+    SourceCodeTraceMode,
+    SourceCodeInjector,
+)
 from pywhlobf.code_file_processor import (
     ExecutionContextCollection,
     CodeFileProcessorConfig,
@@ -90,6 +97,53 @@ def test_code_file_processor():
     assert encrypted_traceback.count('(pywhlobf') == 3
 
 
+def test_code_file_processor_compact_payload():
+    working_fd = get_test_output_fd()
+    test_py_file = get_test_py_file()
+
+    fernet_key = 'WwAPKBMXKl-I43L4u8B5WD9xoperM9qhXDlLVWRFkiY='
+    config = CodeFileProcessorConfig(
+        cpp_compiler_config=CppCompilerConfig(setup_build_ext_timeout=600)
+    )
+    config.source_code_injector_config.fernet_key = fernet_key
+    config.source_code_injector_config.payload_format = SourceCodePayloadFormat.COMPACT
+    output = CodeFileProcessor(config).run(
+        py_file=test_py_file,
+        build_fd=working_fd,
+        logging_fd=working_fd,
+    )
+    print(output.execution_context_collection.get_logging_message())
+    assert output.execution_context_collection.succeeded
+
+    env = os.environ.copy()
+    env['PYTHONPATH'] = str(working_fd)
+    process = subprocess.run(
+        [
+            sys.executable,
+            '-c',
+            f'import {test_py_file.stem}',
+        ],
+        env=env,
+        capture_output=True,
+        text=True,
+    )
+    encrypted_traceback = process.stderr
+    print(encrypted_traceback)
+    assert 'wheel' not in encrypted_traceback
+
+    # The source code is recovered from the temporary file.
+    temp_file = None
+    for line in encrypted_traceback.splitlines():
+        line = line.strip()
+        if line.startswith('File "') and '(pywhlobf' in line:
+            temp_file = io.file(line[len('File "'):line.index('"', len('File "'))])
+            break
+    assert temp_file and temp_file.is_file()
+    fernet = Fernet(fernet_key.encode())
+    assert SourceCodeInjector.decrept(fernet, temp_file.read_text()) \
+        == test_py_file.read_text() + '\n'
+
+
 def test_customzied_setup():
     working_fd = get_test_output_fd()
     test_py_file = get_test_customized_py_file()
@@ -126,3 +180,53 @@ def test_customzied_setup():
     print('-' * 40)
     print(process.stderr)
     print('-' * 40)
+
+
+def test_code_file_processor_linecache_trace_mode():
+    working_fd = get_test_output_fd()
+    test_py_file = get_test_py_file()
+
+    fernet_key = 'WwAPKBMXKl-I43L4u8B5WD9xoperM9qhXDlLVWRFkiY='
+    config = CodeFileProcessorConfig(
+        cpp_compiler_config=CppCompilerConfig(setup_build_ext_timeout=600)
+    )
+    config.source_code_injector_config.fernet_key = fernet_key
+    config.source_code_injector_config.trace_mode = SourceCodeTraceMode.LINECACHE
+    output = CodeFileProcessor(config).run(
+        py_file=test_py_file,
+        build_fd=working_fd,
+        logging_fd=working_fd,
+    )
+    print(output.execution_context_collection.get_logging_message())
+    assert output.execution_context_collection.succeeded
+
+    env = os.environ.copy()
+    env['PYTHONPATH'] = str(working_fd)
+    temp_fd = io.folder(working_fd / 'temp', touch=True)
+    env['TMPDIR'] = str(temp_fd)
+    process = subprocess.run(
+        [
+            sys.executable,
+            '-c',
+            (
+                'import traceback\n'
+                'try:\n'
+                f'    import {test_py_file.stem}\n'
+                'except ImportError:\n'
+                '    traceback.print_exc()\n'
+            ),
+        ],
+        env=env,
+        capture_output=True,
+        text=True,
+    )
+    encrypted_traceback = process.stderr
+    print(encrypted_traceback)
+    assert 'wheel' not in encrypted_traceback
+    # The file name, the function name, and the source line from linecache.
+    assert encrypted_traceback.count('(pywhlobf') == 3
+    assert not tuple(temp_fd.iterdir())
+
+    fernet = Fernet(fernet_key.encode())
+    decrypted_traceback = SourceCodeInjector.decrept(fernet, encrypted_traceback)
+    assert 'import' in decrypted_traceback
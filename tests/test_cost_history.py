@@ -0,0 +1,124 @@
+from pywhlobf.component.cpp_compiler import CppCompilerConfig, CppCompilerBuildProfile
+from pywhlobf.code_file_processor import CodeFileProcessorConfig
+from pywhlobf.cost_history import CostHistory
+from pywhlobf.package_folder_processor import (
+    PackageFolderProcessorConfig,
+    PackageFolderProcessor,
+)
+from tests.opt import get_test_output_fd, get_test_small_package_fd
+
+
+def test_cost_history():
+    test_output_fd = get_test_output_fd()
+
+    cost_history = CostHistory(test_output_fd)
+    # No history, fallback to size.
+    assert cost_history.estimate_cost('a.py', 'x', 10) == 10.0
+    assert cost_history.get_cpp_compiler_timeout('a.py', 'x', 10, 5.0, 30.0) is None
+
+    cost_history.record('a.py', 'x', 10, {'cpp_generator': 1.0, 'cpp_compiler': 10.0})
+    cost_history.record('b.py', 'y', 100, {'cpp_generator': 1.0, 'cpp_compiler': 1.0})
+    cost_history.save()
+
+    cost_history = CostHistory(test_output_fd)
+    assert cost_history.estimate_cost('a.py', 'x', 10) == 11.0
+    # Changed file, scaled by size.
+    assert cost_history.estimate_cost('a.py', 'z', 20) == 22.0
+    # Unknown file, scaled by the average throughput.
+    assert cost_history.estimate_cost('c.py', 'z', 110) == 13.0
+
+    assert cost_history.get_cpp_compiler_timeout('a.py', 'x', 10, 5.0, 30.0) == 50.0
+    assert cost_history.get_cpp_compiler_timeout('b.py', 'y', 100, 5.0, 30.0) == 30.0
+
+
+def test_cost_history_unwritable():
+    test_output_fd = get_test_output_fd()
+    # Not a folder.
+    (test_output_fd / 'file').write_text('')
+    history_fd = test_output_fd / 'file' / 'cost_history'
+
+    cost_history = CostHistory(history_fd)
+    assert not cost_history.entries
+    cost_history.record('a.py', 'x', 10, {'cpp_compiler': 1.0})
+    # Ignored.
+    cost_history.save()
+    assert not CostHistory(history_fd).entries
+
+
+def test_package_folder_processor_with_cost_history():
+    test_output_fd = get_test_output_fd()
+    input_fd = get_test_small_package_fd()
+    cost_history_fd = test_output_fd / 'cost_history'
+
+    package_folder_processor = PackageFolderProcessor(
+        PackageFolderProcessorConfig(
+            enable_cost_history=True,
+            cost_history_folder=str(cost_history_fd),
+        )
+    )
+    output = package_folder_processor.run(
+        input_fd=input_fd,
+        output_fd=test_output_fd / 'output' / input_fd.name,
+        working_fd=test_output_fd / 'working',
+    )
+    assert output.succeeded
+
+    cost_history = CostHistory(cost_history_fd)
+    config_hash = package_folder_processor.get_cost_history_config_hash()[:16]
+    assert set(cost_history.entries) == {
+        f'{config_hash}/pkg/{rel_path}'
+        for rel_path in ('__init__.py', 'a.py', 'sub/__init__.py', 'sub/b.py')
+    }
+    for entry in cost_history.entries.values():
+        assert entry['durations']['cpp_compiler'] > 0.0
+
+    # Another build profile.
+    package_folder_processor = PackageFolderProcessor(
+        PackageFolderProcessorConfig(
+            code_file_processor_config=CodeFileProcessorConfig(
+                cpp_compiler_config=CppCompilerConfig(
+                    build_profile=CppCompilerBuildProfile.FAST_BUILD,
+                    setup_build_ext_timeout=600,
+                )
+            ),
+            enable_cost_history=True,
+            cost_history_folder=str(cost_history_fd),
+        )
+    )
+    prepared = package_folder_processor.prepare(input_fd, test_output_fd / 'working')
+    assert prepared.cost_history
+    for py_file, key in prepared.cost_history_keys.items():
+        assert key not in cost_history.entries
+        # Never shorter than `setup_build_ext_timeout`.
+        assert prepared.py_file_kwargs[py_file].get('cpp_compiler_timeout', 600) >= 600
+
+    # Dropped on failure.
+    prepared.cost_history.record(key, 'x', 1, {'cpp_compiler': 1.0})
+    prepared.cost_history.remove(key)
+    prepared.cost_history.save()
+    assert key not in CostHistory(cost_history_fd).entries
+
+
+def test_package_folder_processor_with_default_cost_history(monkeypatch):
+    test_output_fd = get_test_output_fd()
+    input_fd = get_test_small_package_fd()
+    # Instead of `~/.cache`.
+    monkeypatch.setenv('XDG_CACHE_HOME', str(test_output_fd / 'cache'))
+
+    package_folder_processor = PackageFolderProcessor(
+        PackageFolderProcessorConfig(enable_cost_history=True)
+    )
+    for idx in range(2):
+        # A new working folder per run.
+        prepared = package_folder_processor.prepare(input_fd, None)
+        assert prepared.cost_history
+        assert bool(prepared.cost_history.entries) == (idx > 0)
+
+        output = package_folder_processor.run(
+            input_fd=input_fd,
+            output_fd=test_output_fd / 'output' / input_fd.name,
+        )
+        assert output.succeeded
+
+    cost_history = CostHistory(test_output_fd / 'cache' / 'pywhlobf')
+    assert len(cost_history.entries) == 4
@@ -1,12 +1,16 @@
 import sys
 import subprocess
 import os
+import time
+from pathlib import Path
 from multiprocessing import Process
 
 import iolite as io
+from setuptools import Extension
 
 from pywhlobf.component.cpp_generator import CppGeneratorConfig, CppGenerator
 from pywhlobf.component.string_literal_obfuscator import (
+    StringLiteralObfuscatorMode,
     StringLiteralObfuscatorConfig,
     StringLiteralObfuscator,
 )
@@ -16,7 +20,11 @@ from pywhlobf.component.source_code_injector import (
 )
 from pywhlobf.component.cpp_compiler import (
     CppCompilerConfig,
+    CppCompilerBackend,
+    CppCompilerBuildProfile,
+    CppCompilerStripMode,
     CppCompiler,
+    run_command,
 )
 from pywhlobf.command_line_interface import run_extension_file
 from tests.opt import get_test_output_fd, get_test_py_file
@@ -74,8 +82,7 @@ def test_cpp_compiler():
     assert encrypted_traceback.count('(pywhlobf') == 3
 
 
-def test_cpp_compiler_simple():
-    test_output_fd = get_test_output_fd()
+def run_cpp_compiler_simple(test_output_fd: Path, config: CppCompilerConfig):
     test_py_file = test_output_fd / 'simple.py'
     test_py_file.write_text(
         '''
@@ -91,7 +98,7 @@ if __name__ == '__main__':
     cpp_generator = CppGenerator(CppGeneratorConfig())
     _, ext_module = cpp_generator.run(test_py_file, output_fd)
 
-    cpp_compiler = CppCompiler(CppCompilerConfig(setup_build_ext_timeout=600))
+    cpp_compiler = CppCompiler(config)
     compiled_lib_file = cpp_compiler.run(
         ext_module=ext_module,
         working_fd=output_fd,
@@ -100,6 +107,7 @@ if __name__ == '__main__':
         source_code_injector_activated=False,
     )
     assert compiled_lib_file.is_file()
+    size_report = cpp_compiler.strip(compiled_lib_file)
 
     process = Process(
         target=run_extension_file,
@@ -108,3 +116,141 @@ if __name__ == '__main__':
     process.start()
     process.join(timeout=10)
     assert process.exitcode == 0
+
+    return size_report
+
+
+def test_cpp_compiler_simple():
+    run_cpp_compiler_simple(
+        get_test_output_fd(),
+        CppCompilerConfig(setup_build_ext_timeout=600, backend=CppCompilerBackend.DIRECT),
+    )
+
+
+def test_run_command(capsys):
+    command = [sys.executable, '-c', 'pass']
+    run_command(command, time.monotonic() + 60)
+    assert not capsys.readouterr().out
+    # Printed only if verbose.
+    run_command(command, time.monotonic() + 60, verbose=True)
+    assert sys.executable in capsys.readouterr().out
+
+
+def test_cpp_compiler_string_literal_obfuscator_mode():
+    cpp_compiler = CppCompiler(CppCompilerConfig())
+    for mode, cpp_std in (
+        (StringLiteralObfuscatorMode.TEMPLATE, '-std=c++14'),
+        (StringLiteralObfuscatorMode.XOR, '-std=c++11'),
+        (StringLiteralObfuscatorMode.ARENA, '-std=c++11'),
+    ):
+        ext_module = Extension(name='simple', sources=['simple.cpp'], language='c++')
+        cpp_compiler.configure_ext_module(
+            ext_module=ext_module,
+            include_fds=[],
+            string_literal_obfuscator_activated=True,
+            source_code_injector_activated=False,
+            string_literal_obfuscator_mode=mode,
+        )
+        assert cpp_std in ext_module.extra_compile_args
+
+
+def test_cpp_compiler_simple_setuptools_backend():
+    run_cpp_compiler_simple(
+        get_test_output_fd(),
+        CppCompilerConfig(setup_build_ext_timeout=600, backend=CppCompilerBackend.SETUPTOOLS),
+    )
+
+
+def test_cpp_compiler_build_profile():
+    test_output_fd = get_test_output_fd()
+
+    for build_profile in (
+        CppCompilerBuildProfile.FAST_BUILD,
+        CppCompilerBuildProfile.RELEASE,
+        CppCompilerBuildProfile.RELEASE_LTO,
+    ):
+        run_cpp_compiler_simple(
+            io.folder(test_output_fd / build_profile.value, touch=True),
+            CppCompilerConfig(
+                setup_build_ext_timeout=600,
+                build_profile=build_profile,
+                lto_jobs=2,
+            ),
+        )
+
+
+def run_cpp_compiler_precompiled_header(test_output_fd: Path, config: CppCompilerConfig):
+    output_fd = io.folder(test_output_fd / 'working', touch=True)
+
+    cpp_compiler = CppCompiler(config)
+    string_literal_obfuscator = StringLiteralObfuscator(StringLiteralObfuscatorConfig())
+
+    for name in ('foo', 'bar'):
+        test_py_file = test_output_fd / f'{name}.py'
+        test_py_file.write_text(f'print("{name}")\n')
+
+        cpp_generator = CppGenerator(CppGeneratorConfig())
+        cpp_file, ext_module = cpp_generator.run(test_py_file, output_fd)
+        _, include_fd = string_literal_obfuscator.run(cpp_file)
+        assert include_fd
+
+        compiled_lib_file = cpp_compiler.run(
+            ext_module=ext_module,
+            working_fd=output_fd,
+            include_fds=[include_fd],
+            string_literal_obfuscator_activated=True,
+            source_code_injector_activated=False,
+            precompiled_header_codes=[string_literal_obfuscator.get_header_code()],
+        )
+        assert compiled_lib_file.is_file()
+
+    # Shared by both modules.
+    gch_files = tuple(output_fd.glob('pywhlobf_pch/*/pywhlobf_pch.h.gch'))
+    assert len(gch_files) == 1
+    assert len(tuple(output_fd.glob('pywhlobf_pch/*'))) == 1
+
+
+def test_cpp_compiler_precompiled_header():
+    run_cpp_compiler_precompiled_header(
+        get_test_output_fd(),
+        CppCompilerConfig(setup_build_ext_timeout=600),
+    )
+
+
+def test_cpp_compiler_precompiled_header_reproducible():
+    # Not keyed by the per-module flags, e.g. `-frandom-seed`.
+    run_cpp_compiler_precompiled_header(
+        get_test_output_fd(),
+        CppCompilerConfig(setup_build_ext_timeout=600, enable_reproducible=True),
+    )
+
+
+def test_cpp_compiler_size_reduction():
+    test_output_fd = get_test_output_fd()
+
+    size_report = run_cpp_compiler_simple(
+        io.folder(test_output_fd / 'default', touch=True),
+        CppCompilerConfig(setup_build_ext_timeout=600),
+    )
+    assert size_report.before_strip == size_report.after_strip
+
+    reduced_size_report = run_cpp_compiler_simple(
+        io.folder(test_output_fd / 'reduced', touch=True),
+        CppCompilerConfig(
+            setup_build_ext_timeout=600,
+            enable_section_gc=True,
+            strip_mode=CppCompilerStripMode.UNNEEDED,
+        ),
+    )
+    assert reduced_size_report.after_strip < reduced_size_report.before_strip
+    assert reduced_size_report.after_strip < size_report.after_strip
+
+
+def test_cpp_compiler_limited_api():
+    test_output_fd = get_test_output_fd()
+    run_cpp_compiler_simple(
+        test_output_fd,
+        CppCompilerConfig(setup_build_ext_timeout=600, py_limited_api='cp39'),
+    )
+    if os.name == 'posix':
+        assert tuple((test_output_fd / 'working').glob('simple.abi3.so'))
@@ -0,0 +1,76 @@
+from typing import Iterable
+
+import iolite as io
+
+from pywhlobf.component.cpp_transform_pipeline import CppTransformPipeline
+from pywhlobf.code_file_processor import CodeFileProcessorConfig, CodeFileProcessor
+from pywhlobf.execution_context import ExecutionContextCollection
+from tests.opt import get_test_output_fd, get_test_py_file
+
+
+def test_cpp_transform_pipeline():
+    test_output_fd = get_test_output_fd()
+    cpp_file = test_output_fd / 'a.cpp'
+    cpp_file.write_text('a\na\n')
+
+    def append(suffix: str):
+
+        def transform_lines(lines: Iterable[str]):
+            for line in lines:
+                yield line.rstrip('\n') + suffix + '\n'
+
+        return transform_lines
+
+    cpp_transform_pipeline = CppTransformPipeline(debug=True)
+    cpp_transform_pipeline.register('first', append('b'))
+    cpp_transform_pipeline.register('second', append('c'))
+    execution_context_collection = ExecutionContextCollection(test_output_fd, verbose=False)
+    cpp_transform_pipeline.run(cpp_file, execution_context_collection)
+
+    assert execution_context_collection.succeeded
+    assert cpp_file.read_text() == 'abc\nabc\n'
+    assert (test_output_fd / 'a.cpp.bak_before_first').read_text() == 'a\na\n'
+    assert (test_output_fd / 'a.cpp.bak_before_second').read_text() == 'ab\nab\n'
+    assert cpp_transform_pipeline.transform_code('x\n') == 'xbc\n'
+
+    # The file is left untouched on failure.
+    def fail(lines: Iterable[str]):
+        for idx, line in enumerate(lines):
+            if idx > 0:
+                raise RuntimeError()
+            yield line
+
+    cpp_transform_pipeline = CppTransformPipeline()
+    cpp_transform_pipeline.register('first', append('d'))
+    cpp_transform_pipeline.register('fail', fail)
+    execution_context_collection = ExecutionContextCollection(test_output_fd, verbose=False)
+    cpp_transform_pipeline.run(cpp_file, execution_context_collection)
+
+    assert not execution_context_collection.succeeded
+    assert cpp_file.read_text() == 'abc\nabc\n'
+    assert not (test_output_fd / 'a.cpp.tmp').exists()
+
+
+def test_code_file_processor_debug():
+    test_output_fd = get_test_output_fd()
+    test_py_file = get_test_py_file()
+
+    for debug in (False, True):
+        working_fd = io.folder(test_output_fd / f'working_{debug}', touch=True)
+        output = CodeFileProcessor(CodeFileProcessorConfig(debug=debug)).run_generate(
+            py_file=test_py_file,
+            build_fd=working_fd,
+            logging_fd=working_fd,
+        )
+        print(output.execution_context_collection.get_logging_message())
+        assert output.execution_context_collection.succeeded
+        assert output.string_literal_obfuscator_activated
+
+        backup_names = sorted(path.name for path in working_fd.glob('**/*.cpp.bak_*'))
+        if debug:
+            assert backup_names == [
+                f'{test_py_file.stem}.cpp.bak_before_flag_setter',
+                f'{test_py_file.stem}.cpp.bak_before_string_literal_obfuscator',
+            ]
+        else:
+            assert not backup_names
@@ -0,0 +1,56 @@
+from pywhlobf.file_link import FileLinkStrategy, link_file, link_files
+from pywhlobf.package_folder_processor import (
+    PackageFolderProcessorConfig,
+    PackageFolderProcessor,
+)
+from tests.opt import get_test_output_fd, get_test_small_package_fd
+
+
+def test_link_file():
+    test_output_fd = get_test_output_fd()
+    src = test_output_fd / 'src.txt'
+    src.write_text('src')
+
+    dst = test_output_fd / 'dst.txt'
+    link_file(src, dst, FileLinkStrategy.LINK)
+    assert dst.read_text() == 'src'
+    assert dst.stat().st_ino == src.stat().st_ino
+
+    # The hard linked source is not touched.
+    link_file(test_output_fd / 'dst.txt', test_output_fd / 'other.txt')
+    (test_output_fd / 'other.txt').write_text('other')
+    link_file(test_output_fd / 'other.txt', dst, FileLinkStrategy.COPY)
+    assert dst.read_text() == 'other'
+    assert src.read_text() == 'src'
+
+    link_file(src, dst, FileLinkStrategy.REFLINK)
+    assert dst.read_text() == 'src'
+    assert dst.stat().st_ino != src.stat().st_ino
+
+    link_files(
+        [(src, test_output_fd / 'a' / f'{idx}.txt') for idx in range(10)],
+        FileLinkStrategy.LINK,
+    )
+    for idx in range(10):
+        assert (test_output_fd / 'a' / f'{idx}.txt').stat().st_ino == src.stat().st_ino
+
+
+def test_package_folder_processor_with_file_link():
+    test_output_fd = get_test_output_fd()
+    input_fd = get_test_small_package_fd()
+    output_fd = test_output_fd / 'output' / input_fd.name
+
+    package_folder_processor = PackageFolderProcessor(
+        PackageFolderProcessorConfig(file_link_strategy=FileLinkStrategy.LINK)
+    )
+    output = package_folder_processor.run(
+        input_fd=input_fd,
+        output_fd=output_fd,
+        working_fd=test_output_fd / 'working',
+    )
+    assert output.succeeded
+
+    assert (output_fd / 'sub' / 'data.txt').stat().st_ino \
+        == (input_fd / 'sub' / 'data.txt').stat().st_ino
+    assert not tuple(output_fd.glob('**/*.py'))
+    assert len(tuple(output_fd.glob('**/*.so'))) == 4
@@ -1,14 +1,27 @@
 import os
 import sys
 import subprocess
+import shutil
 
-from pywhlobf.component.cpp_compiler import CppCompilerConfig
+import pytest
+
+from pywhlobf.component.cpp_compiler import (
+    CppCompilerConfig,
+    CppCompilerTargetConfig,
+    CppCompilerKind,
+    CppCompiler,
+)
 from pywhlobf.code_file_processor import CodeFileProcessorConfig
 from pywhlobf.package_folder_processor import (
     PackageFolderProcessorConfig,
     PackageFolderProcessor,
 )
-from tests.opt import get_test_output_fd, get_test_code_fd
+from tests.opt import (
+    get_test_output_fd,
+    get_test_code_fd,
+    get_test_small_package_fd,
+    run_small_package,
+)
 
 
 def test_package_folder_processor():
@@ -61,3 +74,143 @@ def test_package_folder_processor():
 
     assert not process.stderr
     assert process.stdout and not process.stdout.strip().endswith('.py')
+
+
+def test_package_folder_processor_pipeline():
+    test_output_fd = get_test_output_fd()
+    input_fd = get_test_small_package_fd()
+    output_fd = test_output_fd / 'output' / input_fd.name
+
+    package_folder_processor = PackageFolderProcessor(
+        PackageFolderProcessorConfig(
+            enable_pipeline=True,
+            num_cpp_generator_processes=1,
+            num_cpp_compiler_processes=2,
+            pipeline_queue_size=1,
+        )
+    )
+    output = package_folder_processor.run(
+        input_fd=input_fd,
+        output_fd=output_fd,
+        working_fd=test_output_fd / 'working',
+    )
+    print(output.get_logging_message())
+    assert output.succeeded
+    assert len(output.succeeded_outputs) == 4
+    assert len(output.compiled_lib_size_reports) == 4
+    assert not tuple(output_fd.glob('**/*.py'))
+    assert (output_fd / 'sub' / 'data.txt').is_file()
+
+    assert run_small_package(sys.executable, test_output_fd / 'output') == 'foofoo'
+
+
+def test_package_folder_processor_unity_build():
+    test_output_fd = get_test_output_fd()
+    input_fd = get_test_small_package_fd()
+    output_fd = test_output_fd / 'output' / input_fd.name
+
+    package_folder_processor = PackageFolderProcessor(
+        PackageFolderProcessorConfig(enable_unity_build=True)
+    )
+    output = package_folder_processor.run(
+        input_fd=input_fd,
+        output_fd=output_fd,
+        working_fd=test_output_fd / 'working',
+    )
+    print(output.get_logging_message())
+    assert output.succeeded
+    assert output.unity_build_lib_file
+    # Single shared library at the package root.
+    compiled_lib_files = [path for path in output_fd.glob('**/*') if path.suffix in ('.so', '.pyd')]
+    assert compiled_lib_files == [output_fd / output.unity_build_lib_file.name]
+    assert not tuple(output_fd.glob('**/*.py'))
+    assert (output_fd / 'sub' / 'data.txt').is_file()
+
+    assert run_small_package(
+        sys.executable,
+        test_output_fd / 'output',
+        'import pkg.sub.b; print(pkg.sub.b.bar(2)); print(pkg.sub.b.__name__)',
+    ).split() == ['foofoo', 'pkg.sub.b']
+
+
+def test_package_folder_processor_pgo():
+    cpp_compiler_kind = CppCompiler(CppCompilerConfig()).cpp_compiler_kind
+    if cpp_compiler_kind not in (CppCompilerKind.GCC, CppCompilerKind.CLANG):
+        pytest.skip('PGO requires GCC or Clang.')
+
+    test_output_fd = get_test_output_fd()
+    input_fd = get_test_small_package_fd()
+    output_fd = test_output_fd / 'output' / input_fd.name
+    working_fd = test_output_fd / 'working'
+
+    package_folder_processor = PackageFolderProcessor(
+        PackageFolderProcessorConfig(
+            pgo_workload_command=(
+                sys.executable,
+                '-c',
+                'import pkg.sub.b, pkg.sub.b as b; [b.bar(n) for n in range(1000)]; '
+                'assert not b.__file__.endswith(".py")',
+            ),
+        )
+    )
+    output = package_folder_processor.run(
+        input_fd=input_fd,
+        output_fd=output_fd,
+        working_fd=working_fd,
+    )
+    print(output.get_logging_message(verbose=True))
+    assert output.succeeded
+    assert len(output.succeeded_outputs) == 4
+    # Collected by the instrumented package.
+    pgo_profile_fd = working_fd / 'p' / 'profile'
+    if cpp_compiler_kind == CppCompilerKind.GCC:
+        assert tuple(pgo_profile_fd.glob('**/*.gcda'))
+    else:
+        # Merged from the `.profraw` files.
+        assert (pgo_profile_fd / 'default.profdata').is_file()
+
+    assert run_small_package(sys.executable, test_output_fd / 'output') == 'foofoo'
+
+
+def find_other_python_executable():
+    for minor in (12, 13, 10, 9):
+        if minor == sys.version_info.minor:
+            continue
+        python_executable = shutil.which(f'python3.{minor}')
+        if python_executable and subprocess.run(
+            [python_executable, '-c', 'pass'],
+            capture_output=True,
+        ).returncode == 0:
+            return python_executable
+    return None
+
+
+def test_package_folder_processor_targets():
+    test_output_fd = get_test_output_fd()
+    input_fd = get_test_small_package_fd()
+
+    python_executables = [sys.executable]
+    other_python_executable = find_other_python_executable()
+    if other_python_executable:
+        python_executables.append(other_python_executable)
+
+    package_folder_processor = PackageFolderProcessor(PackageFolderProcessorConfig())
+    output_fds = [
+        test_output_fd / f'output_{idx}' / input_fd.name
+        for idx in range(len(python_executables))
+    ]
+    outputs = package_folder_processor.run_targets(
+        input_fd=input_fd,
+        cpp_compiler_targets=[
+            CppCompilerTargetConfig(python_executable=python_executable)
+            for python_executable in python_executables
+        ],
+        output_fds=output_fds,
+        working_fd=test_output_fd / 'working',
+    )
+    assert len(outputs) == len(python_executables)
+
+    for output, output_fd, python_executable in zip(outputs, output_fds, python_executables):
+        print(output.get_logging_message())
+        assert output.succeeded
+        assert run_small_package(python_executable, output_fd.parent) == 'foofoo'
@@ -1,8 +1,21 @@
+import base64
+import os
+import subprocess
+import sys
+
+import pytest
+from cryptography.fernet import Fernet
+
 from pywhlobf.component.cpp_generator import CppGeneratorConfig, CppGenerator
+from pywhlobf.component.flag_setter import FlagSetterConfig
+from pywhlobf.component.string_literal_obfuscator import StringLiteralObfuscatorConfig
 from pywhlobf.component.source_code_injector import (
+    DeterministicFernet,
+    SourceCodePayloadFormat,
     SourceCodeInjectorConfig,
     SourceCodeInjector,
 )
+from pywhlobf.code_file_processor import CodeFileProcessorConfig, CodeFileProcessor
 from tests.opt import get_test_output_fd, get_test_py_file
 
 
@@ -21,3 +34,170 @@ def test_source_code_injector():
         cpp_file=cpp_file,
     )
     assert activated
+
+
+def test_source_code_injector_pyx_mark_err_pos():
+    test_py_file = get_test_py_file()
+    source_code_injector = SourceCodeInjector(
+        SourceCodeInjectorConfig(fernet_key='WwAPKBMXKl-I43L4u8B5WD9xoperM9qhXDlLVWRFkiY=')
+    )
+
+    # Both the single line and the backslash continued forms.
+    for macro in (
+        '#define __PYX_MARK_ERR_POS(f_index, lineno)  { __pyx_lineno = lineno; }\n',
+        '#define __PYX_MARK_ERR_POS(f_index, lineno) \\\n    { __pyx_lineno = lineno; }\n',
+    ):
+        lines = [
+            'static const char *__pyx_filename;\n',
+            macro,
+            'int main() {\n',
+            '  const char *__pyx_filename = NULL;\n',
+            '}\n',
+        ]
+        code = ''.join(source_code_injector.transform_lines(test_py_file, lines))
+
+        assert code.count('get_encrypted_src_code_file()') == 2
+        # Nothing is added to the function scope.
+        assert '__pyx_temp_file' not in code
+        assert code.endswith('int main() {\n  const char *__pyx_filename = NULL;\n}\n')
+        macro_code = code[code.index('#define __PYX_MARK_ERR_POS'):code.index('int main()')]
+        assert macro_code.rstrip().endswith('}')
+        assert 'get_encrypted_src_code_file();' in macro_code
+
+
+def test_source_code_injector_compact_payload():
+    test_py_file = get_test_py_file()
+    fernet_key = 'WwAPKBMXKl-I43L4u8B5WD9xoperM9qhXDlLVWRFkiY='
+    fernet = Fernet(fernet_key.encode())
+
+    codes = {}
+    for payload_format in SourceCodePayloadFormat:
+        source_code_injector = SourceCodeInjector(
+            SourceCodeInjectorConfig(fernet_key=fernet_key, payload_format=payload_format)
+        )
+        codes[payload_format] = ''.join(
+            source_code_injector.transform_lines(
+                test_py_file,
+                ['#define __PYX_MARK_ERR_POS(f_index, lineno)  { __pyx_lineno = lineno; }\n'],
+            )
+        )
+    assert len(codes[SourceCodePayloadFormat.COMPACT]) < len(codes[SourceCodePayloadFormat.LINES])
+
+    # The temporary file content written by the C++ code.
+    payload = SourceCodeInjector.encrypt_compact(fernet, test_py_file.read_text())
+    encrypted_message = f'(pywhlobf-compact {base64.urlsafe_b64encode(payload).decode()})\n'
+    assert SourceCodeInjector.decrept(fernet, encrypted_message) \
+        == test_py_file.read_text() + '\n'
+
+
+@pytest.mark.benchmark
+def test_source_code_injector_call_overhead():
+    test_output_fd = get_test_output_fd()
+    py_file = test_output_fd / 'call_overhead.py'
+    py_file.write_text('''\
+def add(a, b):
+    return a + b
+
+
+def call(n):
+    total = 0
+    for idx in range(n):
+        total = add(total, idx)
+    return total
+
+
+def fallback(mapping):
+    try:
+        return mapping['missing']
+    except KeyError:
+        return None
+''')
+
+    plain_config = CodeFileProcessorConfig(
+        flag_setter_config=FlagSetterConfig(enable=False),
+        string_literal_obfuscator_config=StringLiteralObfuscatorConfig(enable=False),
+        source_code_injector_config=SourceCodeInjectorConfig(enable=False),
+    )
+    injected_config = CodeFileProcessorConfig(
+        flag_setter_config=FlagSetterConfig(enable=False),
+        string_literal_obfuscator_config=StringLiteralObfuscatorConfig(enable=False),
+        source_code_injector_config=SourceCodeInjectorConfig(
+            fernet_key='WwAPKBMXKl-I43L4u8B5WD9xoperM9qhXDlLVWRFkiY='
+        ),
+    )
+
+    elapsed = {}
+    for name, config in (('plain', plain_config), ('injected', injected_config)):
+        working_fd = test_output_fd / name
+        output = CodeFileProcessor(config).run(
+            py_file=py_file,
+            build_fd=working_fd,
+            logging_fd=working_fd,
+        )
+        print(output.execution_context_collection.get_logging_message())
+        assert output.execution_context_collection.succeeded
+
+        env = os.environ.copy()
+        env['PYTHONPATH'] = str(working_fd)
+        process = subprocess.run(
+            [
+                sys.executable,
+                '-c',
+                (
+                    'import timeit; '
+                    'print(min(timeit.repeat("add(1, 2); call(100); fallback({})", '
+                    'setup="from call_overhead import add, call, fallback", '
+                    'number=20000, repeat=7)))'
+                ),
+            ],
+            env=env,
+            capture_output=True,
+            text=True,
+            check=True,
+        )
+        elapsed[name] = float(process.stdout.strip())
+
+    print(elapsed)
+    # The normal call path is not changed, and the exception path doesn't touch the file system
+    # after the first error. Allows some noise.
+    assert elapsed['injected'] < elapsed['plain'] * 1.5
+
+
+def test_deterministic_fernet():
+    fernet_key = b'WwAPKBMXKl-I43L4u8B5WD9xoperM9qhXDlLVWRFkiY='
+    fernet = Fernet(fernet_key)
+    deterministic_fernet = DeterministicFernet(fernet_key)
+
+    for data in (b'', b'a', b'a' * 16, b'source code\n' * 100):
+        token = deterministic_fernet.encrypt(data)
+        assert token == deterministic_fernet.encrypt(data)
+        assert fernet.decrypt(token) == data
+        assert deterministic_fernet.decrypt(token) == data
+    assert deterministic_fernet.encrypt(b'a') != deterministic_fernet.encrypt(b'b')
+    assert DeterministicFernet(Fernet.generate_key()).encrypt(b'a') \
+        != deterministic_fernet.encrypt(b'a')
+
+
+def test_source_code_injector_deterministic():
+    test_py_file = get_test_py_file()
+    fernet_key = 'WwAPKBMXKl-I43L4u8B5WD9xoperM9qhXDlLVWRFkiY='
+    lines = ['#define __PYX_MARK_ERR_POS(f_index, lineno)  { __pyx_lineno = lineno; }\n']
+
+    for payload_format in SourceCodePayloadFormat:
+        codes = []
+        for enable_deterministic_encryption in (True, True, False):
+            source_code_injector = SourceCodeInjector(
+                SourceCodeInjectorConfig(
+                    fernet_key=fernet_key,
+                    payload_format=payload_format,
+                    enable_deterministic_encryption=enable_deterministic_encryption,
+                )
+            )
+            codes.append(''.join(source_code_injector.transform_lines(test_py_file, lines)))
+        assert codes[0] == codes[1]
+        assert codes[0] != codes[2]
+
+    # Still decrypted by `decrypt_message`.
+    fernet = Fernet(fernet_key.encode())
+    encrypted = SourceCodeInjector.encrypt(DeterministicFernet(fernet_key.encode()), 'foo')
+    assert SourceCodeInjector.decrept(fernet, f'File "{encrypted}"') == 'File "foo"'
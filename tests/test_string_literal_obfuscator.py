@@ -1,8 +1,23 @@
+import re
+import time
+import os
+import subprocess
+import sys
+from pathlib import Path
+
+import pytest
+
 from pywhlobf.component.cpp_generator import CppGeneratorConfig, CppGenerator
+from pywhlobf.component.flag_setter import FlagSetterConfig
+from pywhlobf.component.source_code_injector import SourceCodeInjectorConfig
 from pywhlobf.component.string_literal_obfuscator import (
+    StringLiteralObfuscatorMode,
     StringLiteralObfuscatorConfig,
     StringLiteralObfuscator,
+    parse_c_string_literal_value,
+    xor_encrypt_arena,
 )
+from pywhlobf.code_file_processor import CodeFileProcessorConfig, CodeFileProcessor
 from tests.opt import get_test_output_fd, get_test_py_file
 
 
@@ -16,3 +31,216 @@ def test_string_literal_obfuscator():
     string_literal_obfuscator = StringLiteralObfuscator(StringLiteralObfuscatorConfig())
     _, include_fd = string_literal_obfuscator.run(cpp_file)
     assert include_fd
+
+
+def obfuscate_static_char_literal_per_variable(with_const: bool, code: str):
+    # The previous implementation, one pass per variable.
+    drop_const = StringLiteralObfuscator.drop_const
+    pattern = drop_const(with_const, r'^static const char (\w+)\[\] = \"(.*?)\";$')
+    var_names = [var_name for var_name, _ in re.findall(pattern, code, flags=re.MULTILINE)]
+    code = re.sub(
+        pattern,
+        '\n'.join([
+            f'/* Changed by pywhlobf StringLiteralObfuscator (with_const={with_const}). */',
+            drop_const(with_const, r'static const char *\1 = AY_OBFUSCATE("\2");'),
+            r'static const long __length\1 = AY_OBFUSCATE_HACK_LENGTH("\2");',
+        ]),
+        code,
+        flags=re.MULTILINE,
+    )
+    for var_name in var_names:
+        code = re.sub(
+            r'sizeof\(' + var_name + r'\)',
+            (
+                f'__length{var_name} '
+                f'/* Changed by pywhlobf StringLiteralObfuscator (with_const={with_const}). */'
+            ),
+            code,
+        )
+    return code
+
+
+def generate_synthetic_code(num_strings: int):
+    lines = []
+    for idx in range(num_strings):
+        const = 'const ' if idx % 2 == 0 else ''
+        lines.append(f'static {const}char __pyx_k_{idx}[] = "string_{idx}";')
+    for idx in range(num_strings):
+        lines.append(f'  {{&__pyx_k_{idx}, __pyx_k_{idx}, sizeof(__pyx_k_{idx}), 0, 0, 1, 1}},')
+    return '\n'.join(lines) + '\n'
+
+
+def test_string_literal_obfuscator_single_pass():
+    output_fd = get_test_output_fd()
+    test_py_file = get_test_py_file()
+
+    cpp_generator = CppGenerator(CppGeneratorConfig())
+    cpp_file, _ = cpp_generator.run(test_py_file, output_fd)
+
+    for code in (cpp_file.read_text(), generate_synthetic_code(100)):
+        expected = obfuscate_static_char_literal_per_variable(True, code)
+        expected = obfuscate_static_char_literal_per_variable(False, expected)
+        assert StringLiteralObfuscator.obfuscate_static_char_literals(code) == expected
+
+
+@pytest.mark.benchmark
+def test_string_literal_obfuscator_scaling():
+    # Benchmark on a synthetic module with 10k strings.
+    elapsed = {}
+    for num_strings in (1000, 10000):
+        code = generate_synthetic_code(num_strings)
+        begin = time.perf_counter()
+        code = StringLiteralObfuscator.obfuscate_static_char_literals(code)
+        elapsed[num_strings] = time.perf_counter() - begin
+        assert code.count('AY_OBFUSCATE(') == num_strings
+        assert 'sizeof(' not in code
+
+    print(f'elapsed={elapsed}')
+    # Linear, the per-variable passes would take minutes here.
+    assert elapsed[10000] < 5.0
+    assert elapsed[10000] < 30 * max(elapsed[1000], 0.01)
+
+
+def test_parse_c_string_literal_value():
+    assert parse_c_string_literal_value('') == b''
+    assert parse_c_string_literal_value(r'a\"b\\c\n\t\?') == b'a"b\\c\n\t?'
+    assert parse_c_string_literal_value(r'\0\1\047\3770') == b'\x00\x01\x27\xff0'
+    assert parse_c_string_literal_value(r'\x41\x7fz') == b'A\x7fz'
+    assert parse_c_string_literal_value(r'ab""cd" "ef') == b'abcdef'
+    assert parse_c_string_literal_value('\u4e2d') == '\u4e2d'.encode()
+
+    # Octal escapes as emitted by Cython.
+    data = bytes(range(256))
+    value = ''.join(f'\\{val:03o}' for val in data)
+    assert parse_c_string_literal_value(value) == data
+
+
+def test_string_literal_obfuscator_xor():
+    code = StringLiteralObfuscator.obfuscate_static_char_literals(
+        generate_synthetic_code(10),
+        StringLiteralObfuscatorMode.XOR,
+    )
+    assert 'AY_OBFUSCATE' not in code
+    assert '"string_' not in code
+    assert code.count('pywhlobf_decode_string_literal(') == 10
+    assert 'static const long __length__pyx_k_1 = 9;' in code
+    # Deterministic.
+    assert code == StringLiteralObfuscator.obfuscate_static_char_literals(
+        generate_synthetic_code(10),
+        StringLiteralObfuscatorMode.XOR,
+    )
+
+    build_and_run_strings_module(StringLiteralObfuscatorMode.XOR)
+
+
+def test_string_literal_obfuscator_arena():
+    code = StringLiteralObfuscator.obfuscate_static_char_literals(
+        generate_synthetic_code(10),
+        StringLiteralObfuscatorMode.ARENA,
+    )
+    assert '"string_' not in code
+    assert code.count('(__pywhlobf_arena + ') == 10
+    assert code.count('pywhlobf_decode_arena(') == 1
+    assert 'pywhlobf_decode_string_literal(' not in code
+
+    # The same literals are encrypted differently at different offsets.
+    data = b'pywhlobf' * 4
+    _, encrypted_data = xor_encrypt_arena(data)
+    assert len({encrypted_data[idx:idx + 8] for idx in range(0, 32, 8)}) == 4
+    assert 'static char *__pyx_k_1 = (char *)(__pywhlobf_arena + 9);' in code
+    assert 'static const long __length__pyx_k_1 = 9;' in code
+
+    build_and_run_strings_module(StringLiteralObfuscatorMode.ARENA)
+
+
+def build_module(
+    py_file: Path,
+    working_fd: Path,
+    mode: StringLiteralObfuscatorMode,
+):
+    config = CodeFileProcessorConfig(
+        flag_setter_config=FlagSetterConfig(enable=False),
+        string_literal_obfuscator_config=StringLiteralObfuscatorConfig(mode=mode),
+        source_code_injector_config=SourceCodeInjectorConfig(enable=False),
+    )
+    output = CodeFileProcessor(config).run(
+        py_file=py_file,
+        build_fd=working_fd,
+        logging_fd=working_fd,
+    )
+    print(output.execution_context_collection.get_logging_message())
+    assert output.execution_context_collection.succeeded
+    assert output.compiled_lib_file
+    return output.compiled_lib_file
+
+
+def build_and_run_strings_module(mode: StringLiteralObfuscatorMode):
+    test_output_fd = get_test_output_fd(frames_offset=1)
+    py_file = test_output_fd / 'strings_module.py'
+    py_file.write_text('''\
+def show():
+    print('pywhlobf_secret_string')
+    print('\\u4e2d\\n"tab\\t"')
+    print(repr(b'\\x00\\xff\\\\ bytes'))
+''')
+
+    working_fd = test_output_fd / 'working'
+    compiled_lib_file = build_module(py_file, working_fd, mode)
+    assert b'pywhlobf_secret_string' not in compiled_lib_file.read_bytes()
+
+    env = os.environ.copy()
+    env['PYTHONPATH'] = str(working_fd)
+    process = subprocess.run(
+        [sys.executable, '-c', 'import strings_module; strings_module.show()'],
+        env=env,
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    assert process.stdout == (
+        'pywhlobf_secret_string\n'
+        '\u4e2d\n"tab\t"\n'
+        "b'\\x00\\xff\\\\ bytes'\n"
+    )
+
+
+@pytest.mark.benchmark
+def test_string_literal_obfuscator_import_latency():
+    test_output_fd = get_test_output_fd()
+    py_file = test_output_fd / 'many_strings.py'
+    py_file.write_text(
+        'STRINGS = [\n'
+        + ''.join(f"    'string literal {idx}',\n" for idx in range(1000))
+        + ']\n'
+    )
+
+    elapsed = {}
+    for mode in (StringLiteralObfuscatorMode.TEMPLATE, StringLiteralObfuscatorMode.ARENA):
+        working_fd = test_output_fd / mode.value
+        build_module(py_file, working_fd, mode)
+
+        env = os.environ.copy()
+        env['PYTHONPATH'] = str(working_fd)
+        elapsed[mode] = min(
+            float(
+                subprocess.run(
+                    [
+                        sys.executable,
+                        '-c',
+                        (
+                            'import time; begin = time.perf_counter(); '
+                            'import many_strings; print(time.perf_counter() - begin)'
+                        ),
+                    ],
+                    env=env,
+                    capture_output=True,
+                    text=True,
+                    check=True,
+                ).stdout
+            ) for _ in range(10)
+        )
+
+    print(f'elapsed={elapsed}')
+    # Allows some noise.
+    assert elapsed[StringLiteralObfuscatorMode.ARENA] \
+        < elapsed[StringLiteralObfuscatorMode.TEMPLATE] * 1.5
@@ -1,11 +1,29 @@
-from pywhlobf.component.cpp_compiler import CppCompilerConfig
+import os
+import sys
+import zipfile
+import hashlib
+
+import pytest
+
+from wheel.wheelfile import WheelFile
+from cryptography.fernet import Fernet
+
+from pywhlobf.component.cpp_compiler import CppCompilerConfig, CppCompilerTargetConfig
+from pywhlobf.component.source_code_injector import SourceCodeInjectorConfig
 from pywhlobf.code_file_processor import CodeFileProcessorConfig
 from pywhlobf.package_folder_processor import PackageFolderProcessorConfig
+from pywhlobf.wheel_writer import WheelWriterConfig, WheelWriter
 from pywhlobf.wheel_file_processor import (
     WheelFileProcessorConfig,
     WheelFileProcessor,
+    generate_wheel_name,
+)
+from tests.opt import (
+    get_test_output_fd,
+    get_test_wheel_file,
+    get_test_small_package_fd,
+    run_small_package,
 )
-from tests.opt import get_test_output_fd, get_test_wheel_file
 
 
 def test_wheel_file_processor():
@@ -23,3 +41,264 @@ def test_wheel_file_processor():
     output = wheel_file_processor.run(wheel_file=wheel_file, working_fd=working_fd)
     print(output.execution_context_collection.get_logging_message())
     assert output.succeeded
+
+
+def test_generate_wheel_name():
+    assert generate_wheel_name(
+        distribution='foo',
+        version='1.0',
+        abi_tag='abi3',
+        platform_tag='linux-x86_64',
+        python_tag='cp39',
+    ) == 'foo-1.0-cp39-abi3-linux_x86_64.whl'
+
+
+def test_wheel_writer():
+    test_output_fd = get_test_output_fd()
+
+    input_fd = test_output_fd / 'input'
+    (input_fd / 'pkg').mkdir(parents=True)
+    (input_fd / 'pkg' / 'a.py').write_text('print(1)\n' * 1000)
+    (input_fd / 'pkg' / 'b.so').write_bytes(os.urandom(4096))
+    (input_fd / 'pkg-1.0.dist-info').mkdir()
+    (input_fd / 'pkg-1.0.dist-info' / 'METADATA').write_text('Name: pkg\n')
+
+    wheel_file = test_output_fd / 'pkg-1.0-py3-none-any.whl'
+    wheel_writer = WheelWriter(
+        wheel_file,
+        WheelWriterConfig(compress_level=9, store_file_patterns=['**/*.so'], num_threads=2),
+    )
+    wheel_writer.write_fd(input_fd)
+    wheel_writer.close()
+
+    # RECORD is verified on read.
+    with WheelFile(wheel_file) as wf:
+        assert wf.namelist() == [
+            'pkg/a.py',
+            'pkg/b.so',
+            'pkg-1.0.dist-info/METADATA',
+            'pkg-1.0.dist-info/RECORD',
+        ]
+        for name in wf.namelist():
+            wf.read(name)
+        assert wf.getinfo('pkg/a.py').compress_type == zipfile.ZIP_DEFLATED
+        assert wf.getinfo('pkg/a.py').compress_size < 1000
+        assert wf.getinfo('pkg/b.so').compress_type == zipfile.ZIP_STORED
+        assert wf.read('pkg/b.so') == (input_fd / 'pkg' / 'b.so').read_bytes()
+
+
+def test_wheel_writer_large_members():
+    test_output_fd = get_test_output_fd()
+
+    input_fd = test_output_fd / 'input'
+    (input_fd / 'pkg').mkdir(parents=True)
+    for idx in (0, 1):
+        (input_fd / 'pkg' / f'{idx}.py').write_text(f'print({idx})\n' * 100)
+    # Streamed.
+    (input_fd / 'pkg' / '2.so').write_bytes(os.urandom(4096))
+    (input_fd / 'pkg' / '3.py').write_text('print(3)\n' * 1000)
+    (input_fd / 'pkg-1.0.dist-info').mkdir()
+    (input_fd / 'pkg-1.0.dist-info' / 'METADATA').write_text('Name: pkg\n')
+
+    wheel_file = test_output_fd / 'pkg-1.0-py3-none-any.whl'
+    wheel_writer = WheelWriter(
+        wheel_file,
+        WheelWriterConfig(
+            store_file_patterns=['**/*.so'],
+            num_threads=2,
+            max_pending_size=1000,
+            stream_file_size_threshold=1000,
+        ),
+    )
+    wheel_writer.write_fd(input_fd)
+    wheel_writer.close()
+
+    with WheelFile(wheel_file) as wf:
+        assert wf.namelist() == [
+            'pkg/0.py',
+            'pkg/1.py',
+            'pkg/2.so',
+            'pkg/3.py',
+            'pkg-1.0.dist-info/METADATA',
+            'pkg-1.0.dist-info/RECORD',
+        ]
+        for name in wf.namelist():
+            if name.startswith('pkg/'):
+                assert wf.read(name) == (input_fd / name).read_bytes()
+        assert wf.getinfo('pkg/0.py').compress_type == zipfile.ZIP_DEFLATED
+        assert wf.getinfo('pkg/0.py').compress_size < 1000
+        assert wf.getinfo('pkg/2.so').compress_type == zipfile.ZIP_STORED
+        assert wf.getinfo('pkg/3.py').compress_type == zipfile.ZIP_DEFLATED
+        assert wf.getinfo('pkg/3.py').compress_size < 1000
+
+
+def test_wheel_writer_reproducible(monkeypatch):
+    test_output_fd = get_test_output_fd()
+    monkeypatch.setenv('SOURCE_DATE_EPOCH', '1700000000')
+
+    wheel_files = []
+    for idx in range(2):
+        input_fd = test_output_fd / f'input_{idx}'
+        (input_fd / 'pkg').mkdir(parents=True)
+        (input_fd / 'pkg' / 'a.py').write_text('print(1)\n')
+        (input_fd / 'pkg' / 'b.so').write_bytes(b'b')
+        (input_fd / 'pkg-1.0.dist-info').mkdir()
+        (input_fd / 'pkg-1.0.dist-info' / 'METADATA').write_text('Name: pkg\n')
+        # Different mtime and permissions.
+        os.utime(input_fd / 'pkg' / 'a.py', (idx * 1000000, idx * 1000000))
+        os.chmod(input_fd / 'pkg' / 'a.py', 0o600 if idx else 0o664)
+        os.chmod(input_fd / 'pkg' / 'b.so', 0o700 if idx else 0o775)
+
+        wheel_file = test_output_fd / f'pkg-1.0-py3-none-any_{idx}.whl'
+        wheel_writer = WheelWriter(wheel_file, WheelWriterConfig(enable_reproducible=True))
+        wheel_writer.write_fd(input_fd)
+        wheel_writer.close()
+        wheel_files.append(wheel_file)
+
+    assert wheel_files[0].read_bytes() == wheel_files[1].read_bytes()
+
+    with WheelFile(wheel_files[0]) as wf:
+        for zip_info in wf.infolist():
+            wf.read(zip_info)
+            assert zip_info.date_time == (2023, 11, 14, 22, 13, 20)
+        assert wf.getinfo('pkg/a.py').external_attr >> 16 == 0o100644
+        assert wf.getinfo('pkg/b.so').external_attr >> 16 == 0o100755
+        assert wf.getinfo('pkg-1.0.dist-info/RECORD').external_attr >> 16 == 0o100644
+
+
+def build_test_small_package_wheel(test_output_fd):
+    input_fd = get_test_small_package_fd()
+
+    # Build a wheel with a data file.
+    dist_info_fd = test_output_fd / 'input' / 'pkg-1.0.dist-info'
+    dist_info_fd.mkdir(parents=True)
+    (dist_info_fd / 'METADATA').write_text('Metadata-Version: 2.1\nName: pkg\nVersion: 1.0\n')
+    (dist_info_fd / 'WHEEL').write_text('Wheel-Version: 1.0\nRoot-Is-Purelib: true\n')
+    wheel_file = test_output_fd / 'pkg-1.0-py3-none-any.whl'
+    with WheelFile(wheel_file, 'w') as wf:
+        for file in sorted(input_fd.glob('**/*')):
+            if file.is_file():
+                wf.write(file, f'pkg/{file.relative_to(input_fd).as_posix()}')
+        wf.write_files(str(test_output_fd / 'input'))
+
+    return wheel_file
+
+
+def test_wheel_file_processor_streaming():
+    test_output_fd = get_test_output_fd()
+    wheel_file = build_test_small_package_wheel(test_output_fd)
+
+    wheel_file_processor = WheelFileProcessor(WheelFileProcessorConfig(enable_streaming=True))
+    output = wheel_file_processor.run(wheel_file=wheel_file, working_fd=test_output_fd / 'working')
+    print(output.execution_context_collection.get_logging_message())
+    assert output.succeeded
+    assert output.output_wheel_file
+
+    with zipfile.ZipFile(wheel_file) as input_zip_file, \
+            zipfile.ZipFile(output.output_wheel_file) as output_zip_file:
+        names = set(output_zip_file.namelist())
+        assert not any(name.endswith('.py') for name in names)
+        assert sum(name.startswith('pkg/sub/b.') for name in names) == 1
+        # Copied as is.
+        for name in ('pkg/sub/data.txt', 'pkg-1.0.dist-info/METADATA'):
+            input_zip_info = input_zip_file.getinfo(name)
+            output_zip_info = output_zip_file.getinfo(name)
+            assert output_zip_info.CRC == input_zip_info.CRC
+            assert output_zip_info.compress_size == input_zip_info.compress_size
+
+    # RECORD is verified on read.
+    extracted_fd = test_output_fd / 'extracted'
+    with WheelFile(output.output_wheel_file) as wf:
+        wf.extractall(extracted_fd)
+
+    assert run_small_package(sys.executable, extracted_fd) == 'foofoo'
+
+
+def test_wheel_file_processor_targets():
+    test_output_fd = get_test_output_fd()
+    wheel_file = build_test_small_package_wheel(test_output_fd)
+
+    wheel_file_processor = WheelFileProcessor(
+        WheelFileProcessorConfig(
+            cpp_compiler_targets=[CppCompilerTargetConfig(python_executable=sys.executable)],
+        )
+    )
+    output = wheel_file_processor.run(wheel_file=wheel_file, working_fd=test_output_fd / 'working')
+    print(output.get_logging_message())
+    assert output.succeeded
+    assert len(output.output_wheel_files) == 1
+
+    python_tag = 'cp' + ''.join(map(str, sys.version_info[:2]))
+    assert output.output_wheel_files[0].name.startswith(f'pkg-1.0-{python_tag}-{python_tag}-')
+
+    extracted_fd = test_output_fd / 'extracted'
+    with WheelFile(output.output_wheel_files[0]) as wf:
+        wf.extractall(extracted_fd)
+    assert run_small_package(sys.executable, extracted_fd) == 'foofoo'
+
+
+def test_wheel_file_processor_limited_api():
+    test_output_fd = get_test_output_fd()
+    wheel_file = build_test_small_package_wheel(test_output_fd)
+
+    config = WheelFileProcessorConfig()
+    config.package_folder_processor_config.code_file_processor_config \
+        .cpp_compiler_config.py_limited_api = 'cp39'
+    output = WheelFileProcessor(config).run(
+        wheel_file=wheel_file,
+        working_fd=test_output_fd / 'working',
+    )
+    print(output.get_logging_message())
+    assert output.succeeded
+    assert output.output_wheel_files == [output.output_wheel_file]
+    assert output.output_wheel_file
+    assert output.output_wheel_file.name.startswith('pkg-1.0-cp39-abi3-')
+
+    # One wheel for all the versions, instead of one per target.
+    config.cpp_compiler_targets = [CppCompilerTargetConfig(python_executable=sys.executable)]
+    with pytest.raises(NotImplementedError):
+        WheelFileProcessor(config).run(
+            wheel_file=wheel_file,
+            working_fd=test_output_fd / 'working_targets',
+        )
+
+
+def test_wheel_file_processor_reproducible(monkeypatch):
+    test_output_fd = get_test_output_fd()
+    wheel_file = build_test_small_package_wheel(test_output_fd)
+    monkeypatch.setenv('SOURCE_DATE_EPOCH', '1700000000')
+
+    config = WheelFileProcessorConfig(
+        package_folder_processor_config=PackageFolderProcessorConfig(
+            code_file_processor_config=CodeFileProcessorConfig(
+                source_code_injector_config=SourceCodeInjectorConfig(
+                    fernet_key=Fernet.generate_key().decode(),
+                    enable_deterministic_encryption=True,
+                ),
+                cpp_compiler_config=CppCompilerConfig(enable_reproducible=True),
+            )
+        ),
+        wheel_writer_config=WheelWriterConfig(enable_reproducible=True),
+    )
+
+    digests = []
+    for enable_streaming in (False, True):
+        # Built in different folders.
+        for idx in range(2):
+            config.enable_streaming = enable_streaming
+            output = WheelFileProcessor(config).run(
+                wheel_file=wheel_file,
+                working_fd=test_output_fd / f'working_{enable_streaming}_{idx}',
+            )
+            print(output.execution_context_collection.get_logging_message())
+            assert output.succeeded
+            assert output.output_wheel_file
+            digests.append(hashlib.sha256(output.output_wheel_file.read_bytes()).hexdigest())
+
+            # RECORD is verified on read.
+            with WheelFile(output.output_wheel_file) as wf:
+                for zip_info in wf.infolist():
+                    wf.read(zip_info)
+
+    assert digests[0] == digests[1]
+    assert digests[2] == digests[3]